@@ -41,6 +41,7 @@ the table::
        print x
 """
 
+from bayeslite.stats import arithmetic_mean
 from bayeslite.util import cursor_value
 
 builtin_backends = []
@@ -206,6 +207,27 @@ class BayesDB_Backend(object):
         """Compute ``DEPENDENCE PROBABILITY OF <col0> WITH <col1>``."""
         raise NotImplementedError
 
+    def column_dependence_probabilities(self, bdb, generator_id, modelnos,
+            colnos):
+        """Compute ``DEPENDENCE PROBABILITY`` of every pair of `colnos`.
+
+        Used by ``ESTIMATE DEPENDENCE PROBABILITY FROM PAIRWISE
+        COLUMNS``.  Returns a square matrix, as a list of lists, whose
+        entry ``[i][j]`` is the dependence probability of ``colnos[i]``
+        with ``colnos[j]`` averaged over the models.
+
+        The default implementation calls
+        :meth:`column_dependence_probability` once for each pair.
+        Backends that can compute the whole matrix at once should
+        override it.
+        """
+        def depprob(colno0, colno1):
+            depprob_list = self.column_dependence_probability(
+                bdb, generator_id, modelnos, colno0, colno1)
+            return arithmetic_mean(depprob_list)
+        return [[depprob(colno0, colno1) for colno1 in colnos]
+            for colno0 in colnos]
+
     def column_mutual_information(self, bdb, generator_id, modelnos, colnos0,
             colnos1, constraints=None, numsamples=100):
         """Compute ``MUTUAL INFORMATION OF (<cols0>) WITH (<cols1>)``."""
@@ -216,6 +238,28 @@ class BayesDB_Backend(object):
         """Compute ``SIMILARITY TO <target_row>`` for given `rowid`."""
         raise NotImplementedError
 
+    def row_similarities(self, bdb, generator_id, modelnos, rowids,
+            target_rowids, colnos):
+        """Compute ``SIMILARITY`` of every row in `rowids` to every row
+        in `target_rowids`.
+
+        Used by ``ESTIMATE SIMILARITY FROM PAIRWISE``.  Returns a
+        matrix, as a list of lists, whose entry ``[i][j]`` is the
+        similarity of ``rowids[i]`` to ``target_rowids[j]`` averaged
+        over the models.
+
+        The default implementation calls :meth:`row_similarity` once
+        for each pair.  Backends that can compute a block of
+        similarities at once should override it.
+        """
+        def similarity(rowid, target_rowid):
+            similarity_list = self.row_similarity(
+                bdb, generator_id, modelnos, rowid, target_rowid, colnos)
+            return arithmetic_mean(similarity_list)
+        return [[similarity(rowid, target_rowid)
+                for target_rowid in target_rowids]
+            for rowid in rowids]
+
     def predictive_relevance(self, bdb, generator_id, modelnos, rowid_target,
             rowid_query, hypotheticals, colno):
         """Compute predictive relevance, also known as relevance probability.
@@ -244,6 +288,39 @@ class BayesDB_Backend(object):
         """Predict a value for a column and return confidence."""
         raise NotImplementedError
 
+    def predict_many(self, bdb, generator_id, modelnos, queries, threshold,
+            numsamples=None):
+        """Predict values for many cells, if confidence is high enough.
+
+        `queries` is a list of ``(rowid, colno)`` pairs.
+
+        Returns a list of values, or `None` where confidence is below
+        `threshold`, one for each query.
+        """
+        predictions = self.predict_confidence_many(
+            bdb, generator_id, modelnos, queries, numsamples=numsamples)
+        return [value if threshold <= confidence else None
+            for value, confidence in predictions]
+
+    def predict_confidence_many(self, bdb, generator_id, modelnos, queries,
+            numsamples=None):
+        """Predict values for many cells and return confidences.
+
+        `queries` is a list of ``(rowid, colno)`` pairs.
+
+        Returns a list of ``(value, confidence)`` pairs, one for each
+        query.
+
+        The default implementation calls :meth:`predict_confidence`
+        once for each query.
+        """
+        return [
+            self.predict_confidence(
+                bdb, generator_id, modelnos, rowid, colno,
+                numsamples=numsamples)
+            for rowid, colno in queries
+        ]
+
     def simulate_joint(self, bdb, generator_id, modelnos, rowid, targets,
             constraints, num_samples=1, accuracy=None):
         """Simulate `targets` from a generator, subject to `constraints`.
@@ -270,6 +347,28 @@ class BayesDB_Backend(object):
         """
         raise NotImplementedError
 
+    def simulate_joint_many(self, bdb, generator_id, modelnos, queries,
+            num_samples=1, accuracy=None):
+        """Simulate from a generator for each of many queries.
+
+        `queries` is a list of ``(rowid, targets, constraints)``
+        triples, each as for :meth:`simulate_joint`.
+
+        Returns a list of the results of :meth:`simulate_joint`, one
+        for each query.
+
+        The default implementation calls :meth:`simulate_joint` once
+        for each query.  Backends that can share the work of engine
+        lookup, constraint retrieval, and value encoding across
+        queries should override it.
+        """
+        return [
+            self.simulate_joint(
+                bdb, generator_id, modelnos, rowid, targets, constraints,
+                num_samples=num_samples, accuracy=accuracy)
+            for rowid, targets, constraints in queries
+        ]
+
     def logpdf_joint(self, bdb, generator_id, modelnos, rowid, targets,
             constraints):
         """Evalute the joint probability of `targets` subject to `constraints`.
@@ -286,6 +385,25 @@ class BayesDB_Backend(object):
         """
         raise NotImplementedError
 
+    def logpdf_joint_many(self, bdb, generator_id, modelnos, queries):
+        """Evaluate the joint probability density for many queries.
+
+        `queries` is a list of ``(rowid, targets, constraints)``
+        triples, each as for :meth:`logpdf_joint`.
+
+        Returns a list of log densities, one for each query.
+
+        The default implementation calls :meth:`logpdf_joint` once for
+        each query.  Backends that can share the work of engine lookup,
+        constraint retrieval, and value encoding across queries should
+        override it.
+        """
+        return [
+            self.logpdf_joint(
+                bdb, generator_id, modelnos, rowid, targets, constraints)
+            for rowid, targets, constraints in queries
+        ]
+
     def json_ready_models(self, bdb, population_id, generator_id):
         """Return a data object capturing model information
         that is ready to be written in JSON syntax.
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Analysis running in a background thread.
+
+A BayesDB connection may be used only by the thread which opened it, so
+the background thread never touches it: it analyzes a private copy of
+the models and hands each checkpoint over to be written by the thread
+which owns the connection, when that thread asks for it by calling
+:meth:`BackgroundAnalysis.poll` or :meth:`BackgroundAnalysis.wait`.
+Until then, queries read the models last written.
+"""
+
+import sys
+import threading
+import time
+
+# Marks the checkpoint slot empty.
+_EMPTY = object()
+
+class BackgroundAnalysis(object):
+    """Analysis of models running in a background thread.
+
+    `run` is a generator function, called in the background thread,
+    which yields a checkpoint of the analyzed models after each segment
+    of analysis.  `commit` is called with a checkpoint, in the thread
+    which polls or waits, to write it.  Each checkpoint supersedes the
+    ones before it, so only the latest one reached is kept until it is
+    written.
+    """
+
+    def __init__(self, run, commit):
+        self._commit = commit
+        # Guards the latest checkpoint not yet written, and the outcome
+        # of the analysis, and signals when either changes.
+        self._condition = threading.Condition()
+        self._checkpoint = _EMPTY
+        self._error = None
+        self._finished = False
+        self._cancelled = threading.Event()
+        self._done = False
+        self._commits = 0
+        self._thread = threading.Thread(target=self._work, args=(run,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def done(self):
+        """True if the analysis has finished and been written."""
+        return self._done
+
+    @property
+    def commits(self):
+        """Number of checkpoints written so far."""
+        return self._commits
+
+    def poll(self):
+        """Write the latest checkpoint reached, if any not yet written.
+
+        Return True if the analysis has finished.  If it failed, or the
+        checkpoint could not be written, raise the exception.
+        """
+        return self._drain(0)
+
+    def wait(self, timeout=None):
+        """Wait for the analysis to finish, writing its checkpoints.
+
+        Return True if it finished, or False if `timeout` seconds
+        passed first.  If it failed, or a checkpoint could not be
+        written, raise the exception.
+        """
+        return self._drain(timeout)
+
+    def cancel(self):
+        """Stop the analysis at the end of its current segment.
+
+        Checkpoints reached are still written by :meth:`poll` or
+        :meth:`wait`.
+        """
+        self._cancelled.set()
+
+    def _work(self, run):
+        try:
+            for checkpoint in run():
+                with self._condition:
+                    self._checkpoint = checkpoint
+                    self._condition.notify_all()
+                if self._cancelled.is_set():
+                    break
+        except Exception:
+            with self._condition:
+                self._error = sys.exc_info()
+        with self._condition:
+            self._finished = True
+            self._condition.notify_all()
+
+    def _drain(self, timeout):
+        if self._done:
+            return True
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            # Take the latest checkpoint reached, waiting for one or for
+            # the end of the analysis if there is none yet.
+            with self._condition:
+                while self._checkpoint is _EMPTY and self._error is None \
+                        and not self._finished:
+                    if deadline is None:
+                        self._condition.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                        self._condition.wait(remaining)
+                checkpoint = self._checkpoint
+                self._checkpoint = _EMPTY
+                error = self._error
+                finished = self._finished
+            if checkpoint is not _EMPTY:
+                try:
+                    self._commit(checkpoint)
+                except Exception:
+                    self._fail()
+                    raise
+                self._commits += 1
+            if error is not None:
+                self._fail()
+                exc_type, exc_value, exc_tb = error
+                raise exc_type, exc_value, exc_tb
+            if finished:
+                self._done = True
+                return True
+
+    def _fail(self):
+        # Stop the analysis and forget what remains of it.
+        self._cancelled.set()
+        self._done = True
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Memory-bounded cache of backend state for generators.
+
+A backend instance may be used across many BayesDB handles, e.g. the
+builtin backends, which are created once per Python session.  The
+cache holds, for each handle and generator, a dictionary of entries
+such as a deserialized engine, each with an estimated size in bytes.
+
+Handles are referenced weakly: once a handle is garbage collected, its
+entries are evicted.  When the total estimated size exceeds the
+budget, the entries of the least recently used generators, across all
+handles, are evicted until it no longer does, sparing only the most
+recently used generator.
+"""
+
+import collections
+import contextlib
+import time
+import weakref
+
+class BackendCache(object):
+    """LRU cache of per-generator backend state, bounded in size.
+
+    `max_bytes` is the budget for the estimated total size of the
+    entries, or ``None`` for no bound.  `evict`, if given, is called
+    with the generator id and the dictionary of entries of each
+    generator evicted, e.g. to release external resources.
+    """
+
+    def __init__(self, max_bytes=None, evict=None):
+        self.max_bytes = max_bytes
+        self._evict_func = evict
+        # (bdb ref, generator_id) -> {key: value}, least recent first.
+        self._generators = collections.OrderedDict()
+        # (bdb ref, generator_id) -> {key: size}
+        self._sizes = {}
+        self._bytes = 0
+        # bdb -> the weak reference to it used in keys
+        self._refs = weakref.WeakKeyDictionary()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._load_seconds = 0.
+
+    def get(self, bdb, generator_id, key):
+        """Return the entry for `key`, or None if there is none."""
+        gkey = self._gkey(bdb, generator_id)
+        entries = self._generators.get(gkey)
+        if entries is None:
+            return None
+        self._touch(gkey)
+        return entries.get(key)
+
+    def set(self, bdb, generator_id, key, value, size=None):
+        """Set the entry for `key` to `value` of estimated `size` bytes.
+
+        May evict the entries of less recently used generators.
+        """
+        gkey = self._gkey(bdb, generator_id)
+        if gkey not in self._generators:
+            self._generators[gkey] = {}
+            self._sizes[gkey] = {}
+        self._touch(gkey)
+        sizes = self._sizes[gkey]
+        self._bytes -= sizes.get(key, 0)
+        self._generators[gkey][key] = value
+        sizes[key] = size or 0
+        self._bytes += sizes[key]
+        self._shrink()
+
+    def delete(self, bdb, generator_id, key):
+        """Delete the entry for `key`, or all entries if `key` is None."""
+        gkey = self._gkey(bdb, generator_id)
+        if gkey not in self._generators:
+            return
+        if key is None:
+            del self._generators[gkey]
+            self._bytes -= sum(self._sizes.pop(gkey).itervalues())
+        elif key in self._generators[gkey]:
+            del self._generators[gkey][key]
+            self._bytes -= self._sizes[gkey].pop(key)
+
+    def set_max_bytes(self, max_bytes):
+        """Set the budget to `max_bytes`, evicting as needed.
+
+        Returns the previous budget.
+        """
+        old = self.max_bytes
+        self.max_bytes = max_bytes
+        self._shrink()
+        return old
+
+    def hit(self):
+        """Count a lookup satisfied by the cache."""
+        self._hits += 1
+
+    @contextlib.contextmanager
+    def miss(self):
+        """Count a lookup not satisfied by the cache, and time the load."""
+        self._misses += 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._load_seconds += time.time() - start
+
+    def stats(self):
+        """Return a dictionary of statistics about the cache.
+
+        - ``hits``, ``misses``: lookups satisfied and not by the cache
+        - ``evictions``: generators evicted to stay within the budget or
+          because their BayesDB handle was garbage collected
+        - ``load_seconds``: total time spent loading on misses
+        - ``generators``: number of generators with entries
+        - ``bytes``: estimated total size of the entries
+        - ``max_bytes``: the budget
+        """
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'load_seconds': self._load_seconds,
+            'generators': len(self._generators),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+    def _gkey(self, bdb, generator_id):
+        ref = self._refs.get(bdb)
+        if ref is None:
+            ref = weakref.ref(bdb, self._collected)
+            self._refs[bdb] = ref
+        return (ref, generator_id)
+
+    def _touch(self, gkey):
+        entries = self._generators.pop(gkey)
+        self._generators[gkey] = entries
+
+    def _shrink(self):
+        if self.max_bytes is None:
+            return
+        while self.max_bytes < self._bytes and 1 < len(self._generators):
+            gkey = next(iter(self._generators))
+            self._evict(gkey)
+
+    def _collected(self, ref):
+        for gkey in [gkey for gkey in self._generators if gkey[0] is ref]:
+            self._evict(gkey)
+
+    def _evict(self, gkey):
+        entries = self._generators.pop(gkey)
+        self._bytes -= sum(self._sizes.pop(gkey).itervalues())
+        self._evictions += 1
+        if self._evict_func is not None:
+            self._evict_func(gkey[1], entries)
@@ -61,6 +61,8 @@ phrase(set_row_cluster_conc)   ::= K_SET K_ROW K_CLUSTER
                                         K_OF column_name(col)
                                         K_TO concentration(conc).
 
+phrase(incorporate_rows)    ::= K_INCORPORATE K_NEW K_ROWS.
+
 variable_token_opt      ::= .
 variable_token_opt      ::= K_VARIABLE.
 variable_token_opt      ::= K_VARIABLES.
@@ -39,7 +39,9 @@ KEYWORDS = {
     'dependent': grammar.K_DEPENDENT,
     'ensure': grammar.K_ENSURE,
     'in': grammar.K_IN,
+    'incorporate': grammar.K_INCORPORATE,
     'independent': grammar.K_INDEPENDENT,
+    'new': grammar.K_NEW,
     'of': grammar.K_OF,
     'parameter': grammar.K_PARAMETER,
     'row': grammar.K_ROW,
@@ -53,6 +55,14 @@ KEYWORDS = {
     'within': grammar.K_WITHIN,
 }
 
+# The words of INCORPORATE NEW ROWS are keywords only there, where no
+# name can be, so that variables may still be named by them.  Each is
+# decided by the token before it and the word after it.
+CONTEXTUAL_KEYWORDS = {
+    'incorporate': lambda previous, following: following == 'new',
+    'new': lambda previous, following: previous == grammar.K_INCORPORATE,
+}
+
 PUNCTUATION = {
     '(': grammar.T_LROUND,
     ')': grammar.T_RROUND,
@@ -76,18 +86,25 @@ def parse(tokens):
     return semantics.phrases
 
 def tokenize(tokenses):
-    for token in intersperse(',', [flatten(tokens) for tokens in tokenses]):
+    flat = list(intersperse(',', [flatten(tokens) for tokens in tokenses]))
+    words = [casefold(token) if isinstance(token, str) else None
+        for token in flat]
+    previous = None
+    for token, following in zip(flat, words[1:] + [None]):
         if isinstance(token, str):
-            if casefold(token) in KEYWORDS:
-                yield KEYWORDS[casefold(token)], token
+            keyword = casefold(token)
+            if keyword in KEYWORDS and (keyword not in CONTEXTUAL_KEYWORDS
+                    or CONTEXTUAL_KEYWORDS[keyword](previous, following)):
+                previous = KEYWORDS[keyword]
             elif token in PUNCTUATION:
-                yield PUNCTUATION[token], token
+                previous = PUNCTUATION[token]
             else:               # XXX check for alphanumeric/_
-                yield grammar.L_NAME, token
+                previous = grammar.L_NAME
         elif isinstance(token, (int, float)):
-            yield grammar.L_NUMBER, token
+            previous = grammar.L_NUMBER
         else:
             raise IOError('Invalid token: %r' % (token,))
+        yield previous, token
     yield 0, ''                 # EOF
 
 class CGpmAlterSemantics(object):
@@ -112,9 +129,9 @@ class CGpmAlterSemantics(object):
 
     def p_alter_start(self, ps):                self.phrases = ps
 
-    def p_phrases_one(self, p):                 return [p] if p else []
+    def p_phrases_one(self, p):                 return [] if p is None else [p]
     def p_phrases_many(self, ps, p):
-        if p: ps.append(p)
+        if p is not None: ps.append(p)
         return ps
 
     def p_phrase_none(self,):                   return None
@@ -140,6 +157,9 @@ class CGpmAlterSemantics(object):
     def p_phrase_set_row_cluster_conc(self, col, conc):
         return SetRowClusterConc(col, conc)
 
+    def p_phrase_incorporate_rows(self):
+        return IncorporateRows()
+
     def p_dependency_independent(self):         return EnsureIndependent
     def p_dependency_dependent(self):           return EnsureDependent
 
@@ -189,6 +209,8 @@ SetRowClusterConc = namedtuple('SetRowClusterConc', [
     'concentration'     # real valued concentration parameter
 ])
 
+IncorporateRows = namedtuple('IncorporateRows', [])
+
 SqlAll = 'SqlAll'
 EnsureDependent = 'EnsureDependent'
 EnsureIndependent = 'EnsureIndependent'
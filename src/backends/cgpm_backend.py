@@ -14,20 +14,33 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import contextlib
+import copy
 import itertools
 import json
 import math
+import numpy
 import operator
+import time
 
 from collections import Counter
 from collections import defaultdict
 
 from cgpm.crosscat.engine import Engine
 
+import bayeslite.backends.cgpm_serialize as cgpm_serialize
 import bayeslite.core as core
 
+from bayeslite.backends.background import BackgroundAnalysis
+from bayeslite.backends.cache import BackendCache
+from bayeslite.backends.cgpm_pool import CostModel
+from bayeslite.backends.cgpm_pool import StatePool
+from bayeslite.backends.cgpm_pool import share_data
+from bayeslite.backends.cgpm_pool import unshare_data
+
 from bayeslite.exception import BQLError
 from bayeslite.backend import BayesDB_Backend
+from bayeslite.math_util import logavgexp_weighted
 from bayeslite.backend import bayesdb_backend_version
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
@@ -97,21 +110,62 @@ INSERT INTO bayesdb_cgpm_modelno (generator_id, modelno, cgpm_modelno)
     );
 '''
 
+CGPM_SCHEMA_4 = '''
+UPDATE bayesdb_backend SET version = 4 WHERE name = 'cgpm';
+
+CREATE TABLE bayesdb_cgpm_state (
+    generator_id        INTEGER NOT NULL REFERENCES bayesdb_generator(id),
+    cgpm_modelno        INTEGER NOT NULL,
+    state_json          BLOB NOT NULL,
+    state_stamp         INTEGER NOT NULL,
+    PRIMARY KEY(generator_id, cgpm_modelno)
+);
+'''
+
+# Number of rowids to inline into the IN (...) list of a single query when
+# looking up many rows at once.
+_SQL_CHUNK = 1000
+
+# Number of rows of a table to convert at a time when loading its data.
+_DATA_CHUNK = 10000
+
 
 class CGPM_Backend(BayesDB_Backend):
 
-    def __init__(self, cgpm_registry, multiprocess=None):
+    def __init__(self, cgpm_registry, multiprocess=None, engine_format=None,
+            cache_bytes=None, ckpt_overhead=None):
+        if engine_format is None:
+            engine_format = 'binary'
+        if engine_format not in ('binary', 'zlib', 'json'):
+            raise ValueError('Unknown engine format: %r' % (engine_format,))
         self._cgpm_registry = cgpm_registry
         self._multiprocess = multiprocess
-        # The cache is a dictionary whose keys are bayeslite.BayesDB objects,
-        # and whose values are dictionaries (one cache per bdb). We need
-        # self._cache to have separate caches for each bdb because the same
+        # Engines are stored in the compact binary format of
+        # cgpm_serialize, optionally compressed ('zlib'), or as JSON text
+        # readable by older versions of bayeslite ('json').  Engines in any
+        # format can be read.
+        self._engine_format = engine_format
+        # ANALYZE ... CHECKPOINT n SECONDS checkpoints less often than asked
+        # if writing the states would otherwise take more than this fraction
+        # of the time spent analyzing them.
+        if ckpt_overhead is None:
+            ckpt_overhead = 0.1
+        self._ckpt_overhead = ckpt_overhead
+        # When multiprocessing, states are evaluated in a pool of worker
+        # processes which keep them resident between queries, started on
+        # first use.  Each call is evaluated in parallel only if its cost
+        # model, fit to the times of past calls, expects that to be faster
+        # than evaluating the states one after another in process.
+        self._pool = None
+        self._costs = CostModel()
+        # The cache holds separate entries for each bdb because the same
         # instance of CGPM_Backend may be used across multiple bdb instances.
         # This situation occurs when CGPM_Backend is used as a default
         # backend (refer to __init__.py, where the bayeslite module, upon
         # import, creates a single CGPM_Backend object to be used throughout
-        # the python session).
-        self._cache = dict()
+        # the python session).  Entries are sized by an estimate of their
+        # size in memory, and `cache_bytes`, if not None, bounds the total.
+        self._cache = BackendCache(max_bytes=cache_bytes)
 
     def name(self):
         return 'cgpm'
@@ -134,7 +188,13 @@ class CGPM_Backend(BayesDB_Backend):
                 # Install CGPM version 3.
                 bdb.sql_execute(CGPM_SCHEMA_3)
                 version = 3
-            if version != 3:
+            if version == 3:
+                # Install CGPM version 4, and move each state of the
+                # existing engines into its own row.
+                bdb.sql_execute(CGPM_SCHEMA_4)
+                self._split_engines(bdb)
+                version = 4
+            if version != 4:
                 # Unrecognized version.
                 raise BQLError(bdb, 'CGPM already installed'
                     ' with unknown schema version: %d' % (version,))
@@ -142,8 +202,20 @@ class CGPM_Backend(BayesDB_Backend):
     def set_multiprocess(self, switch):
         old = self._multiprocess
         self._multiprocess = switch
+        if not switch and self._pool is not None:
+            self._pool.close()
+            self._pool = None
         return old
 
+    def set_cache_bytes(self, max_bytes):
+        return self._cache.set_max_bytes(max_bytes)
+
+    def cache_stats(self):
+        return self._cache.stats()
+
+    def execution_stats(self):
+        return self._costs.stats()
+
     def create_generator(self, bdb, generator_id, schema_tokens, **kwargs):
         schema_ast = cgpm_schema.parse.parse(schema_tokens)
         schema = _create_schema(bdb, generator_id, schema_ast, **kwargs)
@@ -165,52 +237,66 @@ class CGPM_Backend(BayesDB_Backend):
                 bdb, population_id, generator_id, var, stattype)
 
         # Assign codes to categories and consecutive column numbers to
-        # the modeled variables.
+        # the modeled variables.  The distinct values of each nominal
+        # column are numbered in a temporary table and copied with their
+        # codes, without passing through Python.
         vars_cursor = bdb.sql_execute('''
             SELECT colno, name, stattype FROM bayesdb_variable
                 WHERE population_id = ? AND 0 <= colno
         ''', (population_id,))
-        for colno, name, stattype in vars_cursor:
-            if _is_nominal(stattype):
+        nominals = [
+            (colno, name) for colno, name, stattype in vars_cursor.fetchall()
+            if _is_nominal(stattype)
+        ]
+        with _numbering(bdb) as qnt:
+            for colno, name in nominals:
                 qn = sqlite3_quote_name(name)
-                cursor = bdb.sql_execute('''
-                    SELECT DISTINCT %s
-                    FROM %s WHERE %s IS NOT NULL
-                ''' % (qn, qt, qn))
-                for code, (value,) in enumerate(cursor):
-                    bdb.sql_execute('''
-                        INSERT INTO bayesdb_cgpm_category
-                            (generator_id, colno, value, code)
-                            VALUES (?, ?, ?, ?)
-                    ''', (generator_id, colno, value, code))
+                bdb.sql_execute('''
+                    INSERT INTO %s (value)
+                        SELECT DISTINCT %s FROM %s WHERE %s IS NOT NULL
+                ''' % (qnt, qn, qt, qn))
+                bdb.sql_execute('''
+                    INSERT INTO bayesdb_cgpm_category
+                        (generator_id, colno, value, code)
+                        SELECT ?, ?, value, number - 1 FROM %s
+                ''' % (qnt,), (generator_id, colno))
+                bdb.sql_execute('DELETE FROM %s' % (qnt,))
+        self._del_cache_entry(bdb, generator_id, 'codebook')
 
         # Assign contiguous 0-indexed ids to the individuals in the
-        # table.
-        if schema['subsample']:
-            k = schema['subsample']
-            n = cursor_value(
-                bdb.sql_execute('SELECT COUNT(*) FROM %s' % (qt,)))
-            cursor = bdb.sql_execute(
-                'SELECT _rowid_ FROM %s ORDER BY _rowid_ ASC' % (qt,))
-            uniform = bdb._prng.weakrandom_uniform
-            # https://en.wikipedia.org/wiki/Reservoir_sampling
-            samples = []
-            for i, row in enumerate(cursor):
-                if i < k:
-                    samples.append(row)
-                else:
-                    r = uniform(i + 1)
-                    if r < k:
-                        samples[r] = row
-            cursor = samples
-        else:
-            cursor = bdb.sql_execute('SELECT _rowid_ FROM %s' % (qt,))
-        for cgpm_rowid, (table_rowid,) in enumerate(cursor):
+        # table, in order of table rowid, which is the order of the data
+        # given to the models.
+        with _numbering(bdb) as qnt:
+            if schema['subsample']:
+                k = schema['subsample']
+                cursor = bdb.sql_execute(
+                    'SELECT _rowid_ FROM %s ORDER BY _rowid_ ASC' % (qt,))
+                uniform = bdb._prng.weakrandom_uniform
+                # https://en.wikipedia.org/wiki/Reservoir_sampling
+                samples = []
+                for i, (rowid,) in enumerate(cursor):
+                    if i < k:
+                        samples.append(rowid)
+                    else:
+                        r = uniform(i + 1)
+                        if r < k:
+                            samples[r] = rowid
+                samples.sort()
+                for i in xrange(0, len(samples), _SQL_CHUNK):
+                    bdb.sql_execute('INSERT INTO %s (value) VALUES %s' % (
+                        qnt, ','.join('(%d)' % (rowid,)
+                            for rowid in samples[i:i + _SQL_CHUNK])))
+            else:
+                bdb.sql_execute('''
+                    INSERT INTO %s (value)
+                        SELECT _rowid_ FROM %s ORDER BY _rowid_ ASC
+                ''' % (qnt, qt))
             bdb.sql_execute('''
                 INSERT INTO bayesdb_cgpm_individual
                     (generator_id, table_rowid, cgpm_rowid)
-                    VALUES (?, ?, ?)
-            ''', (generator_id, table_rowid, cgpm_rowid))
+                    SELECT ?, value, number - 1 FROM %s
+            ''' % (qnt,), (generator_id,))
+        self._del_cache_entry(bdb, generator_id, 'rowid_map')
 
     def drop_generator(self, bdb, generator_id):
         # Remove the cache for this generator_id.
@@ -232,6 +318,11 @@ class CGPM_Backend(BayesDB_Backend):
             DELETE FROM bayesdb_cgpm_modelno WHERE generator_id = ?
         ''', (generator_id,))
 
+        # Delete states.
+        bdb.sql_execute('''
+            DELETE FROM bayesdb_cgpm_state WHERE generator_id = ?
+        ''', (generator_id,))
+
         # Delete generator.
         bdb.sql_execute('''
             DELETE FROM bayesdb_cgpm_generator WHERE generator_id = ?
@@ -267,10 +358,10 @@ class CGPM_Backend(BayesDB_Backend):
                         (generator_id, colno, value, code)
                         VALUES (?, ?, ?, ?)
                 ''', (generator_id, colno, value, code))
+            self._del_cache_entry(bdb, generator_id, 'codebook')
 
         # Retrieve the rows from the table.
-        rows = list(itertools.chain.from_iterable(
-            self._data(bdb, generator_id, [varname])))
+        rows = self._data(bdb, generator_id, [varname])[:, 0].tolist()
 
         # Retrieve the engine.
         engine = self._engine(bdb, generator_id)
@@ -280,8 +371,8 @@ class CGPM_Backend(BayesDB_Backend):
             rows, [colno], cctype=dist, distargs=params,
             multiprocess=self._multiprocess)
 
-        # Serialize the engine.
-        self._serialize_engine(bdb, generator_id, engine, True)
+        # Serialize the engine, including the data the states share.
+        self._serialize_engine(bdb, generator_id, engine, True, shared=True)
 
     def initialize_models(self, bdb, generator_id, modelnos):
         # Caller should guarantee a nondegenerate request.
@@ -317,10 +408,12 @@ class CGPM_Backend(BayesDB_Backend):
                 FROM bayesdb_generator_model
                 WHERE generator_id = ?
             ''', (generator_id,))
+            cgpm_modelnos = None
+            shared = True
         # Appending models to an existing engine.
         else:
-            # Retrieve the engine.
-            engine = self._engine(bdb, generator_id)
+            # Retrieve the engine, with a state to copy the data from.
+            engine = self._engine(bdb, generator_id, [0])
 
             # Confirm requested modelnos do not include existing models.
             intersection = [m for m in existing if m[0] in modelnos]
@@ -328,9 +421,11 @@ class CGPM_Backend(BayesDB_Backend):
                 raise BQLError(bdb,
                     'Cannot initialize existing models: %s.' % (intersection,))
 
-            # Add the states.
-            engine.add_state(
+            # Add the states, to an engine of the one loaded.
+            added = _sub_engine(engine, [0])
+            added.add_state(
                 count=len(modelnos), multiprocess=self._multiprocess)
+            engine.states.extend(added.states[1:])
 
             # Update bayesdb_cgpm_modelno table.
             cgpm_modelnos = range(len(existing), len(existing) + len(modelnos))
@@ -340,9 +435,11 @@ class CGPM_Backend(BayesDB_Backend):
                         (generator_id, modelno, cgpm_modelno)
                         VALUES (?, ?, ?)
                 ''', (generator_id, modelno, cgpm_modelno))
+            shared = False
 
-        # Serialize the engine without caching.
-        self._serialize_engine(bdb, generator_id, engine, False)
+        # Serialize the new states without caching.
+        self._serialize_engine(bdb, generator_id, engine, False,
+            cgpm_modelnos=cgpm_modelnos, shared=shared)
 
     def drop_models(self, bdb, generator_id, modelnos=None):
         # Retrieve currently initialized modelnos.
@@ -364,34 +461,86 @@ class CGPM_Backend(BayesDB_Backend):
                 DELETE FROM bayesdb_cgpm_modelno
                 WHERE generator_id = ?
             ''', (generator_id,))
+            # Delete the states.
+            bdb.sql_execute('''
+                DELETE FROM bayesdb_cgpm_state WHERE generator_id = ?
+            ''', (generator_id,))
             # Delete the engine from the cache.
             self._del_cache_entry(bdb, generator_id, 'engine')
-        # Drop some models.
+        # Drop some models, without loading any states.
         else:
-            engine = self._engine(bdb, generator_id)
+            engine = self._engine_latest(bdb, generator_id)
             cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
-            for m in cgpm_modelnos:
-                del engine.states[m]
-                # Delete the modelno entry.
-                bdb.sql_execute('''
-                    DELETE FROM bayesdb_cgpm_modelno
-                    WHERE generator_id = ? AND cgpm_modelno = ?
-                ''', (generator_id, m,))
-                # Decrement all greater cgpm_modelnos by 1.
-                bdb.sql_execute('''
-                    UPDATE bayesdb_cgpm_modelno
-                    SET cgpm_modelno = cgpm_modelno - 1
-                    WHERE generator_id = ? AND cgpm_modelno > ?
-                ''', (generator_id, m,))
+            engine_stamp = self._engine_stamp(bdb, generator_id) + 1
+            # Delete the states, and renumber the states after them by way
+            # of negative numbers, so they are unique at every step.  Each
+            # moves down by the number of dropped states before it.
+            # Renumbered states get a new stamp, so that other caches of
+            # the engine will not take them for the states they had under
+            # their old numbers.
+            dropped = _sql_in_ranges('cgpm_modelno', cgpm_modelnos)
+            shift = _sql_count_below('cgpm_modelno', cgpm_modelnos)
+            bdb.sql_execute('''
+                DELETE FROM bayesdb_cgpm_state
+                WHERE generator_id = ? AND %s
+            ''' % (dropped,), (generator_id,))
+            bdb.sql_execute('''
+                UPDATE bayesdb_cgpm_state
+                SET cgpm_modelno = -1 - (cgpm_modelno - %s), state_stamp = ?
+                WHERE generator_id = ? AND cgpm_modelno > ?
+            ''' % (shift,), (engine_stamp, generator_id, min(cgpm_modelnos)))
+            bdb.sql_execute('''
+                UPDATE bayesdb_cgpm_state
+                SET cgpm_modelno = -1 - cgpm_modelno
+                WHERE generator_id = ? AND cgpm_modelno < 0
+            ''', (generator_id,))
+            # Delete the modelno entries, and renumber the ones after them
+            # likewise.
+            bdb.sql_execute('''
+                DELETE FROM bayesdb_cgpm_modelno
+                WHERE generator_id = ? AND %s
+            ''' % (dropped,), (generator_id,))
+            bdb.sql_execute('''
+                UPDATE bayesdb_cgpm_modelno
+                SET cgpm_modelno = cgpm_modelno - %s
+                WHERE generator_id = ? AND cgpm_modelno > ?
+            ''' % (shift,), (generator_id, min(cgpm_modelnos)))
             # Assert that the cgpm_modelnos are sequential.
             cursor = bdb.sql_execute('''
                 SELECT cgpm_modelno FROM bayesdb_cgpm_modelno
                 WHERE generator_id = ? ORDER BY cgpm_modelno ASC
             ''', (generator_id,))
             modelnos_cgpm_new = [m[0] for m in cursor]
-            assert modelnos_cgpm_new == range(engine.num_states())
-            # Serialize the engine.
-            self._serialize_engine(bdb, generator_id, engine, True)
+            cursor = bdb.sql_execute('''
+                SELECT cgpm_modelno FROM bayesdb_cgpm_state
+                WHERE generator_id = ? ORDER BY cgpm_modelno ASC
+            ''', (generator_id,))
+            assert modelnos_cgpm_new == [m[0] for m in cursor]
+            # Increment the stamp.
+            bdb.sql_execute('''
+                UPDATE bayesdb_cgpm_generator SET engine_stamp = ?
+                WHERE generator_id = ?
+            ''', (engine_stamp, generator_id))
+            # Drop the states from the cached engine, if it is up to date.
+            if engine is not None:
+                dropped = set(cgpm_modelnos)
+                state_stamps = {}
+                cached_state_stamps = self._get_cache_entry(
+                    bdb, generator_id, 'state_stamps')
+                for stateno, state_stamp in cached_state_stamps.iteritems():
+                    if stateno in dropped:
+                        continue
+                    shift = len([m for m in dropped if m < stateno])
+                    state_stamps[stateno - shift] = \
+                        engine_stamp if shift else state_stamp
+                engine.states = [state
+                    for stateno, state in enumerate(engine.states)
+                    if stateno not in dropped]
+                self._set_cache_entry(bdb, generator_id, 'engine', engine,
+                    _engine_bytes(engine))
+                self._set_cache_entry(bdb, generator_id, 'stamp', engine_stamp)
+                self._set_cache_entry(
+                    bdb, generator_id, 'state_stamps', state_stamps)
 
     def alter(self, bdb, generator_id, modelnos, commands):
         # Get the population_id.
@@ -401,16 +550,17 @@ class CGPM_Backend(BayesDB_Backend):
         cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
 
         # Retrieve the engine.
-        engine = self._engine(bdb, generator_id)
+        engine = self._engine(bdb, generator_id, cgpm_modelnos)
 
         # Find baseline variable numbers for error checking.
-        vars_baseline = engine.states[0].outputs
+        vars_baseline = _loaded_state(engine).outputs
 
         # Retrieve the AST.
         alter_ast =  cgpm_alter.parse.parse(commands)
 
         # Prepare alteration functions.
         alter_funcs = []
+        incorporate = False
 
         # Reduce verbosity with helper functions.
         get_varno = lambda variable: core.bayesdb_variable_number(
@@ -548,12 +698,132 @@ class CGPM_Backend(BayesDB_Backend):
                     varno, clause.concentration)
                 alter_funcs.append(func)
 
-        # Execute alteration functions.
-        engine.alter(alter_funcs, statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess)
+            # INCORPORATE NEW ROWS.
+            elif isinstance(clause, cgpm_alter.parse.IncorporateRows):
+                if modelnos is not None:
+                    raise BQLError(bdb,
+                        'New rows are incorporated into all models.')
+                incorporate = True
+
+        if alter_funcs:
+            # Execute alteration functions.
+            altered = _sub_engine(engine, cgpm_modelnos)
+            altered.alter(alter_funcs, multiprocess=self._multiprocess)
+            _put_states(engine, altered, cgpm_modelnos)
+
+            # Serialize the altered states.
+            self._serialize_engine(bdb, generator_id, engine, True,
+                cgpm_modelnos=cgpm_modelnos)
+
+        if incorporate:
+            self._incorporate_new_rows(bdb, generator_id)
+
+    def _incorporate_new_rows(self, bdb, generator_id):
+        # Incorporate the rows added to the table since the generator was
+        # created or last incorporated rows into every state, and resample
+        # their row cluster assignments alone.  Rows with no values of the
+        # modeled variables are left out until they have some.
+        if self._schema(bdb, generator_id)['subsample']:
+            raise BQLError(bdb,
+                'Cannot incorporate new rows into a subsampled generator.')
+        engine = self._engine(bdb, generator_id)
+        state = _loaded_state(engine)
+        if state.hooked_cgpms:
+            raise BQLError(bdb, 'Cannot incorporate new rows into'
+                ' a generator with foreign cgpms.')
 
-        # Serialize the engine.
-        self._serialize_engine(bdb, generator_id, engine, True)
+        population_id = core.bayesdb_generator_population(bdb, generator_id)
+        outputs = state.outputs
+        variables = [
+            core.bayesdb_variable_name(bdb, population_id, generator_id, colno)
+            for colno in outputs
+        ]
+        table = core.bayesdb_generator_table(bdb, generator_id)
+        qt = sqlite3_quote_name(table)
+        new_rows = '''
+            _rowid_ NOT IN (
+                SELECT table_rowid FROM bayesdb_cgpm_individual
+                    WHERE generator_id = :generator_id
+            )
+            AND (%s)
+        ''' % (' OR '.join(
+            '%s IS NOT NULL' % (sqlite3_quote_name(var),)
+            for var in variables),)
+
+        # Refuse categories the models have no code for, rather than lose
+        # them for good.
+        for colno, var in zip(outputs, variables):
+            stattype = core.bayesdb_variable_stattype(
+                bdb, population_id, generator_id, colno)
+            if not _is_nominal(stattype):
+                continue
+            qv = sqlite3_quote_name(var)
+            cursor = bdb.sql_execute('''
+                SELECT DISTINCT %s FROM %s
+                    WHERE %s AND %s IS NOT NULL AND %s NOT IN (
+                        SELECT value FROM bayesdb_cgpm_category
+                            WHERE generator_id = :generator_id
+                                AND colno = :colno
+                    )
+            ''' % (qv, qt, new_rows, qv, qv), {
+                'generator_id': generator_id,
+                'colno': colno,
+            })
+            unknown = [value for (value,) in cursor]
+            if unknown:
+                raise BQLError(bdb, 'Unknown categories of %s in new rows: %r'
+                    % (var, sorted(unknown)))
+
+        # Give the new rows the next cgpm rowids, in order of table rowid.
+        cursor = bdb.sql_execute('''
+            SELECT COALESCE(MAX(cgpm_rowid) + 1, 0)
+                FROM bayesdb_cgpm_individual WHERE generator_id = ?
+        ''', (generator_id,))
+        cgpm_rowid_min = cursor_value(cursor)
+        with _numbering(bdb) as qnt:
+            bdb.sql_execute('''
+                INSERT INTO %s (value)
+                    SELECT _rowid_ FROM %s WHERE %s ORDER BY _rowid_ ASC
+            ''' % (qnt, qt, new_rows), {'generator_id': generator_id})
+            num_rows = cursor_value(
+                bdb.sql_execute('SELECT COUNT(*) FROM %s' % (qnt,)))
+            if not num_rows:
+                return
+            bdb.sql_execute('''
+                INSERT INTO bayesdb_cgpm_individual
+                    (generator_id, table_rowid, cgpm_rowid)
+                    SELECT ?, value, ? + number - 1 FROM %s
+            ''' % (qnt,), (generator_id, cgpm_rowid_min))
+        self._del_cache_entry(bdb, generator_id, 'rowid_map')
+        cgpm_rowids = range(cgpm_rowid_min, cgpm_rowid_min + num_rows)
+
+        # Incorporate their observed values of the baseline variables into
+        # each state.
+        data = self._data(bdb, generator_id, variables,
+            cgpm_rowid_min=cgpm_rowid_min)
+        observed = ~numpy.isnan(data)
+        observations = [
+            {colno: value
+                for colno, value, ok in zip(outputs, row, observed_row) if ok}
+            for row, observed_row in zip(data.tolist(), observed)
+        ]
+
+        # The cached engine is changed in place, so forget it if anything
+        # fails: the savepoint rolls back what was written, not the cache.
+        try:
+            unshare_data(engine.states)
+            for state in engine.states:
+                for cgpm_rowid, observation in zip(cgpm_rowids, observations):
+                    state.incorporate(cgpm_rowid, observation)
+            engine.transition(N=1, kernels=['rows'], rowids=cgpm_rowids,
+                progress=False, multiprocess=self._multiprocess)
+
+            # Serialize the states, with the data they now share.
+            self._serialize_engine(bdb, generator_id, engine, True,
+                shared=True)
+        except Exception:
+            self._del_cache_entry(bdb, generator_id, None)
+            raise
 
     def analyze_models(
             self, bdb, generator_id, modelnos=None, iterations=None,
@@ -563,30 +833,114 @@ class CGPM_Backend(BayesDB_Backend):
         if not iterations and not max_seconds:
             return
 
-        # Checkpoint by seconds disabled.
-        if ckpt_seconds:
-            raise NotImplementedError('Checkpoint by seconds in CGPM analyze.')
+        engine, statenos, transition = self._prepare_analysis(bdb,
+            generator_id, modelnos, iterations, max_seconds, ckpt_iterations,
+            ckpt_seconds, program, False)
+
+        # Analyze, and serialize the analyzed states at each checkpoint.
+        segments = self._analysis_segments(
+            lambda n, seconds: transition(engine, n, seconds),
+            iterations, max_seconds, ckpt_seconds)
+        for _segment in segments:
+            with bdb.savepoint():
+                self._serialize_engine(bdb, generator_id, engine, True,
+                    cgpm_modelnos=statenos)
 
+    def analyze_models_async(
+            self, bdb, generator_id, modelnos=None, iterations=None,
+            max_seconds=None, ckpt_iterations=None, ckpt_seconds=None,
+            program=None):
+        """Start analyzing models in a background thread.
+
+        Arguments are as for :meth:`analyze_models`.  The models are
+        copied as last written and the copies analyzed while the
+        connection remains free for queries, which read the models as
+        last written.  Return a
+        :class:`~bayeslite.backends.background.BackgroundAnalysis`,
+        whose `poll` and `wait` methods write the analyzed models at
+        each checkpoint reached, in a single transaction bumping the
+        engine stamp.  Writing fails with BQLError if the models were
+        changed otherwise since the analysis started.
+        """
+        if not iterations and not max_seconds:
+            raise BQLError(bdb,
+                'Background analysis needs iterations or seconds.')
+
+        engine, statenos, transition = self._prepare_analysis(bdb,
+            generator_id, modelnos, iterations, max_seconds, ckpt_iterations,
+            ckpt_seconds, program, True)
+        num_states = engine.num_states()
+        if statenos is None:
+            statenos = range(num_states)
+        statenos = sorted(statenos)
+
+        # Copy the states as last written, with a random number generator
+        # of their own, which the background thread alone may use.
+        stamps = self._state_stamps(bdb, generator_id, statenos)
+        seed = bdb.np_prng.randint(2**31 - 1)
+        analyzed = self._read_engine(bdb, generator_id, statenos,
+            numpy.random.RandomState(seed))
+        states = [None] * num_states
+        for stateno, state in zip(statenos, analyzed.states):
+            states[stateno] = state
+        analyzed.states = states
+
+        def run():
+            # In the background thread: analyze the copy, and serialize
+            # its states at each checkpoint.
+            segments = self._analysis_segments(
+                lambda n, seconds: transition(analyzed, n, seconds),
+                iterations, max_seconds, ckpt_seconds)
+            for _segment in segments:
+                metadata = _engine_metadata(analyzed, statenos)
+                yield [self._dumps(state) for state in metadata['states']]
+
+        def commit(states_serialized):
+            # In the thread polling: write the states if nothing else has
+            # since the analysis started.
+            with bdb.savepoint():
+                if self._state_stamps(bdb, generator_id, statenos) != stamps:
+                    generator = core.bayesdb_generator_name(bdb, generator_id)
+                    raise BQLError(bdb, 'Models of generator %r changed'
+                        ' during background analysis.' % (generator,))
+                engine_stamp = self._write_states(
+                    bdb, generator_id, statenos, states_serialized)
+            stamps.update((stateno, engine_stamp) for stateno in statenos)
+
+        return BackgroundAnalysis(run, commit)
+
+    def _prepare_analysis(self, bdb, generator_id, modelnos, iterations,
+            max_seconds, ckpt_iterations, ckpt_seconds, program, background):
+        # Check an analysis and return the engine with the states to
+        # analyze loaded, their numbers, or None for all, and a function
+        # transition(engine, iterations, max_seconds) to analyze them in
+        # an engine.
         if program is None:
             program = []
 
         # Get the modelnos.
         cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
 
-        # Retrieve the engine.
-        engine = self._engine(bdb, generator_id)
-
         # Retrieve user-specified target variables to transition.
         analyze_ast = cgpm_analyze.parse.parse(program)
         vars_user, rowids_user, subproblems, optimized, quiet = \
             _retrieve_analyze_variables(bdb, generator_id, analyze_ast)
 
-        # Explicitly suppress progress bar if quiet, otherwise use default.
-        progress = False if quiet else None
+        # Retrieve the engine, with the states to analyze.  Loom analyzes
+        # all of them.
+        statenos = cgpm_modelnos
+        if optimized and optimized.backend == 'loom':
+            statenos = None
+        engine = self._engine(bdb, generator_id, statenos)
+
+        # Explicitly suppress progress bar if quiet or in the background,
+        # otherwise use default.
+        progress = False if quiet or background else None
 
-        vars_baseline = engine.states[0].outputs
+        state = _loaded_state(engine)
+        vars_baseline = state.outputs
         vars_foreign = list(itertools.chain.from_iterable([
-            cgpm.outputs for cgpm in engine.states[0].hooked_cgpms.itervalues()
+            cgpm.outputs for cgpm in state.hooked_cgpms.itervalues()
         ]))
 
         # By default transition all baseline variables only.
@@ -634,19 +988,99 @@ class CGPM_Backend(BayesDB_Backend):
                 raise BQLError(bdb, 'No VARIABLES or SKIP in Loom.')
             if rowids_user:
                 raise BQLError(bdb, 'No ROWS in Loom.')
+            if ckpt_seconds:
+                raise BQLError(bdb, 'No CHECKPOINT by SECONDS in Loom.')
+            if background:
+                raise BQLError(bdb, 'No background analysis in Loom.')
+
+        # Number of rows each iteration transitions, to estimate its cost.
+        num_rows = len(rowids_cgpm) if rowids_cgpm is not None \
+            else len(self._rowid_map(bdb, generator_id)['cgpm_rowids'])
+
+        def transition(engine, iterations, max_seconds):
+            self._transition(engine, optimized, iterations, max_seconds,
+                kernels, vars_target_baseline, vars_target_foreign,
+                rowids_cgpm, num_rows, progress, ckpt_iterations,
+                cgpm_modelnos)
+
+        return engine, statenos, transition
+
+    def _analysis_segments(self, transition, iterations, max_seconds,
+            ckpt_seconds):
+        # Call transition(iterations, max_seconds) in segments of about
+        # `ckpt_seconds` each, or in one if None, and yield after each so
+        # the caller can checkpoint the analyzed states.  Segments bounded
+        # by iterations are sized by the time the last one took per
+        # iteration.
+        if not ckpt_seconds:
+            transition(iterations, max_seconds)
+            yield
+            return
+        deadline = time.time() + max_seconds if max_seconds else None
+        interval = ckpt_seconds
+        remaining = iterations
+        per_iteration = None
+        while True:
+            start = time.time()
+            seconds = None if deadline is None else max(0, deadline - start)
+            if remaining is None:
+                n = None
+                seconds = min(interval, seconds)
+            elif per_iteration is None:
+                n = 1
+            else:
+                n = min(remaining, max(1, int(interval / per_iteration)))
+            transition(n, seconds)
+            elapsed = time.time() - start
+            if n is not None:
+                per_iteration = elapsed / n
+                remaining -= n
+            yield
+            overhead = time.time() - start - elapsed
+            if remaining == 0 or \
+                    (deadline is not None and deadline <= time.time()):
+                break
+            # Checkpoint less often if checkpointing takes too long.
+            if self._ckpt_overhead * elapsed < overhead:
+                interval = max(interval, overhead / self._ckpt_overhead)
+
+    def _transition(self, engine, optimized, iterations, max_seconds,
+            kernels, vars_target_baseline, vars_target_foreign, rowids_cgpm,
+            num_rows, progress, ckpt_iterations, cgpm_modelnos):
+        # Transition the states in parallel if the cost model expects that
+        # to pay off, and always if bounded only by time.
+        loom = optimized and optimized.backend == 'loom'
+        num_states = engine.num_states() \
+            if cgpm_modelnos is None or loom else len(cgpm_modelnos)
+        units = None
+        if iterations is not None:
+            units = num_states * iterations * max(1, num_rows)
+        if not self._multiprocess:
+            multiprocess = False
+        elif units is None:
+            multiprocess = num_states > 1
+        else:
+            multiprocess = self._costs.choose(
+                'transition', num_states, units)
+        start = time.time()
+
+        # Hand cgpm only the states to transition, which alone may be
+        # loaded; Loom transitions all of them.
+        transitioned = engine if loom \
+            else _sub_engine(engine, cgpm_modelnos)
 
         # Run transitions on baseline variables.
         if vars_target_baseline:
-            if optimized and optimized.backend == 'loom':
-                engine.transition_loom(
+            if loom:
+                transitioned.transition_loom(
                     N=iterations,
                     S=max_seconds,
                     progress=progress,
                     checkpoint=ckpt_iterations,
-                    multiprocess=self._multiprocess,
+                    multiprocess=multiprocess,
                 )
             elif optimized and optimized.backend == 'lovecat':
-                engine.transition_lovecat(
+                transitioned.transition_lovecat(
                     N=iterations,
                     S=max_seconds,
                     kernels=kernels,
@@ -654,11 +1088,10 @@ class CGPM_Backend(BayesDB_Backend):
                     rowids=rowids_cgpm,
                     progress=progress,
                     checkpoint=ckpt_iterations,
-                    statenos=cgpm_modelnos,
-                    multiprocess=self._multiprocess,
+                    multiprocess=multiprocess,
                 )
             else:
-                engine.transition(
+                transitioned.transition(
                     N=iterations,
                     S=max_seconds,
                     kernels=kernels,
@@ -666,24 +1099,26 @@ class CGPM_Backend(BayesDB_Backend):
                     rowids=rowids_cgpm,
                     progress=progress,
                     checkpoint=ckpt_iterations,
-                    statenos=cgpm_modelnos,
-                    multiprocess=self._multiprocess,
+                    multiprocess=multiprocess,
                 )
 
         # Run transitions on foreign variables.
         if vars_target_foreign:
-            engine.transition_foreign(
+            transitioned.transition_foreign(
                 N=iterations,
                 S=max_seconds,
                 cols=vars_target_foreign,
                 progress=progress,
-                statenos=cgpm_modelnos,
-                multiprocess=self._multiprocess,
+                multiprocess=multiprocess,
             )
 
-        # Serialize the engine.
-        self._serialize_engine(bdb, generator_id, engine, True)
+        # Parallel transitions replace the states.
+        if not loom:
+            _put_states(engine, transitioned, cgpm_modelnos)
 
+        if units is not None:
+            self._costs.record('transition', multiprocess, num_states, units,
+                time.time() - start)
 
     def column_dependence_probability(
             self, bdb, generator_id, modelnos, colno0, colno1):
@@ -697,16 +1132,44 @@ class CGPM_Backend(BayesDB_Backend):
         cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
 
         # Get the engine.
-        engine = self._engine(bdb, generator_id)
+        engine = self._engine(bdb, generator_id, cgpm_modelnos)
 
         # Engine gives us a list of dependence probabilities which it is our
         # responsibility to integrate over.
-        depprob_list = engine.dependence_probability(
-            colno0, colno1, statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess)
+        depprob_list = self._evaluate(bdb, generator_id, engine,
+            cgpm_modelnos, 'dependence_probability', colno0, colno1)
 
         return depprob_list
 
+    def column_dependence_probabilities(
+            self, bdb, generator_id, modelnos, colnos):
+        # Get the modelnos.
+        cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
+
+        # Get the engine and the states to integrate over.
+        engine = self._engine(bdb, generator_id, cgpm_modelnos)
+        statenos = cgpm_modelnos
+        if statenos is None:
+            statenos = range(engine.num_states())
+        states = [engine.states[stateno] for stateno in statenos]
+
+        # Dependence through foreign cgpms is not determined by the column
+        # partition alone, so ask the engine pair by pair.
+        if any(state.hooked_cgpms for state in states):
+            return super(CGPM_Backend, self).column_dependence_probabilities(
+                bdb, generator_id, modelnos, colnos)
+
+        # Two columns are dependent in a state exactly when they are in the
+        # same view.  state.Zv() is a column partition given as
+        # {col_num : view_num, ...}, so compare the view assignments of all
+        # pairs of columns at once.
+        depprobs = numpy.zeros((len(colnos), len(colnos)))
+        for state in states:
+            Zv = state.Zv()
+            views = numpy.array([Zv[colno] for colno in colnos])
+            depprobs += views[:, numpy.newaxis] == views[numpy.newaxis, :]
+        return depprobs / len(states)
+
     def column_mutual_information(
             self, bdb, generator_id, modelnos, colnos0, colnos1,
             constraints=None, numsamples=None):
@@ -718,7 +1181,7 @@ class CGPM_Backend(BayesDB_Backend):
         cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
 
         # Get the engine.
-        engine = self._engine(bdb, generator_id)
+        engine = self._engine(bdb, generator_id, cgpm_modelnos)
 
         # Build the evidence, ignoring nan values and converting nominals.
         evidence = constraints and {
@@ -729,10 +1192,9 @@ class CGPM_Backend(BayesDB_Backend):
 
         # Engine gives us a list of samples which it is our
         # responsibility to integrate over.
-        mi_list = engine.mutual_information(
+        mi_list = _sub_engine(engine, cgpm_modelnos).mutual_information(
             colnos0, colnos1, constraints=evidence, N=numsamples,
-            progress=True, statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess)
+            progress=True, multiprocess=self._multiprocess)
 
         # Pass through the distribution of CMI to BayesDB without aggregation.
         return mi_list
@@ -751,16 +1213,60 @@ class CGPM_Backend(BayesDB_Backend):
             return [float('nan')]
 
         # Get the engine.
-        engine = self._engine(bdb, generator_id)
+        engine = self._engine(bdb, generator_id, cgpm_modelnos)
 
         # Engine gives us a list of similarities which it is our
         # responsibility to integrate over.
-        similarity_list = engine.row_similarity(
-            cgpm_rowid, cgpm_target_rowid, colnos, statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess)
+        similarity_list = self._evaluate(bdb, generator_id, engine,
+            cgpm_modelnos, 'row_similarity',
+            cgpm_rowid, cgpm_target_rowid, colnos)
 
         return similarity_list
 
+    def row_similarities(
+            self, bdb, generator_id, modelnos, rowids, target_rowids, colnos):
+        # Retrieve the modelnos.
+        cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
+
+        # Get the engine and the states to integrate over.
+        engine = self._engine(bdb, generator_id, cgpm_modelnos)
+        statenos = cgpm_modelnos
+        if statenos is None:
+            statenos = range(engine.num_states())
+        states = [engine.states[stateno] for stateno in statenos]
+
+        # Similarity in the context of a foreign cgpm's variables is not
+        # determined by the row partitions, so ask the engine pair by pair.
+        if any(colno not in state.Zv() for state in states for colno in colnos):
+            return super(CGPM_Backend, self).row_similarities(
+                bdb, generator_id, modelnos, rowids, target_rowids, colnos)
+
+        # Map the individual indexing.  Rows which are not incorporated have
+        # no similarity to anything.
+        row_clusters = self._row_clusters(bdb, generator_id, engine)
+        cgpm_rowids = row_clusters['cgpm_rowids']
+        rows0 = numpy.array([cgpm_rowids.get(rowid, -1) for rowid in rowids])
+        rows1 = numpy.array(
+            [cgpm_rowids.get(rowid, -1) for rowid in target_rowids])
+
+        # In each state, the similarity of two rows is the fraction of the
+        # views of colnos in which they are in the same cluster.
+        similarities = numpy.zeros((len(rowids), len(target_rowids)))
+        for stateno, state in zip(statenos, states):
+            views = set(state.Zv(colno) for colno in colnos)
+            for view in views:
+                Zr = row_clusters['Zr'].get((stateno, view))
+                if Zr is None:
+                    Zr = _row_partition(state.views[view].Zr())
+                    row_clusters['Zr'][stateno, view] = Zr
+                similarities += \
+                    (Zr[rows0][:, numpy.newaxis] == Zr[rows1][numpy.newaxis, :]) \
+                    / float(len(views))
+        similarities /= len(states)
+        similarities[rows0 == -1, :] = float('nan')
+        similarities[:, rows1 == -1] = float('nan')
+        return similarities
+
     def predictive_relevance(
             self, bdb, generator_id, modelnos, rowid_target, rowid_query,
             hypotheticals, colno):
@@ -780,7 +1286,7 @@ class CGPM_Backend(BayesDB_Backend):
         # drop any rowids which are not incorporated.
         cgpm_rowid_query = filter(
             lambda r: r != -1,
-            [self._cgpm_rowid(bdb, generator_id, r) for r in rowid_query]
+            self._cgpm_rowids(bdb, generator_id, rowid_query)
         )
 
         # If the query rowids are all not incorporated and no hypotheticals,
@@ -804,12 +1310,13 @@ class CGPM_Backend(BayesDB_Backend):
                 % (hypotheticals,))
 
         # Get the engine.
-        engine = self._engine(bdb, generator_id)
+        engine = self._engine(bdb, generator_id, cgpm_modelnos)
 
         # Go!
-        similarity_list = engine.relevance_probability(
-            cgpm_rowid_target, cgpm_rowid_query, colno, hypotheticals_numeric,
-            statenos=cgpm_modelnos, multiprocess=self._multiprocess)
+        similarity_list = _sub_engine(engine, cgpm_modelnos) \
+            .relevance_probability(
+                cgpm_rowid_target, cgpm_rowid_query, colno,
+                hypotheticals_numeric, multiprocess=self._multiprocess)
 
         return similarity_list
 
@@ -819,20 +1326,15 @@ class CGPM_Backend(BayesDB_Backend):
             numsamples = 2
         assert numsamples > 0
 
-        def _impute_nominal(sample):
-            counts = Counter(s[0] for s in sample)
-            mode_count = max(counts[v] for v in counts)
-            pred = iter(v for v in counts if counts[v] == mode_count).next()
-            conf = float(mode_count) / numsamples
-            return pred, conf
-
-        def _impute_numerical(sample):
-            pred = sum(s[0] for s in sample) / float(len(sample))
-            conf = 0 # XXX Punt confidence for now
-            return pred, conf
+        # Predict from the posterior predictive in closed form if possible.
+        prediction = self._predict_exact(
+            bdb, generator_id, modelnos, [(rowid, colno)])[0]
+        if prediction is not None:
+            return prediction
 
-        # Retrieve the samples. Specifying `rowid` ensures that relevant
-        # constraints are retrieved by `simulate`, so provide empty constraints.
+        # Otherwise retrieve the samples. Specifying `rowid` ensures that
+        # relevant constraints are retrieved by `simulate`, so provide empty
+        # constraints.
         sample = self.simulate_joint(
             bdb, generator_id, modelnos, rowid, [colno], [], numsamples)
 
@@ -840,10 +1342,152 @@ class CGPM_Backend(BayesDB_Backend):
         population_id = core.bayesdb_generator_population(bdb, generator_id)
         stattype = core.bayesdb_variable_stattype(
             bdb, population_id, generator_id, colno)
-        if _is_nominal(stattype):
-            return _impute_nominal(sample)
-        else:
-            return _impute_numerical(sample)
+        return _impute(stattype, sample)
+
+    def predict_confidence_many(
+            self, bdb, generator_id, modelnos, queries, numsamples=None):
+        if not numsamples:
+            numsamples = 2
+        assert numsamples > 0
+
+        # Predict from the posterior predictive in closed form where
+        # possible.
+        predictions = self._predict_exact(bdb, generator_id, modelnos, queries)
+        sampled = [i for i, prediction in enumerate(predictions)
+            if prediction is None]
+        if not sampled:
+            return predictions
+
+        # Retrieve the samples for all other queries at once.
+        samples = self.simulate_joint_many(
+            bdb, generator_id, modelnos,
+            [(queries[i][0], [queries[i][1]], []) for i in sampled],
+            num_samples=numsamples)
+
+        # Impute each cell by the mode or mean of its samples.
+        population_id = core.bayesdb_generator_population(bdb, generator_id)
+        for i, sample in zip(sampled, samples):
+            _rowid, colno = queries[i]
+            stattype = core.bayesdb_variable_stattype(
+                bdb, population_id, generator_id, colno)
+            predictions[i] = _impute(stattype, sample)
+        return predictions
+
+    def _predict_exact(self, bdb, generator_id, modelnos, queries):
+        # Predict each cell (rowid, colno) of `queries` from its posterior
+        # predictive, a mixture over the states of the predictive of the
+        # row's cluster, in closed form: the mode of a nominal variable,
+        # with its probability as confidence, or the mean of a numerical
+        # variable, with as confidence the fraction of the variance of the
+        # variable's observed values explained by the predictive,
+        # 1 - var(predictive)/var(observed), clipped to [0, 1].  Return None
+        # for cells which cannot be: of rows not incorporated, whose clusters
+        # depend on their values, or of variables not modelled by the same
+        # conjugate primitive in every state, e.g. by a foreign cgpm.
+        predictions = [None] * len(queries)
+        if not queries:
+            return predictions
+        cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
+        engine = self._engine(bdb, generator_id, cgpm_modelnos)
+        statenos = cgpm_modelnos
+        if statenos is None:
+            statenos = range(engine.num_states())
+        states = [engine.states[stateno] for stateno in statenos]
+        population_id = core.bayesdb_generator_population(bdb, generator_id)
+        row_clusters = self._row_clusters(bdb, generator_id, engine)
+        codebook = self._codebook(bdb, generator_id)
+
+        def cctype(colno):
+            cctypes = set(
+                state.views[state.Zv(colno)].dims[colno].cctype
+                if colno in state.Zv() else None
+                for state in states
+            )
+            return cctypes.pop() if len(cctypes) == 1 else None
+
+        # Sort the cells by how to predict them.
+        nominal = []
+        numerical = []
+        cctypes = {}
+        for i, (rowid, colno) in enumerate(queries):
+            cgpm_rowid = row_clusters['cgpm_rowids'].get(rowid, -1)
+            if cgpm_rowid == -1:
+                continue
+            if colno not in cctypes:
+                cctypes[colno] = cctype(colno)
+            stattype = core.bayesdb_variable_stattype(
+                bdb, population_id, generator_id, colno)
+            if _is_nominal(stattype):
+                if cctypes[colno] != 'categorical' \
+                        or not len(codebook['values'].get(colno, ())):
+                    continue
+                value = states[0].X[colno][cgpm_rowid]
+                if not math.isnan(value):
+                    predictions[i] = (
+                        codebook['values'][colno][int(value)], 1.)
+                else:
+                    nominal.append((i, cgpm_rowid, colno))
+            elif cctypes[colno] in _PREDICTIVE_MOMENTS:
+                value = states[0].X[colno][cgpm_rowid]
+                if not math.isnan(value):
+                    predictions[i] = (value, 1.)
+                else:
+                    numerical.append((i, cgpm_rowid, colno))
+
+        # Probability of each category of a nominal variable, averaged over
+        # the states, all at once.
+        if nominal:
+            rowids = []
+            targets_list = []
+            for _i, cgpm_rowid, colno in nominal:
+                for code in xrange(len(codebook['values'][colno])):
+                    rowids.append(cgpm_rowid)
+                    targets_list.append({colno: code})
+            logpdfs = self._evaluate(bdb, generator_id, engine, cgpm_modelnos,
+                'logpdf_bulk',
+                rowids=rowids,
+                targets_list=targets_list,
+                constraints_list=[{} for _rowid in rowids],
+            )
+            probabilities = numpy.exp(numpy.array(logpdfs)).mean(axis=0)
+            start = 0
+            for i, _cgpm_rowid, colno in nominal:
+                values = codebook['values'][colno]
+                p = probabilities[start:start + len(values)]
+                start += len(values)
+                mode = numpy.argmax(p)
+                predictions[i] = (values[mode], float(p[mode] / numpy.sum(p)))
+
+        # Mean and variance of the mixture over the states of the predictive
+        # of the row's cluster.
+        variances = {}
+        for i, cgpm_rowid, colno in numerical:
+            if colno not in variances:
+                variances[colno] = numpy.nanvar(states[0].X[colno])
+            means = []
+            second_moments = []
+            for stateno, state in zip(statenos, states):
+                view = state.Zv(colno)
+                Zr = row_clusters['Zr'].get((stateno, view))
+                if Zr is None:
+                    Zr = _row_partition(state.views[view].Zr())
+                    row_clusters['Zr'][stateno, view] = Zr
+                cluster = state.views[view].dims[colno].clusters[
+                    int(Zr[cgpm_rowid])]
+                mean, variance = _PREDICTIVE_MOMENTS[cctypes[colno]](
+                    cluster.get_hypers(), cluster.get_suffstats())
+                means.append(mean)
+                second_moments.append(variance + mean**2)
+            mean = sum(means) / len(means)
+            variance = sum(second_moments) / len(second_moments) - mean**2
+            if math.isinf(variance) or not variances[colno] > 0:
+                confidence = 0.
+            else:
+                confidence = min(1., max(0.,
+                    1. - variance / float(variances[colno])))
+            predictions[i] = (mean, confidence)
+
+        return predictions
 
     def simulate_joint(
             self, bdb, generator_id, modelnos, rowid, targets, constraints,
@@ -857,73 +1501,235 @@ class CGPM_Backend(BayesDB_Backend):
         cgpm_rowid = self._cgpm_rowid(bdb, generator_id, rowid)
         cgpm_targets = targets
         cgpm_constraints = {}
+        to_numeric = self._to_numeric_batch(bdb, generator_id)
         for colno, value in full_constraints:
-            value_numeric = self._to_numeric(bdb, generator_id, colno, value)
+            value_numeric = to_numeric(colno, value)
             if not math.isnan(value_numeric):
                 cgpm_constraints.update({colno: value_numeric})
         # Retrieve the engine.
-        engine = self._engine(bdb, generator_id)
-        samples = engine.simulate(
+        engine = self._engine(bdb, generator_id, cgpm_modelnos)
+        samples = self._evaluate(bdb, generator_id, engine, cgpm_modelnos,
+            'simulate',
             rowid=cgpm_rowid,
             targets=cgpm_targets,
             constraints=cgpm_constraints,
             inputs=None,
             N=num_samples,
             accuracy=accuracy,
-            statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess
-        )
-        weighted_samples = engine._likelihood_weighted_resample(
-            samples=samples,
-            rowid=cgpm_rowid,
-            constraints=cgpm_constraints,
-            inputs=None,
-            statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess
         )
-        def map_value(colno, value):
-            return self._from_numeric(bdb, generator_id, colno, value)
-        return [
-            [map_value(colno, row[colno]) for colno in cgpm_targets]
+        weighted_samples = _sub_engine(engine, cgpm_modelnos) \
+            ._likelihood_weighted_resample(
+                samples=samples,
+                rowid=cgpm_rowid,
+                constraints=cgpm_constraints,
+                inputs=None,
+                multiprocess=self._multiprocess
+            )
+        return self._from_numeric_rows(bdb, generator_id, cgpm_targets, [
+            [row[colno] for colno in cgpm_targets]
             for row in weighted_samples
-        ]
+        ])
 
     def logpdf_joint(
             self, bdb, generator_id, modelnos, rowid, targets, constraints):
         cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
         cgpm_rowid = self._cgpm_rowid(bdb, generator_id, rowid)
-        # TODO: Handle nan values in the logpdf query.
-        cgpm_targets = {
-            colno: self._to_numeric(bdb, generator_id, colno, value)
-            for colno, value in targets
-        }
+        to_numeric = self._to_numeric_batch(bdb, generator_id)
+        # Build the query, ignoring nan values, which are marginalized out:
+        # with none left, the density of nothing is 1.
+        cgpm_targets = {}
+        for colno, value in targets:
+            value_numeric = to_numeric(colno, value)
+            if not math.isnan(value_numeric):
+                cgpm_targets[colno] = value_numeric
+        if not cgpm_targets:
+            return 0
         # Build the evidence, ignoring nan values.
         cgpm_constraints = {}
         for colno, value in constraints:
-            value_numeric = self._to_numeric(bdb, generator_id, colno, value)
+            value_numeric = to_numeric(colno, value)
             if not math.isnan(value_numeric):
                 cgpm_constraints.update({colno: value_numeric})
         # Retrieve the engine.
-        engine = self._engine(bdb, generator_id)
-        logpdfs = engine.logpdf(
+        engine = self._engine(bdb, generator_id, cgpm_modelnos)
+        logpdfs = self._evaluate(bdb, generator_id, engine, cgpm_modelnos,
+            'logpdf',
             rowid=cgpm_rowid,
             targets=cgpm_targets,
             constraints=cgpm_constraints,
             inputs=None,
             accuracy=None,
-            statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess
-        )
-        return engine._likelihood_weighted_integrate(
-            logpdfs=logpdfs,
-            rowid=cgpm_rowid,
-            constraints=cgpm_constraints,
-            inputs=None,
-            statenos=cgpm_modelnos,
-            multiprocess=self._multiprocess,
         )
+        return _sub_engine(engine, cgpm_modelnos) \
+            ._likelihood_weighted_integrate(
+                logpdfs=logpdfs,
+                rowid=cgpm_rowid,
+                constraints=cgpm_constraints,
+                inputs=None,
+                multiprocess=self._multiprocess,
+            )
 
-    def json_ready_models(self, bdb, population_id, generator_id):
+    def simulate_joint_many(
+            self, bdb, generator_id, modelnos, queries, num_samples=None,
+            accuracy=None):
+        if num_samples is None:
+            num_samples = 1
+        # The bulk simulator of cgpm has no notion of accuracy.
+        if accuracy is not None:
+            return super(CGPM_Backend, self).simulate_joint_many(
+                bdb, generator_id, modelnos, queries, num_samples=num_samples,
+                accuracy=accuracy)
+        if not queries:
+            return []
+        cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
+        # Prepare the rowids, queries, and evidence for cgpm.
+        rowids = [rowid for rowid, _targets, _constraints in queries]
+        table_constraints = self._retrieve_table_constraints_many(
+            bdb, generator_id, rowids)
+        cgpm_rowids = self._cgpm_rowids(bdb, generator_id, rowids)
+        to_numeric = self._to_numeric_batch(bdb, generator_id)
+        cgpm_targets_list = [targets for _rowid, targets, _c in queries]
+        cgpm_constraints_list = []
+        for rowid, targets, constraints in queries:
+            full_constraints = self._merge_user_table_constraints(
+                bdb, generator_id, rowid, targets, constraints,
+                table_constraints=table_constraints.get(rowid, []))
+            cgpm_constraints = {}
+            for colno, value in full_constraints:
+                value_numeric = to_numeric(colno, value)
+                if not math.isnan(value_numeric):
+                    cgpm_constraints[colno] = value_numeric
+            cgpm_constraints_list.append(cgpm_constraints)
+        # Retrieve the engine.
+        engine = self._engine(bdb, generator_id, cgpm_modelnos)
+        samples = self._evaluate(bdb, generator_id, engine, cgpm_modelnos,
+            'simulate_bulk',
+            rowids=cgpm_rowids,
+            targets_list=cgpm_targets_list,
+            constraints_list=cgpm_constraints_list,
+            Ns=[num_samples] * len(queries),
+        )
+        # Resample from the states in proportion to the likelihood of the
+        # constraints.
+        weights = self._likelihood_weights(bdb, generator_id,
+            engine, cgpm_rowids, cgpm_constraints_list, cgpm_modelnos)
+        codebook = self._codebook(bdb, generator_id)
+        results = []
+        for i, targets in enumerate(cgpm_targets_list):
+            p = numpy.exp(weights[i] - numpy.max(weights[i]))
+            draws = bdb.np_prng.choice(len(p), size=num_samples, p=p/sum(p))
+            results.append(self._from_numeric_rows(
+                bdb, generator_id, targets, [
+                    [samples[s][i][k][colno] for colno in targets]
+                    for k, s in enumerate(draws)
+                ], codebook))
+        return results
+
+    def logpdf_joint_many(self, bdb, generator_id, modelnos, queries):
+        if not queries:
+            return []
+        cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
+        cgpm_rowids = self._cgpm_rowids(
+            bdb, generator_id, [rowid for rowid, _t, _c in queries])
+        to_numeric = self._to_numeric_batch(bdb, generator_id)
+        # Build the queries and the evidence, ignoring nan values, as in
+        # logpdf_joint.
+        def numeric(assignments):
+            cgpm_assignments = {}
+            for colno, value in assignments:
+                value_numeric = to_numeric(colno, value)
+                if not math.isnan(value_numeric):
+                    cgpm_assignments[colno] = value_numeric
+            return cgpm_assignments
+        cgpm_targets_list = [
+            numeric(targets) for _rowid, targets, _constraints in queries
+        ]
+        cgpm_constraints_list = [
+            numeric(constraints) for _rowid, _targets, constraints in queries
+        ]
+        # Queries with no targets left have density 1; evaluate the rest.
+        targeted = [
+            i for i, cgpm_targets in enumerate(cgpm_targets_list)
+            if cgpm_targets
+        ]
+        results = [0] * len(queries)
+        if not targeted:
+            return results
+        cgpm_rowids = [cgpm_rowids[i] for i in targeted]
+        cgpm_targets_list = [cgpm_targets_list[i] for i in targeted]
+        cgpm_constraints_list = [cgpm_constraints_list[i] for i in targeted]
+        # Retrieve the engine.
+        engine = self._engine(bdb, generator_id, cgpm_modelnos)
+        logpdfs = self._evaluate(bdb, generator_id, engine, cgpm_modelnos,
+            'logpdf_bulk',
+            rowids=cgpm_rowids,
+            targets_list=cgpm_targets_list,
+            constraints_list=cgpm_constraints_list,
+        )
+        # Integrate over the states, weighted by the likelihood of the
+        # constraints.
+        weights = self._likelihood_weights(bdb, generator_id,
+            engine, cgpm_rowids, cgpm_constraints_list, cgpm_modelnos)
+        for j, i in enumerate(targeted):
+            results[i] = logavgexp_weighted(
+                list(weights[j]), [logpdfs_s[j] for logpdfs_s in logpdfs])
+        return results
+
+    def _likelihood_weights(self, bdb, generator_id, engine, cgpm_rowids,
+            cgpm_constraints_list, cgpm_modelnos):
+        # Log likelihood of the constraints of each query in each state, all
+        # zero for a query with no constraints.
+        num_states = engine.num_states() if cgpm_modelnos is None \
+            else len(cgpm_modelnos)
+        weights = numpy.zeros((len(cgpm_rowids), num_states))
+        constrained = [
+            i for i, constraints in enumerate(cgpm_constraints_list)
+            if constraints
+        ]
+        if constrained:
+            logpdfs = self._evaluate(bdb, generator_id, engine,
+                cgpm_modelnos, 'logpdf_bulk',
+                rowids=[cgpm_rowids[i] for i in constrained],
+                targets_list=[cgpm_constraints_list[i] for i in constrained],
+                constraints_list=[{} for _i in constrained],
+            )
+            for s, logpdfs_s in enumerate(logpdfs):
+                weights[constrained, s] = logpdfs_s
+        return weights
+
+    def json_ready_models(self, bdb, population_id, generator_id,
+            modelnos=None, variables=None):
+        header, models = self._json_ready(
+            bdb, population_id, generator_id, modelnos, variables)
+        header['models'] = list(models)
+        return header
+
+    def write_json_models(self, bdb, population_id, generator_id, f,
+            modelnos=None, variables=None):
+        """Write the JSON text of :meth:`json_ready_models` to `f`.
+
+        The models are written one at a time, and states not in the
+        cache are read one at a time and not kept, so only one model
+        need be in memory at once.  `modelnos` and `variables`, if not
+        None, restrict the output to those models and variables.
+        """
+        header, models = self._json_ready(
+            bdb, population_id, generator_id, modelnos, variables)
+        # Keys in the sorted order of json_dumps, with models last.
+        f.write('{')
+        for key in sorted(header):
+            f.write('%s: %s, ' % (json_dumps(key), json_dumps(header[key])))
+        f.write('"models": [')
+        for i, model in enumerate(models):
+            if i:
+                f.write(', ')
+            f.write(json_dumps(model))
+        f.write(']}')
+
+    def _json_ready(self, bdb, population_id, generator_id, modelnos,
+            variables):
+        # Return the dict of json_ready_models without its models, and an
+        # iterator over the models.
         stattypes = {
             name: stattype for (name, stattype) in
             bdb.sql_execute('''
@@ -932,29 +1738,60 @@ class CGPM_Backend(BayesDB_Backend):
                 AND population_id = ?
             ''', (generator_id, population_id))
         }
-        categories = self._json_ready_categories(
-            bdb, population_id, generator_id, stattypes)
 
         # Dict mapping colno to variable name
         name_map = core.bayesdb_colno_to_variable_names(
             bdb, population_id, generator_id)
-        states = self._engine(bdb, generator_id).states
-        model_blobs = [self._json_ready_model(s, name_map) for s in states]
+        if variables is not None:
+            colnos = set()
+            for var in variables:
+                if not core.bayesdb_has_variable(
+                        bdb, population_id, generator_id, var):
+                    raise BQLError(bdb, 'No such variable: %r' % (var,))
+                colnos.add(core.bayesdb_variable_number(
+                    bdb, population_id, generator_id, var))
+            name_map = {
+                colno: name for colno, name in name_map.iteritems()
+                if colno in colnos
+            }
+            names = set(name_map.itervalues())
+            stattypes = {
+                name: stattype for name, stattype in stattypes.iteritems()
+                if name in names
+            }
+        categories = self._json_ready_categories(
+            bdb, generator_id, name_map, stattypes)
+
+        statenos = self._get_modelnos(bdb, generator_id, modelnos)
+        if statenos is None:
+            cursor = bdb.sql_execute('''
+                SELECT cgpm_modelno FROM bayesdb_cgpm_state
+                    WHERE generator_id = ?
+            ''', (generator_id,))
+            statenos = [stateno for (stateno,) in cursor]
+            if not statenos:
+                generator = core.bayesdb_generator_name(bdb, generator_id)
+                raise BQLError(bdb, 'No models initialized for generator: %r'
+                    % (generator,))
+        models = (
+            self._json_ready_model(state, name_map)
+            for state in self._iter_states(bdb, generator_id, sorted(statenos))
+        )
         return {
             "column-statistical-types": stattypes,
             "categories": categories,
-            "models": model_blobs
-        }
+        }, models
 
     def _json_ready_model(self, state, name_map):
-        # Obtain sorted view indexes.
-        view_indices = sorted(state.views.keys())
+        # Obtain sorted indexes of the views of the variables in `name_map`.
         # state.Zv() is a column partition given as {col_num : view_num, ...}
+        Zv = state.Zv()
+        view_indices = sorted(set(Zv[colno] for colno in name_map))
         column_partition = [
             [
                 name_map[colno]
-                for colno, current_view_index in state.Zv().iteritems()
-                if current_view_index == view_index
+                for colno in sorted(name_map)
+                if Zv[colno] == view_index
             ]
             for view_index in view_indices
         ]
@@ -964,21 +1801,12 @@ class CGPM_Backend(BayesDB_Backend):
         # so that clusters_for_views[i][j] contains the row indexes
         # in the j-th cluster of the i-th view.
         clusters_for_views = [
-            [
-                sorted([
-                    rowid
-                    for (rowid, current_cluster_index)
-                        in state.views[view_index].Zr().iteritems()
-                    if current_cluster_index == cluster_index
-                ])
-                for cluster_index
-                    in sorted(set(state.views[view_index].Zr().itervalues()))
-            ]
+            _cluster_members(state.views[view_index].Zr())
             for view_index in view_indices
         ]
         # Each column has a dict of hyperparameters.
         column_hypers = {
-            name : state.views[state.Zv()[colno]].dims[colno].hypers
+            name : state.views[Zv[colno]].dims[colno].hypers
             for (colno, name) in name_map.iteritems()
         }
         # Return dump-able blob.
@@ -989,30 +1817,57 @@ class CGPM_Backend(BayesDB_Backend):
             "column-hypers": column_hypers
         }
 
-    def _json_ready_categories(self, bdb, population_id, generator_id, stattypes):
-        name_map_all = core.bayesdb_colno_to_variable_names(
-            bdb, population_id, generator_id)
-        name_map = {
-            k : v for k, v in name_map_all.iteritems()
-            if stattypes[v] == 'nominal'
+    def _json_ready_categories(self, bdb, generator_id, name_map, stattypes):
+        # All categories for all categorical variables in `name_map`, in
+        # order of code.
+        categories = {
+            colno: [] for colno, name in name_map.iteritems()
+            if stattypes[name] == 'nominal'
         }
-        # All categories for all categorical variables
-        raw_categories = sorted(bdb.sql_execute('''
-            SELECT colno, code, value FROM bayesdb_cgpm_category
+        cursor = bdb.sql_execute('''
+            SELECT colno, value FROM bayesdb_cgpm_category
             WHERE generator_id = ?
-            ''', (generator_id,)))
+            ORDER BY colno, code
+            ''', (generator_id,))
+        for colno, value in cursor:
+            if colno in categories:
+                categories[colno].append(value)
         # Collate categories by variable
         return {
-            name : [item[2] for item in raw_categories if item[0] == colno]
-            for colno, name in name_map.iteritems()
+            name_map[colno]: values
+            for colno, values in categories.iteritems()
         }
 
+    def _iter_states(self, bdb, generator_id, statenos):
+        # Yield the states numbered `statenos`, from the cached engine if
+        # it holds them as last written, and otherwise deserialized one at
+        # a time and not kept.
+        engine = self._engine_latest(bdb, generator_id)
+        loaded = {}
+        if engine is not None:
+            loaded = self._get_cache_entry(bdb, generator_id, 'state_stamps')
+        metadata = None
+        for stateno in statenos:
+            if stateno in loaded:
+                yield engine.states[stateno]
+                continue
+            if metadata is None:
+                metadata = self._read_metadata(bdb, generator_id)
+            yield self._read_engine(bdb, generator_id, [stateno],
+                bdb.np_prng, metadata).states[0]
+
     def _unique_rowid(self, rowids):
         if len(set(rowids)) != 1:
             raise ValueError('Multiple-row query: %r' % (list(set(rowids)),))
         return rowids[0]
 
-    def _data(self, bdb, generator_id, vars):
+    def _data(self, bdb, generator_id, vars, cgpm_rowid_min=0):
+        # Return the data of the variables `vars` for the incorporated rows,
+        # or those numbered from `cgpm_rowid_min`, in order of cgpm rowid,
+        # as an array of floats with codes for nominal values and NaN for
+        # missing values.  Row i is the row numbered cgpm_rowid_min + i,
+        # which is not in order of table rowid once rows incorporated later
+        # skipped rows which had no values yet.
         # Get the column numbers.
         population_id = core.bayesdb_generator_population(bdb, generator_id)
         colnos = [
@@ -1033,17 +1888,26 @@ class CGPM_Backend(BayesDB_Backend):
         cursor = bdb.sql_execute('''
             SELECT %s FROM %s AS t, bayesdb_cgpm_individual AS ci
                 WHERE ci.generator_id = ?
+                    AND ci.cgpm_rowid >= ?
                     AND ci.table_rowid = t._rowid_
-            ORDER BY t._rowid_ ASC
-        ''' % (qexpressions, qt), (generator_id,))
-
-        # Map values to codes.
-        def map_value(colno, value):
-            return self._to_numeric(bdb, generator_id, colno, value)
-        return [
-            tuple(map_value(colno, x) for colno, x in zip(colnos, row))
-            for row in cursor
-        ]
+            ORDER BY ci.cgpm_rowid ASC
+        ''' % (qexpressions, qt), (generator_id, cgpm_rowid_min))
+
+        # Map values to codes, a column of a chunk of rows at a time.
+        codebook = self._codebook(bdb, generator_id)
+        chunks = []
+        while True:
+            rows = cursor.fetchmany(_DATA_CHUNK)
+            if not rows:
+                break
+            chunk = numpy.empty((len(rows), len(colnos)))
+            for i, (colno, column) in enumerate(zip(colnos, zip(*rows))):
+                chunk[:, i] = self._to_numeric_column(
+                    bdb, generator_id, colno, column, codebook)
+            chunks.append(chunk)
+        if not chunks:
+            return numpy.empty((0, len(colnos)))
+        return numpy.concatenate(chunks)
 
     def _initialize_engine(self, bdb, generator_id, n, variables):
         population_id = core.bayesdb_generator_population(bdb, generator_id)
@@ -1065,10 +1929,10 @@ class CGPM_Backend(BayesDB_Backend):
             gpmcc_data = self._data(bdb, generator_id, gpmcc_vars)
             # If gpmcc_data has any column which is all null, then crash early
             # and notify the user of all offending column names.
-            n_rows = len(gpmcc_data)
             nulls = [
-                v for i, v in enumerate(gpmcc_vars)
-                if all(math.isnan(gpmcc_data[r][i]) for r in xrange(n_rows))
+                v for v, null in
+                zip(gpmcc_vars, numpy.isnan(gpmcc_data).all(axis=0))
+                if null
             ]
             if nulls:
                 raise BQLError(bdb, 'Failed to initialize, '
@@ -1095,7 +1959,10 @@ class CGPM_Backend(BayesDB_Backend):
         cgpm_vars = cgpm_ext['outputs'] + cgpm_ext['inputs']
         cgpm_data = self._data(bdb, generator_id, cgpm_vars)
         cgpm = cls(outputs, inputs, rng=bdb.np_prng, *args, **kwds)
-        for cgpm_rowid, row in enumerate(cgpm_data):
+        cgpm_present = ~numpy.isnan(cgpm_data)
+        n = len(outputs)
+        for cgpm_rowid, (row, present) in \
+                enumerate(zip(cgpm_data.tolist(), cgpm_present.tolist())):
             # CGPMs do not uniformly handle null values or missing
             # values sensibly yet, so until we have that sorted
             # out we both (a) omit nulls and (b) ignore errors in
@@ -1103,13 +1970,12 @@ class CGPM_Backend(BayesDB_Backend):
             obs_values = {
                 colno: row[i]
                 for i, colno in enumerate(outputs)
-                if not math.isnan(row[i])
+                if present[i]
             }
-            n = len(outputs)
             input_values = {
                 colno: row[n + i]
                 for i, colno in enumerate(inputs)
-                if not math.isnan(row[n + i])
+                if present[n + i]
             }
             try:
                 cgpm.incorporate(cgpm_rowid, obs_values, input_values)
@@ -1141,38 +2007,113 @@ class CGPM_Backend(BayesDB_Backend):
 
         return schema
 
-    def _engine(self, bdb, generator_id):
-        # Retrieve the cache.
+    def _engine(self, bdb, generator_id, cgpm_modelnos=None):
+        # Return the engine with the states numbered `cgpm_modelnos`, or all
+        # states if None, loaded.  States not asked for may be None.
 
         # Probe the cache.
         cached_engine = self._engine_latest(bdb, generator_id)
         if cached_engine is not None:
-            return cached_engine
-
-        # Not cached or mismatched stamps. Load the engine from the database.
+            loaded = self._get_cache_entry(bdb, generator_id, 'state_stamps')
+            statenos = cgpm_modelnos
+            if statenos is None:
+                statenos = range(cached_engine.num_states())
+            if all(stateno in loaded for stateno in statenos):
+                self._cache.hit()
+                return cached_engine
+
+        with self._cache.miss():
+            return self._load_engine(bdb, generator_id, cgpm_modelnos)
+
+    def _load_engine(self, bdb, generator_id, cgpm_modelnos):
+        # Not cached, mismatched stamps, or missing states.  Keep the cached
+        # states which are still the latest on disk, and load the rest.
+        engine = self._get_cache_entry(bdb, generator_id, 'engine')
+        loaded = self._get_cache_entry(bdb, generator_id, 'state_stamps')
+        engine_stamp = self._engine_stamp(bdb, generator_id)
         cursor = bdb.sql_execute('''
-            SELECT engine_json, engine_stamp FROM bayesdb_cgpm_generator
+            SELECT cgpm_modelno, state_stamp FROM bayesdb_cgpm_state
                 WHERE generator_id = ?
-        ''', (generator_id,)).fetchall()
-        engine_json, engine_stamp = cursor[0]
+        ''', (generator_id,))
+        state_stamps = dict(cursor)
 
         # Check if the generator has an initialized engine.
-        if not engine_json:
+        if not state_stamps:
             generator = core.bayesdb_generator_name(bdb, generator_id)
             raise BQLError(bdb, 'No models initialized for generator: %r'
                 % (generator,))
 
-        # Deserialize the engine.
-        engine = Engine.from_metadata(
-            json.loads(engine_json), rng=bdb.np_prng,
-            multiprocess=self._multiprocess)
-
-        # Cache the engine with its stamp.
-        self._set_cache_entry(bdb, generator_id, 'engine', engine)
+        num_states = len(state_stamps)
+        statenos = cgpm_modelnos
+        if statenos is None:
+            statenos = range(num_states)
+        fresh = {}
+        if engine is not None:
+            fresh = {
+                stateno: state_stamp
+                for stateno, state_stamp in loaded.iteritems()
+                if state_stamps.get(stateno) == state_stamp
+            }
+        missing = sorted(set(statenos) - set(fresh))
+        states = [None] * num_states
+        for stateno in fresh:
+            states[stateno] = engine.states[stateno]
+
+        # Deserialize the missing states, with the data they share.
+        if missing:
+            missing_engine = self._read_engine(
+                bdb, generator_id, missing, bdb.np_prng)
+            for stateno, state in zip(missing, missing_engine.states):
+                states[stateno] = state
+                fresh[stateno] = state_stamps[stateno]
+            if engine is None:
+                engine = missing_engine
+        engine.states = states
+        self._share_data(bdb, generator_id, engine)
+
+        # Cache the engine with its stamps.
+        self._set_cache_entry(bdb, generator_id, 'engine', engine,
+            _engine_bytes(engine))
         self._set_cache_entry(bdb, generator_id, 'stamp', engine_stamp)
+        self._set_cache_entry(bdb, generator_id, 'state_stamps', fresh)
 
         return engine
 
+    def _read_engine(self, bdb, generator_id, statenos, rng,
+            metadata=None):
+        # Deserialize a new engine with the states numbered `statenos`, in
+        # that order, and the data they share, drawing from `rng`.  The
+        # metadata they share may be given, if already read.
+        if metadata is None:
+            metadata = self._read_metadata(bdb, generator_id)
+        metadata = dict(metadata)
+        cursor = bdb.sql_execute('''
+            SELECT cgpm_modelno, state_json FROM bayesdb_cgpm_state
+                WHERE generator_id = ? AND cgpm_modelno IN (%s)
+        ''' % (','.join(map(str, statenos)),), (generator_id,))
+        states_json = dict(cursor)
+        metadata['states'] = [
+            _loads(states_json[stateno]) for stateno in statenos
+        ]
+        return Engine.from_metadata(
+            metadata, rng=rng, multiprocess=self._multiprocess)
+
+    def _read_metadata(self, bdb, generator_id):
+        # Deserialize the data and other metadata the states share.
+        cursor = bdb.sql_execute('''
+            SELECT engine_json FROM bayesdb_cgpm_generator
+                WHERE generator_id = ?
+        ''', (generator_id,))
+        return _loads(cursor_value(cursor))
+
+    def _state_stamps(self, bdb, generator_id, statenos):
+        # Stamps of the states numbered `statenos` as last written.
+        cursor = bdb.sql_execute('''
+            SELECT cgpm_modelno, state_stamp FROM bayesdb_cgpm_state
+                WHERE generator_id = ? AND cgpm_modelno IN (%s)
+        ''' % (','.join(map(str, statenos)),), (generator_id,))
+        return dict(cursor)
+
     def _engine_latest(self, bdb, generator_id):
         # Check whether there is a cached_engine.
         cached_engine = self._get_cache_entry(bdb, generator_id, 'engine')
@@ -1196,145 +2137,437 @@ class CGPM_Backend(BayesDB_Backend):
         ''', (generator_id,))
         return cursor_value(cursor)
 
-    def _serialize_engine(self, bdb, generator_id, engine, cache):
-        # Write the engine to JSON.
-        engine_json = json_dumps(engine.to_metadata())
+    def _serialize_engine(self, bdb, generator_id, engine, cache,
+            cgpm_modelnos=None, shared=False):
+        # Write the states numbered `cgpm_modelnos`, or all states if None,
+        # and, if `shared`, the data and other metadata the states share.
+        statenos = cgpm_modelnos
+        if statenos is None:
+            statenos = range(engine.num_states())
+        statenos = sorted(statenos)
+        metadata = _engine_metadata(engine, statenos)
+        states = metadata['states']
+        metadata['states'] = []
+        engine_stamp_new = self._write_states(bdb, generator_id, statenos,
+            [self._dumps(state) for state in states],
+            self._dumps(metadata) if shared else None)
+
+        # Add it to the cache, with one copy of the data its states share.
+        if cache:
+            self._share_data(bdb, generator_id, engine)
+            state_stamps = {}
+            if self._get_cache_entry(bdb, generator_id, 'engine') is engine:
+                state_stamps.update(self._get_cache_entry(
+                    bdb, generator_id, 'state_stamps'))
+            state_stamps.update(
+                (stateno, engine_stamp_new) for stateno in statenos)
+            self._set_cache_entry(bdb, generator_id, 'engine', engine,
+                _engine_bytes(engine))
+            self._set_cache_entry(bdb, generator_id, 'stamp', engine_stamp_new)
+            self._set_cache_entry(
+                bdb, generator_id, 'state_stamps', state_stamps)
+            # Send the new versions of the states to the workers which
+            # hold them.
+            if self._pool is not None:
+                self._pool.push(engine, statenos, state_stamps)
+
+    def _share_data(self, bdb, generator_id, engine):
+        # Make the states of the engine share one copy of their data, kept
+        # for the generator so that states transitioned in other processes
+        # or deserialized again come back to it.
+        shared = self._get_cache_entry(bdb, generator_id, 'data')
+        shared = share_data(engine.states, shared)
+        self._set_cache_entry(bdb, generator_id, 'data', shared,
+            _data_bytes(shared))
+
+    def _write_states(self, bdb, generator_id, statenos, states_serialized,
+            metadata_serialized=None):
+        # Write the serialized states numbered `statenos`, and the shared
+        # metadata if not None, under a new engine stamp, and return it.
 
         # Increment the stamp.
         engine_stamp_old = self._engine_stamp(bdb, generator_id)
         engine_stamp_new = engine_stamp_old + 1
 
         # Update the engine and stamp.
-        bdb.sql_execute('''
-            UPDATE bayesdb_cgpm_generator
-                SET engine_json = :engine_json,
-                    engine_stamp = :engine_stamp
-                WHERE generator_id = :generator_id
-        ''', {
-            'engine_json': engine_json,
-            'engine_stamp': engine_stamp_new,
-            'generator_id': generator_id,
-        })
-
-        # Add it to the cache.
-        if cache:
-            self._set_cache_entry(bdb, generator_id, 'engine', engine)
-            self._set_cache_entry(bdb, generator_id, 'stamp', engine_stamp_new)
-
-
-    def _retrieve_cache(self, bdb,):
-        if bdb in self._cache:
-            return self._cache[bdb]
-        self._cache[bdb] = dict()
-        return self._cache[bdb]
+        if metadata_serialized is not None:
+            bdb.sql_execute('''
+                UPDATE bayesdb_cgpm_generator
+                    SET engine_json = :engine_json,
+                        engine_stamp = :engine_stamp
+                    WHERE generator_id = :generator_id
+            ''', {
+                'engine_json': metadata_serialized,
+                'engine_stamp': engine_stamp_new,
+                'generator_id': generator_id,
+            })
+        else:
+            bdb.sql_execute('''
+                UPDATE bayesdb_cgpm_generator SET engine_stamp = ?
+                    WHERE generator_id = ?
+            ''', (engine_stamp_new, generator_id))
+        for stateno, state_serialized in zip(statenos, states_serialized):
+            bdb.sql_execute('''
+                INSERT OR REPLACE INTO bayesdb_cgpm_state
+                    (generator_id, cgpm_modelno, state_json, state_stamp)
+                    VALUES (?, ?, ?, ?)
+            ''', (generator_id, stateno, state_serialized,
+                engine_stamp_new))
+        return engine_stamp_new
+
+    def _evaluate(self, bdb, generator_id, engine, cgpm_modelnos, method,
+            *args, **kwargs):
+        # Call `method` of each state numbered `cgpm_modelnos`, or of all
+        # states if None, with `args` and `kwargs`, and return the list of
+        # results.  When multiprocessing, and the cost model expects it to
+        # be faster, evaluate the states of the cached engine in parallel in
+        # the pool of workers where they are resident.  Otherwise evaluate
+        # them in process.  Either way each state is first reseeded from
+        # bdb, alike, so that the choice does not change the results.
+        statenos = cgpm_modelnos
+        if statenos is None:
+            statenos = range(engine.num_states())
+        seeds = bdb.np_prng.randint(2**31 - 1, size=len(statenos)).tolist()
+        units = len(statenos) * _evaluation_units(method, kwargs)
+        parallel = bool(self._multiprocess) and \
+            self._costs.choose(method, len(statenos), units)
+        start = time.time()
+        results, parallel = self._evaluate_states(bdb, generator_id, engine,
+            statenos, seeds, parallel, method, args, kwargs)
+        self._costs.record(method, parallel, len(statenos), units,
+            time.time() - start)
+        return results
+
+    def _evaluate_states(self, bdb, generator_id, engine, statenos, seeds,
+            parallel, method, args, kwargs):
+        # Return the results, and whether they were evaluated in parallel.
+        state_stamps = self._get_cache_entry(bdb, generator_id, 'state_stamps')
+        if parallel and state_stamps is not None \
+                and self._get_cache_entry(bdb, generator_id, 'engine') \
+                    is engine \
+                and all(stateno in state_stamps for stateno in statenos):
+            if self._pool is None:
+                self._pool = StatePool()
+            try:
+                return self._pool.map(engine, statenos, state_stamps,
+                    method, args, kwargs, seeds), True
+            except (EOFError, IOError, OSError):
+                # A worker died.  The pool has been closed; start afresh
+                # next time, and evaluate in process this time.
+                self._pool = None
+        results = []
+        for stateno, seed in zip(statenos, seeds):
+            state = engine.states[stateno]
+            state.rng.seed(seed)
+            results.append(getattr(state, method)(*args, **kwargs))
+        return results, False
+
+    def _dumps(self, metadata):
+        if self._engine_format == 'json':
+            return json_dumps(metadata)
+        compress = self._engine_format == 'zlib'
+        return buffer(cgpm_serialize.dumps(metadata, compress))
+
+    def _split_engines(self, bdb):
+        # Move each state of each engine stored whole into its own row.
+        cursor = bdb.sql_execute('''
+            SELECT generator_id, engine_json, engine_stamp
+                FROM bayesdb_cgpm_generator
+                WHERE engine_json IS NOT NULL
+        ''').fetchall()
+        for generator_id, engine_json, engine_stamp in cursor:
+            metadata = _loads(engine_json)
+            for stateno, state in enumerate(metadata['states']):
+                bdb.sql_execute('''
+                    INSERT INTO bayesdb_cgpm_state
+                        (generator_id, cgpm_modelno, state_json, state_stamp)
+                        VALUES (?, ?, ?, ?)
+                ''', (generator_id, stateno, self._dumps(state),
+                    engine_stamp))
+            metadata['states'] = []
+            bdb.sql_execute('''
+                UPDATE bayesdb_cgpm_generator SET engine_json = ?
+                    WHERE generator_id = ?
+            ''', (self._dumps(metadata), generator_id))
 
-    def _set_cache_entry(self, bdb, generator_id, key, value):
-        cache = self._retrieve_cache(bdb)
-        if generator_id not in cache:
-            cache[generator_id] = dict()
-        cache[generator_id][key] = value
+    def _set_cache_entry(self, bdb, generator_id, key, value, size=None):
+        self._cache.set(bdb, generator_id, key, value, size)
 
     def _get_cache_entry(self, bdb, generator_id, key):
         # Returns None if the generator_id or key do not exist.
-        cache = self._retrieve_cache(bdb)
-        if generator_id not in cache:
-            return None
-        if key not in cache[generator_id]:
-            return None
-        return cache[generator_id][key]
+        return self._cache.get(bdb, generator_id, key)
 
     def _del_cache_entry(self, bdb, generator_id, key):
         # If key is None, wipes bdb[generator_id] in its entirety.
-        cache = self._retrieve_cache(bdb)
-        if generator_id in cache:
-            if key is None:
-                del cache[generator_id]
-            elif key in cache[generator_id]:
-                del cache[generator_id][key]
+        self._cache.delete(bdb, generator_id, key)
+
+    def _row_clusters(self, bdb, generator_id, engine):
+        # Row partitions of the views of each state, as arrays indexed by
+        # cgpm rowid, and the map from table rowids to cgpm rowids, cached
+        # for as long as the engine is unchanged.  The engine is analyzed in
+        # place, so check the stamp as well as the engine itself.
+        stamp = self._get_cache_entry(bdb, generator_id, 'stamp')
+        row_clusters = self._get_cache_entry(bdb, generator_id, 'row_clusters')
+        if row_clusters is not None and row_clusters['engine'] is engine \
+                and row_clusters['stamp'] == stamp:
+            return row_clusters
+        row_clusters = {
+            'engine': engine,
+            'stamp': stamp,
+            'cgpm_rowids': self._rowid_map(bdb, generator_id)['cgpm_rowids'],
+            'Zr': {},
+        }
+        # The map of rowids is charged to the rowid map.  Charge the row
+        # partitions, filled in as they are asked for, at the size they grow
+        # to: an array item for each row of each view of each loaded state.
+        num_views = sum(
+            len(state.views) for state in engine.states if state is not None)
+        size = numpy.dtype(int).itemsize \
+            * (len(row_clusters['cgpm_rowids']) + 1) * num_views
+        self._set_cache_entry(
+            bdb, generator_id, 'row_clusters', row_clusters, size)
+        return row_clusters
+
+    def _rowid_map(self, bdb, generator_id):
+        # Map from table rowids to cgpm rowids, as a dict and as arrays of
+        # the table rowids in order and their cgpm rowids.  It is cached:
+        # bayesdb_cgpm_individual is written only when the generator is
+        # created, and appended to when new rows are incorporated, which
+        # bumps the engine stamp as written, by this client or another.  So
+        # when that stamp has changed, check for new rows by the largest
+        # cgpm rowid.
+        stamp = self._engine_stamp(bdb, generator_id)
+        rowid_map = self._get_cache_entry(bdb, generator_id, 'rowid_map')
+        if rowid_map is not None and rowid_map['stamp'] == stamp:
+            return rowid_map
+        cursor = bdb.sql_execute('''
+            SELECT MAX(cgpm_rowid) FROM bayesdb_cgpm_individual
+                WHERE generator_id = ?
+        ''', (generator_id,))
+        cgpm_rowid_max = cursor_value(cursor)
+        if rowid_map is not None and \
+                rowid_map['cgpm_rowid_max'] == cgpm_rowid_max:
+            rowid_map['stamp'] = stamp
+            return rowid_map
+        cursor = bdb.sql_execute('''
+            SELECT table_rowid, cgpm_rowid FROM bayesdb_cgpm_individual
+                WHERE generator_id = ?
+                ORDER BY table_rowid ASC
+        ''', (generator_id,))
+        rows = cursor.fetchall()
+        rowid_map = {
+            'stamp': stamp,
+            'cgpm_rowid_max': cgpm_rowid_max,
+            'cgpm_rowids': dict(rows),
+            'table_rowids_sorted':
+                numpy.array([r for r, _c in rows], dtype=numpy.int64),
+            'cgpm_rowids_sorted':
+                numpy.array([c for _r, c in rows], dtype=numpy.int64),
+        }
+        # Roughly: a dict entry with its two ints, and two array items.
+        size = 128 * len(rows)
+        self._set_cache_entry(bdb, generator_id, 'rowid_map', rowid_map, size)
+        return rowid_map
 
     def _cgpm_rowid(self, bdb, generator_id, table_rowid, nullok=True):
+        cgpm_rowids = self._rowid_map(bdb, generator_id)['cgpm_rowids']
+        cgpm_rowid = cgpm_rowids.get(table_rowid)
+        if cgpm_rowid is None:
+            if not nullok:
+                raise ValueError('Row not incorporated: %r' % (table_rowid,))
+            return -1
+        return cgpm_rowid
+
+    def _cgpm_rowids(self, bdb, generator_id, table_rowids):
+        # Map many table rowids at once, -1 for those not incorporated.
+        rowid_map = self._rowid_map(bdb, generator_id)
+        sorted_rowids = rowid_map['table_rowids_sorted']
+        if len(table_rowids) == 0 or len(sorted_rowids) == 0:
+            return [-1] * len(table_rowids)
+        table_rowids = numpy.asarray(table_rowids, dtype=numpy.int64)
+        index = numpy.searchsorted(sorted_rowids, table_rowids)
+        index[index == len(sorted_rowids)] = 0
+        found = sorted_rowids[index] == table_rowids
+        cgpm_rowids = numpy.where(
+            found, rowid_map['cgpm_rowids_sorted'][index], -1)
+        return cgpm_rowids.tolist()
+
+    def _codebook(self, bdb, generator_id):
+        # Codes of the categories of the nominal variables, by value and, in
+        # an array indexed by code, the value of each code, cached for as
+        # long as there are as many categories.  Categories are only ever
+        # added, by creating the generator or adding a variable to it, so
+        # their number tells whether another client has added any; ours
+        # invalidates the codebook directly when it adds them.  Analysis,
+        # which changes no categories, leaves it valid.
+        cursor = bdb.sql_execute('''
+            SELECT COUNT(*) FROM bayesdb_cgpm_category WHERE generator_id = ?
+        ''', (generator_id,))
+        num_categories = cursor_value(cursor)
+        codebook = self._get_cache_entry(bdb, generator_id, 'codebook')
+        if codebook is not None \
+                and codebook['num_categories'] == num_categories:
+            return codebook
         cursor = bdb.sql_execute('''
-            SELECT cgpm_rowid FROM bayesdb_cgpm_individual
-                WHERE generator_id = ? AND table_rowid = ?
-        ''', (generator_id, table_rowid))
-        cgpm_rowid = cursor_value(cursor, nullok=nullok)
-        return cgpm_rowid if cgpm_rowid is not None else -1
+            SELECT colno, value, code FROM bayesdb_cgpm_category
+                WHERE generator_id = ?
+        ''', (generator_id,))
+        codes = defaultdict(dict)
+        size = 0
+        for colno, value, code in cursor:
+            codes[colno][value] = code
+            size += len(value) + 64
+        values = {}
+        for colno, codes_colno in codes.iteritems():
+            values[colno] = numpy.empty(
+                max(codes_colno.itervalues()) + 1, dtype=object)
+            for value, code in codes_colno.iteritems():
+                values[colno][code] = value
+        codebook = {
+            'num_categories': num_categories,
+            'codes': dict(codes),
+            'values': values,
+        }
+        self._set_cache_entry(bdb, generator_id, 'codebook', codebook, size)
+        return codebook
+
+    def _to_numeric_batch(self, bdb, generator_id):
+        # _to_numeric, with the codebook fetched once for a batch.
+        codebook = self._codebook(bdb, generator_id)
+        def to_numeric(colno, value):
+            return self._to_numeric_column(
+                bdb, generator_id, colno, [value], codebook)[0]
+        return to_numeric
 
     def _to_numeric(self, bdb, generator_id, colno, value):
         """Convert value in bayeslite to equivalent cgpm format."""
-        if value is None:
-            return float('NaN')
+        return self._to_numeric_column(bdb, generator_id, colno, [value])[0]
+
+    def _from_numeric(self, bdb, generator_id, colno, value):
+        """Convert value in cgpm to equivalent bayeslite format."""
+        return self._from_numeric_column(bdb, generator_id, colno, [value])[0]
+
+    def _to_numeric_column(self, bdb, generator_id, colno, values,
+            codebook=None):
+        """Convert values of a column in bayeslite to cgpm format."""
+        nan = float('NaN')
         # XXX Latent variables are not associated with an entry in
         # bayesdb_cgpm_category, so just pass through whatever value
         # the user supplied, as a float.
         if colno < 0:
-            return float(value)
+            return [nan if value is None else float(value) for value in values]
         population_id = core.bayesdb_generator_population(bdb, generator_id)
         stattype = core.bayesdb_variable_stattype(
             bdb, population_id, generator_id, colno)
-        if _is_nominal(stattype):
-            cursor = bdb.sql_execute('''
-                SELECT code FROM bayesdb_cgpm_category
-                    WHERE generator_id = ? AND colno = ? AND value = ?
-            ''', (generator_id, colno, value))
-            integer = cursor_value(cursor, nullok=True)
-            if integer is None:
-                return float('NaN')
-                # raise BQLError('Invalid category: %r' % (value,))
-            return integer
-        else:
-            return value
-
-    def _from_numeric(self, bdb, generator_id, colno, value):
-        """Convert value in cgpm to equivalent bayeslite format."""
-        if math.isnan(value):
-            return None
+        if not _is_nominal(stattype):
+            return [nan if value is None else value for value in values]
+        if codebook is None:
+            codebook = self._codebook(bdb, generator_id)
+        codes = codebook['codes'].get(colno, {})
+        fallback = {}
+        numeric = []
+        for value in values:
+            if value is None:
+                numeric.append(nan)
+                continue
+            key = _category_key(value)
+            code = codes.get(key)
+            if code is None and not isinstance(key, unicode):
+                # Leave SQLite to decide which text a real number or blob
+                # compares equal to.
+                if key not in fallback:
+                    cursor = bdb.sql_execute('''
+                        SELECT code FROM bayesdb_cgpm_category
+                            WHERE generator_id = ? AND colno = ? AND value = ?
+                    ''', (generator_id, colno, value))
+                    fallback[key] = cursor_value(cursor, nullok=True)
+                code = fallback[key]
+            # XXX Unknown categories are missing, rather than an error.
+            numeric.append(nan if code is None else code)
+        return numeric
+
+    def _from_numeric_column(self, bdb, generator_id, colno, values,
+            codebook=None):
+        """Convert values of a column in cgpm to bayeslite format."""
         population_id = core.bayesdb_generator_population(bdb, generator_id)
         stattype = core.bayesdb_variable_stattype(
             bdb, population_id, generator_id, colno)
-        if _is_nominal(stattype):
-            # XXX Latent variables are not associated with an entry in
-            # bayesdb_cgpm_category, so just pass through whatever value cgpm
-            # returns as a string.
-            if colno < 0:
-                return str(value)
-            cursor = bdb.sql_execute('''
-                SELECT value FROM bayesdb_cgpm_category
-                    WHERE generator_id = ? AND colno = ? AND code = ?
-            ''', (generator_id, colno, value))
-            text = cursor_value(cursor, nullok=True)
-            if text is None:
-                raise BQLError('Invalid category: %r' % (value,))
-            return text
-        else:
-            return value
+        if not _is_nominal(stattype):
+            return [None if math.isnan(value) else value for value in values]
+        # XXX Latent variables are not associated with an entry in
+        # bayesdb_cgpm_category, so just pass through whatever value cgpm
+        # returns as a string.
+        if colno < 0:
+            return [None if math.isnan(value) else str(value)
+                for value in values]
+        if codebook is None:
+            codebook = self._codebook(bdb, generator_id)
+        lookup = codebook['values'].get(colno)
+        if lookup is None:
+            lookup = numpy.empty(0, dtype=object)
+        numeric = numpy.asarray(values, dtype=float)
+        present = ~numpy.isnan(numeric)
+        codes = numeric[present]
+        valid = (codes == numpy.floor(codes)) & (0 <= codes) \
+            & (codes < len(lookup))
+        text = numpy.empty(len(numeric), dtype=object)
+        if valid.all():
+            text[present] = lookup[codes.astype(int)]
+            valid = numpy.array(
+                [value is not None for value in text[present]], dtype=bool)
+        if not valid.all():
+            raise BQLError(bdb, 'Invalid category: %r' % (
+                codes[~valid][0],))
+        return text.tolist()
+
+    def _from_numeric_rows(self, bdb, generator_id, colnos, rows,
+            codebook=None):
+        """Convert rows of values of columns `colnos` in cgpm to bayeslite.
+
+        Each column is converted in bulk.
+        """
+        if not rows:
+            return []
+        if codebook is None:
+            codebook = self._codebook(bdb, generator_id)
+        columns = [
+            self._from_numeric_column(
+                bdb, generator_id, colno, column, codebook)
+            for colno, column in zip(colnos, zip(*rows))
+        ]
+        return [list(row) for row in zip(*columns)]
 
     def _retrieve_baseline_variables(self, bdb, generator_id):
         # XXX Store this data in the bdb.
-        engine = self._engine(bdb, generator_id)
+        engine = self._engine(bdb, generator_id, [0])
         return engine.states[0].outputs
 
     def _retrieve_foreign_variables(self, bdb, generator_id):
         # XXX Store this data in the bdb.
-        engine = self._engine(bdb, generator_id)
+        engine = self._engine(bdb, generator_id, [0])
         return list(itertools.chain.from_iterable([
             cgpm.outputs for cgpm in engine.states[0].hooked_cgpms.itervalues()
         ]))
 
     def _merge_user_table_constraints(
-            self, bdb, generator_id, rowid, targets, constraints):
+            self, bdb, generator_id, rowid, targets, constraints,
+            table_constraints=None):
         """Returns user specified constraints combined with values from table.
 
         Variables in `targets` will not be in the returned constraints, even
         if they exist in the base table. Howeer, any `targets` which eixst in
         the user specified `constraints` will remain there, and probably result
         in an error by cgpm.
+
+        `table_constraints`, if given, are the values from the table already
+        retrieved by `_retrieve_table_constraints_many`.
         """
         # Handle `None` constraints.
         constraints = constraints or []
         # Retrieve table constraints.
-        table_constraints = self._retrieve_table_constraints(
-            bdb, generator_id, rowid)
+        if table_constraints is None:
+            table_constraints = self._retrieve_table_constraints(
+                bdb, generator_id, rowid)
         # Verify user constraints do not intersect table constraints.
         if table_constraints and constraints:
             user_cols = set(c[0] for c in constraints)
@@ -1362,21 +2595,19 @@ class CGPM_Backend(BayesDB_Backend):
         # INSERT INTO or SUBSAMPLE), then retrieve all values for rowid as the
         # constraints. Note that we do not need to populate constraints if the
         # rowid is already observed, which is done by cgpm.
+        # Is the rowid incorporated into the cgpm?  Usually it is, and we
+        # need not ask the base table.
+        if self._cgpm_rowid(bdb, generator_id, rowid) != -1:
+            return []
         table = core.bayesdb_generator_table(bdb, generator_id)
         qt = sqlite3_quote_name(table)
         # Does the rowid exist in the base table?
         exists = bdb.sql_execute('''
             SELECT 1 FROM %s WHERE oid = ?
         ''' % (qt,), (rowid,)).fetchall()
-        # Is the rowid incorporated into the cgpm?
-        incorporated = bdb.sql_execute('''
-            SELECT 1 FROM bayesdb_cgpm_individual
-            WHERE generator_id = ? AND table_rowid = ?
-            LIMIT 1
-        ''', (generator_id, rowid,)).fetchall()
         # Populate values if necessary.
         table_constraints = []
-        if exists and (not incorporated):
+        if exists:
             population_id = core.bayesdb_generator_population(bdb, generator_id)
             row_values = core.bayesdb_population_row_values(
                 bdb, population_id, rowid)
@@ -1389,6 +2620,46 @@ class CGPM_Backend(BayesDB_Backend):
             ]
         return table_constraints
 
+    def _retrieve_table_constraints_many(self, bdb, generator_id, rowids):
+        """Return table constraints of many rowids, as a dict by rowid.
+
+        Rowids with no table constraints are omitted.
+        """
+        table = core.bayesdb_generator_table(bdb, generator_id)
+        qt = sqlite3_quote_name(table)
+        # Find the rowids which are not incorporated into the cgpm but exist
+        # in the base table.
+        rowids_unique = sorted(set(rowids))
+        rowids_unique = [
+            rowid for rowid, cgpm_rowid in
+            zip(rowids_unique,
+                self._cgpm_rowids(bdb, generator_id, rowids_unique))
+            if cgpm_rowid == -1
+        ]
+        hypothetical = []
+        for i in xrange(0, len(rowids_unique), _SQL_CHUNK):
+            chunk = ','.join(
+                str(int(rowid)) for rowid in rowids_unique[i:i + _SQL_CHUNK])
+            cursor = bdb.sql_execute('''
+                SELECT oid FROM %s WHERE oid IN (%s)
+            ''' % (qt, chunk))
+            hypothetical.extend(rowid for (rowid,) in cursor)
+        # Populate values for those.
+        table_constraints = {}
+        if hypothetical:
+            population_id = core.bayesdb_generator_population(bdb, generator_id)
+            variable_numbers = core.bayesdb_variable_numbers(
+                bdb, population_id, None)
+            for rowid in hypothetical:
+                row_values = core.bayesdb_population_row_values(
+                    bdb, population_id, rowid)
+                table_constraints[rowid] = [
+                    (varno, val)
+                    for varno, val in zip(variable_numbers, row_values)
+                    if val is not None
+                ]
+        return table_constraints
+
     def _get_modelnos(self, bdb, generator_id, modelnos):
         if modelnos is None:
             return modelnos
@@ -1464,6 +2735,202 @@ class CGPM_Backend(BayesDB_Backend):
         return kernels
 
 
+def _impute(stattype, sample):
+    # Impute the mode of a sample of a nominal variable, with the frequency of
+    # the mode as confidence, or the mean of a sample of a numerical variable.
+    if _is_nominal(stattype):
+        counts = Counter(s[0] for s in sample)
+        mode_count = max(counts[v] for v in counts)
+        pred = iter(v for v in counts if counts[v] == mode_count).next()
+        conf = float(mode_count) / len(sample)
+        return pred, conf
+    else:
+        pred = sum(s[0] for s in sample) / float(len(sample))
+        conf = 0 # XXX Punt confidence for now
+        return pred, conf
+
+def _normal_predictive_moments(hypers, suffstats):
+    # Student t, as in cgpm.primitives.normal: the posterior hyperparameters,
+    # then the mean and variance, infinite for two degrees of freedom or less.
+    r, m, s, nu = hypers['r'], hypers['m'], hypers['s'], hypers['nu']
+    N, sum_x, sum_x_sq = \
+        suffstats['N'], suffstats['sum_x'], suffstats['sum_x_sq']
+    rn = r + float(N)
+    nun = nu + float(N)
+    mn = (r * m + sum_x) / rn
+    sn = s + sum_x_sq + r * m * m - rn * mn * mn
+    if sn == 0:
+        sn = s
+    if nun <= 2:
+        return mn, float('inf')
+    return mn, sn * (rn + 1) / (rn * (nun - 2))
+
+def _poisson_predictive_moments(hypers, suffstats):
+    # Negative binomial, from the gamma posterior of the rate.
+    an = hypers['a'] + float(suffstats['sum_x'])
+    bn = hypers['b'] + float(suffstats['N'])
+    return an / bn, an * (bn + 1) / (bn * bn)
+
+# Mean and variance of the posterior predictive of a cluster of a conjugate
+# primitive, from its hyperparameters and sufficient statistics.
+_PREDICTIVE_MOMENTS = {
+    'normal': _normal_predictive_moments,
+    'poisson': _poisson_predictive_moments,
+}
+
+def _category_key(value):
+    # The text stored in bayesdb_cgpm_category for a category `value`, if
+    # it is text or an integer, else `value` itself.  Integers are stored
+    # as their decimal text, by the TEXT affinity of the value column.
+    if isinstance(value, (bool, int, long)):
+        return unicode(int(value))
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value
+    return value
+
+def _loads(engine_json):
+    # Engines and states are stored in the binary format of cgpm_serialize,
+    # or as JSON text by older versions of bayeslite.
+    if cgpm_serialize.is_binary(engine_json):
+        return cgpm_serialize.loads(engine_json)
+    return json.loads(engine_json)
+
+@contextlib.contextmanager
+def _numbering(bdb):
+    # Yield the quoted name of a temporary table of values, each inserted
+    # value numbered consecutively from 1 while it is not emptied.
+    qnt = sqlite3_quote_name(bdb.temp_table_name())
+    bdb.sql_execute('''
+        CREATE TEMP TABLE %s (number INTEGER PRIMARY KEY, value)
+    ''' % (qnt,))
+    try:
+        yield qnt
+    finally:
+        bdb.sql_execute('DROP TABLE %s' % (qnt,))
+
+def _sql_in_ranges(column, numbers):
+    # SQL condition that `column` is one of the integers `numbers`, as a
+    # range for each run of consecutive numbers.
+    numbers = sorted(set(numbers))
+    ranges = []
+    for number in numbers:
+        if ranges and ranges[-1][1] + 1 == number:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return '(%s)' % (' OR '.join(
+        '%s = %d' % (column, lo) if lo == hi else
+            '%s BETWEEN %d AND %d' % (column, lo, hi)
+        for lo, hi in ranges),)
+
+def _sql_count_below(column, numbers):
+    # SQL expression counting the integers `numbers` below `column`.
+    return '(%s)' % (' + '.join(
+        '(%d < %s)' % (number, column) for number in sorted(set(numbers))),)
+
+def _engine_metadata(engine, statenos):
+    # Metadata of `engine` with only the states numbered `statenos`.
+    states = engine.states
+    engine.states = [states[stateno] for stateno in statenos]
+    try:
+        return engine.to_metadata()
+    finally:
+        engine.states = states
+
+def _sub_engine(engine, statenos):
+    # The engine of the states numbered `statenos`, or `engine` itself if
+    # None, to hand to cgpm: some Engine methods touch every state of the
+    # engine, even given statenos, and states not loaded are None.  It
+    # shares the states with `engine`; put back any its methods replace
+    # with _put_states.
+    if statenos is None:
+        return engine
+    sub_engine = copy.copy(engine)
+    sub_engine.states = [engine.states[stateno] for stateno in statenos]
+    return sub_engine
+
+def _put_states(engine, sub_engine, statenos):
+    # Put the states of an engine from _sub_engine back into `engine`.
+    if sub_engine is not engine:
+        for stateno, state in zip(statenos, sub_engine.states):
+            engine.states[stateno] = state
+
+def _evaluation_units(method, kwargs):
+    # Work to evaluate `method` of a state with keyword arguments `kwargs`,
+    # in units roughly proportional to its time: one per target variable
+    # per sample.
+    if method == 'simulate':
+        return kwargs['N'] * len(kwargs['targets'])
+    elif method == 'logpdf':
+        return len(kwargs['targets'])
+    elif method == 'simulate_bulk':
+        return sum(N * len(targets) for N, targets in
+            zip(kwargs['Ns'], kwargs['targets_list']))
+    elif method == 'logpdf_bulk':
+        return sum(len(targets) for targets in kwargs['targets_list'])
+    else:
+        return 1
+
+def _loaded_state(engine):
+    # Any state of `engine` which is loaded.  All states model the same
+    # variables.
+    return next(state for state in engine.states if state is not None)
+
+def _cluster_members(Zr):
+    # Convert a row partition {row_num : cluster_num, ...} into the lists of
+    # row numbers in each cluster, in order of cluster number, each in
+    # order of row number.
+    if not Zr:
+        return []
+    rows = numpy.fromiter(Zr.iterkeys(), dtype=int, count=len(Zr))
+    clusters = numpy.fromiter(Zr.itervalues(), dtype=int, count=len(Zr))
+    order = numpy.lexsort((rows, clusters))
+    rows = rows[order]
+    _, starts = numpy.unique(clusters[order], return_index=True)
+    return [members.tolist() for members in numpy.split(rows, starts[1:])]
+
+# Rough sizes in memory, in bytes, of the parts of what is cached for a
+# generator: a number in a list of data, an entry of a dict keyed by row,
+# as in the row partition of a view, and a cluster of a primitive, with its
+# hyperparameters and sufficient statistics.
+_ITEM_BYTES = 32
+_ROW_BYTES = 128
+_CLUSTER_BYTES = 1024
+
+def _engine_bytes(engine):
+    # Estimate the size in memory of the loaded states of `engine`: the row
+    # partition of each view, the clusters of each variable, and the data of
+    # states holding their own, with foreign cgpms.  The data the others
+    # share is charged to the generator's 'data' entry.
+    size = 0
+    for state in engine.states:
+        if state is None:
+            continue
+        for view in state.views.itervalues():
+            size += _ROW_BYTES * len(view.Zr())
+            for dim in view.dims.itervalues():
+                size += _CLUSTER_BYTES * len(dim.clusters)
+        if state.hooked_cgpms:
+            size += _data_bytes(state.X)
+    return size
+
+def _data_bytes(data):
+    # Estimate the size in memory of columns of data, lists by colno.
+    return _ITEM_BYTES * sum(len(values) for values in data.itervalues())
+
+def _row_partition(Zr):
+    # Convert a row partition {row_num : cluster_num, ...} into an array of
+    # cluster numbers indexed by row number, with -1 for missing rows.  The
+    # last entry is always -1, so that it can be indexed by the -1 we use for
+    # rows which are not incorporated.
+    partition = numpy.empty(max(Zr) + 2 if Zr else 1, dtype=int)
+    partition.fill(-1)
+    partition[Zr.keys()] = Zr.values()
+    return partition
+
 def _create_schema(bdb, generator_id, schema_ast):
     # Get some parameters.
     population_id = core.bayesdb_generator_population(bdb, generator_id)
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Pool of worker processes keeping CGPM states resident.
+
+Asking a cgpm engine to evaluate its states in parallel forks worker
+processes and pickles every state to them on every call.  A StatePool
+instead keeps long-lived workers, each holding the states it has been
+sent, keyed by the engine they belong to and their number in it, and
+versioned by a stamp.  A state is sent to its worker only when the
+worker does not already hold it at the current stamp, so a query on
+unchanged states sends only its arguments and receives only its
+results.
+
+Each worker evaluates its states one after another; states are spread
+over the workers by number.  The states of an engine are dropped from
+the workers once the engine is garbage collected.
+
+The states of an engine all model the same data.  In process, they are
+made to share one copy of each column of it with :func:`share_data`.
+Workers receive the states without that data, and the data itself once
+per engine, and again only if its values change, through a read-only
+memory-mapped file which all the workers, and all the states resident
+in them, reference.
+
+A CostModel decides, call by call, whether parallel evaluation is
+worth its overhead, from the size of the call and the times of past
+calls.
+"""
+
+import itertools
+import multiprocessing
+import numpy
+import os
+import tempfile
+import traceback
+import weakref
+
+class StatePool(object):
+    """Pool of `processes` workers evaluating resident CGPM states.
+
+    Workers are started on first use.  If `processes` is None, use one
+    per CPU.
+    """
+
+    def __init__(self, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self._processes = processes
+        self._workers = None
+        # (token, stateno) -> stamp of the copy resident in its worker
+        self._resident = {}
+        # engine -> token identifying it to the workers
+        self._tokens = weakref.WeakKeyDictionary()
+        # token -> weak reference to the engine, to drop its states
+        self._refs = {}
+        # token -> {colno: values} of the data the workers hold for it
+        self._data = {}
+        self._counter = itertools.count()
+
+    def map(self, engine, statenos, stamps, method, args, kwargs, seeds):
+        """Evaluate a method on states of an engine in the workers.
+
+        For each state numbered in `statenos`, reseed its random number
+        generator with the corresponding entry of `seeds`, and call its
+        method named `method` with positional `args` and keyword
+        `kwargs`.  `stamps` maps each state number to the stamp of the
+        current version of the state.  Return the list of results in the
+        order of `statenos`.
+        """
+        self._start()
+        token = self._token(engine)
+        self._load(token, engine, statenos, stamps)
+        calls = [[] for _worker in self._workers]
+        for i, (stateno, seed) in enumerate(zip(statenos, seeds)):
+            calls[self._worker(stateno)].append((i, (token, stateno), seed))
+        try:
+            for (_process, conn), worker_calls in zip(self._workers, calls):
+                if worker_calls:
+                    conn.send(('call',
+                        [(key, seed) for _i, key, seed in worker_calls],
+                        method, args, kwargs))
+            results = [None] * len(statenos)
+            error = None
+            for (_process, conn), worker_calls in zip(self._workers, calls):
+                if not worker_calls:
+                    continue
+                status, value = conn.recv()
+                if status == 'error':
+                    error = error or value
+                    continue
+                for (i, _key, _seed), result in zip(worker_calls, value):
+                    results[i] = result
+        except (EOFError, IOError, OSError):
+            self.close()
+            raise
+        if error is not None:
+            raise error
+        return results
+
+    def push(self, engine, statenos, stamps):
+        """Send the states numbered `statenos` to the workers if stale.
+
+        Does nothing if the workers have not been started.
+        """
+        if self._workers is None:
+            return
+        self._load(self._token(engine), engine, statenos, stamps)
+
+    def close(self):
+        """Stop the workers and forget the states they held."""
+        workers = self._workers
+        self._workers = None
+        self._resident.clear()
+        self._data.clear()
+        if workers is None:
+            return
+        for process, conn in workers:
+            try:
+                conn.send(('close',))
+            except (IOError, OSError):
+                pass
+            conn.close()
+        for process, _conn in workers:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+    def _start(self):
+        if self._workers is not None:
+            return
+        workers = []
+        for _i in xrange(self._processes):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_serve, args=(child_conn,))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            workers.append((process, conn))
+        self._workers = workers
+
+    def _worker(self, stateno):
+        return stateno % len(self._workers)
+
+    def _token(self, engine):
+        token = self._tokens.get(engine)
+        if token is None:
+            token = next(self._counter)
+            self._tokens[engine] = token
+            self._refs[token] = weakref.ref(
+                engine, lambda _ref: self._drop(token))
+        return token
+
+    def _load(self, token, engine, statenos, stamps):
+        try:
+            stale = [stateno for stateno in statenos
+                if self._resident.get((token, stateno)) != stamps[stateno]]
+            if not stale:
+                return
+            shared = share_data(engine.states, self._data.get(token))
+            self._send_data(token, shared)
+            for stateno in stale:
+                key = (token, stateno)
+                _process, conn = self._workers[self._worker(stateno)]
+                _send_state(conn, key, engine.states[stateno], shared)
+                self._resident[key] = stamps[stateno]
+        except (EOFError, IOError, OSError):
+            self.close()
+            raise
+
+    def _send_data(self, token, shared):
+        # Give the workers the data shared by the states of an engine,
+        # unless they already hold the same values.  Write it to a file
+        # they map, and remove the file once they all have: the mappings
+        # outlive it.
+        if not shared:
+            return
+        data = self._data.get(token)
+        if data is not None and sorted(data) == sorted(shared) \
+                and all(_same_values(data[colno], shared[colno])
+                    for colno in shared):
+            self._data[token] = dict(shared)
+            return
+        self._data[token] = dict(shared)
+        colnos = sorted(shared)
+        fd, path = tempfile.mkstemp(prefix='bayeslite-cgpm-', suffix='.npy')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, numpy.array(
+                    [shared[colno] for colno in colnos], dtype=float))
+            for _process, conn in self._workers:
+                conn.send(('data', token, path, colnos))
+            error = None
+            for _process, conn in self._workers:
+                status, value = conn.recv()
+                if status == 'error':
+                    error = error or value
+        finally:
+            os.unlink(path)
+        if error is not None:
+            del self._data[token]
+            raise error
+
+    def _drop(self, token):
+        del self._refs[token]
+        self._data.pop(token, None)
+        keys = [key for key in self._resident if key[0] == token]
+        for key in keys:
+            del self._resident[key]
+        if self._workers is None or not keys:
+            return
+        for _process, conn in self._workers:
+            try:
+                conn.send(('drop', token))
+            except (IOError, OSError):
+                pass
+
+def share_data(states, shared=None):
+    """Make `states` share one copy of each column of data they hold.
+
+    The states of an engine all model the same data, but each one
+    deserialized or transitioned holds its own copy of it.  Columns are
+    shared by states without foreign cgpms, which may alter them; None,
+    for states not loaded, are skipped.  Return a dictionary mapping
+    the number of each column shared to the list of its values.
+
+    `shared`, if given, is such a dictionary returned before: columns
+    still holding the same values are shared as the lists in it, so
+    that states transitioned elsewhere, e.g. in other processes, come
+    back to the one copy already held.
+
+    The columns are shared in place: to incorporate rows, which appends
+    to them, first give each state its own copy with
+    :func:`unshare_data`.
+    """
+    previous = shared or {}
+    shared = {}
+    for state in states:
+        if state is None or state.hooked_cgpms:
+            continue
+        for colno, values in state.X.iteritems():
+            if not isinstance(values, list):
+                continue
+            values_shared = shared.get(colno)
+            if values_shared is None:
+                values_shared = previous.get(colno)
+                if values_shared is None \
+                        or not _same_values(values, values_shared):
+                    values_shared = values
+                shared[colno] = values_shared
+            if values is not values_shared \
+                    and len(values) == len(values_shared):
+                state.X[colno] = values_shared
+    return shared
+
+def unshare_data(states):
+    """Give each of `states` its own copy of the data it holds."""
+    for state in states:
+        if state is None:
+            continue
+        for colno, values in state.X.items():
+            if isinstance(values, list):
+                state.X[colno] = list(values)
+
+def _same_values(values0, values1):
+    # True if two columns hold the same values, missing ones being NaN.
+    if values0 is values1:
+        return True
+    if len(values0) != len(values1):
+        return False
+    return all(x == y or (x != x and y != y)
+        for x, y in itertools.izip(values0, values1))
+
+def _send_state(conn, key, state, shared):
+    # Send a state to a worker without the columns of the shared data,
+    # which the worker holds already.  The state's views refer to the
+    # same dictionary of columns, so blank them in place while pickling.
+    colnos = [colno for colno, values in shared.iteritems()
+        if state.X.get(colno) is values]
+    try:
+        for colno in colnos:
+            state.X[colno] = None
+        conn.send(('load', key, state, colnos))
+    finally:
+        for colno in colnos:
+            state.X[colno] = shared[colno]
+
+def _serve(conn):
+    # Worker loop: hold the states loaded into it, and the data they
+    # share mapped read-only, and evaluate calls on them, until closed.
+    states = {}
+    data = {}
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, IOError):
+            return
+        if message[0] == 'load':
+            _op, key, state, colnos = message
+            for colno in colnos:
+                state.X[colno] = data[key[0]][colno]
+            states[key] = state
+        elif message[0] == 'data':
+            _op, token, path, colnos = message
+            try:
+                matrix = numpy.load(path, mmap_mode='r')
+                data[token] = {
+                    colno: matrix[i] for i, colno in enumerate(colnos)
+                }
+                reply = ('ok', None)
+            except Exception as e:
+                reply = ('error', e)
+            conn.send(reply)
+        elif message[0] == 'drop':
+            _op, token = message
+            data.pop(token, None)
+            for key in [key for key in states if key[0] == token]:
+                del states[key]
+        elif message[0] == 'call':
+            _op, calls, method, args, kwargs = message
+            try:
+                results = []
+                for key, seed in calls:
+                    state = states[key]
+                    state.rng.seed(seed)
+                    results.append(getattr(state, method)(*args, **kwargs))
+                reply = ('ok', results)
+            except Exception as e:
+                reply = ('error', e)
+            try:
+                conn.send(reply)
+            except Exception:
+                conn.send(('error', RuntimeError(traceback.format_exc())))
+        elif message[0] == 'close':
+            return
+
+class CostModel(object):
+    """Choose between serial and parallel evaluation of calls on states.
+
+    The cost of a call is measured in units of work, e.g. states times
+    targets times samples.  Serial evaluation is modelled as taking a
+    time per unit, and parallel evaluation as a fixed overhead plus the
+    serial time divided among up to `processes` workers, one per state.
+    Both are estimated, for each kind of call, from the times of past
+    calls.  Until a kind of call has been timed serially, it is
+    evaluated serially.
+    """
+
+    # Assumed overhead of parallel evaluation before any is measured, in
+    # seconds, and weight of each new measurement in the estimates.
+    OVERHEAD = 0.05
+    DECAY = 0.3
+
+    def __init__(self, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self._processes = processes
+        # kind -> seconds per unit of serial evaluation
+        self._per_unit = {}
+        # kind -> seconds of overhead of parallel evaluation
+        self._overhead = {}
+        # (kind, parallel) -> [calls, seconds]
+        self._history = {}
+
+    def choose(self, kind, num_states, units):
+        """Return True to evaluate in parallel, False serially."""
+        per_unit = self._per_unit.get(kind)
+        if per_unit is None or num_states < 2:
+            return False
+        serial = per_unit * units
+        parallel = self._overhead.get(kind, self.OVERHEAD) \
+            + serial / min(num_states, self._processes)
+        return parallel < serial
+
+    def record(self, kind, parallel, num_states, units, seconds):
+        """Record that a call took `seconds` to evaluate."""
+        history = self._history.setdefault((kind, parallel), [0, 0.])
+        history[0] += 1
+        history[1] += seconds
+        if units <= 0:
+            return
+        if not parallel:
+            self._per_unit[kind] = self._update(
+                self._per_unit.get(kind), seconds / units)
+        elif kind in self._per_unit:
+            speedup = min(num_states, self._processes)
+            overhead = seconds - self._per_unit[kind] * units / speedup
+            self._overhead[kind] = self._update(
+                self._overhead.get(kind), max(0., overhead))
+
+    def stats(self):
+        """Return a dictionary of the decisions made, by kind of call.
+
+        For each kind of call, ``serial`` and ``parallel`` count the
+        calls evaluated each way, ``serial_seconds`` and
+        ``parallel_seconds`` total their times, and ``per_unit`` and
+        ``overhead`` are the current estimates, or None if there are
+        none yet.
+        """
+        kinds = set(kind for kind, _parallel in self._history)
+        stats = {}
+        for kind in kinds:
+            serial = self._history.get((kind, False), [0, 0.])
+            parallel = self._history.get((kind, True), [0, 0.])
+            stats[kind] = {
+                'serial': serial[0],
+                'serial_seconds': serial[1],
+                'parallel': parallel[0],
+                'parallel_seconds': parallel[1],
+                'per_unit': self._per_unit.get(kind),
+                'overhead': self._overhead.get(kind),
+            }
+        return stats
+
+    def _update(self, estimate, measurement):
+        if estimate is None:
+            return measurement
+        return (1 - self.DECAY) * estimate + self.DECAY * measurement
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Binary serialization of CGPM engine metadata.
+
+Engine metadata is a JSON-like tree of dicts, lists, strings, and
+numbers, whose bulk is a few large lists of numbers -- the data, and
+each model's partitions of rows and columns.  Formatting and parsing
+those as JSON text dominates the time and memory it takes to save and
+load an engine.  Instead, we store every long list of numbers of one
+type, or rectangular list of such lists, as a raw typed buffer, and
+the rest of the tree as JSON with a placeholder for each array.
+
+Format version 1, with integers little-endian:
+
+    magic       8 bytes, ``MAGIC``
+    version     uint32
+    flags       uint32: ``FLAG_ZLIB`` if the chunks are compressed
+    table_len   uint64
+    tree_len    uint64
+    table       JSON list of ``[<dtype>, <shape>, <chunk lengths>]``,
+                one per array
+    tree        JSON metadata, with ``{"__array__": <i>}`` for array i
+    chunks      each array's buffer, split into chunks of at most
+                ``CHUNK_SIZE`` bytes, each compressed if ``FLAG_ZLIB``
+
+Chunks are compressed and decompressed by a pool of threads, which
+runs in parallel because zlib releases the global interpreter lock.
+"""
+
+import json
+import struct
+import zlib
+
+import numpy
+
+from multiprocessing.pool import ThreadPool
+
+from bayeslite.util import json_dumps
+
+MAGIC = 'BDBCGPM\0'
+VERSION = 1
+
+FLAG_ZLIB = 1
+
+# Maximum number of bytes of an array to compress at once.
+CHUNK_SIZE = 1 << 20
+
+# Minimum number of elements of a list to store as an array rather
+# than as JSON.
+MIN_ARRAY_SIZE = 64
+
+_HEADER = struct.Struct('<8sIIQQ')
+_ARRAY = '__array__'
+
+def is_binary(blob):
+    """True if `blob` is engine metadata serialized by :func:`dumps`."""
+    return blob is not None and str(blob[:len(MAGIC)]) == MAGIC
+
+def dumps(metadata, compress=None, threads=None):
+    """Serialize engine `metadata` to a binary string.
+
+    If `compress` is true, compress the arrays with zlib, using a pool
+    of `threads` threads, by default one per CPU.
+    """
+    arrays = []
+    tree = json_dumps(_encode(metadata, arrays))
+    chunks = []
+    table = []
+    for array in arrays:
+        data = array.tostring()
+        array_chunks = [data[i:i + CHUNK_SIZE]
+            for i in xrange(0, len(data), CHUNK_SIZE)]
+        chunks.extend(array_chunks)
+        table.append((array.dtype.str, array.shape, len(array_chunks)))
+    flags = 0
+    if compress:
+        flags |= FLAG_ZLIB
+        chunks = _parallel_map(zlib.compress, chunks, threads)
+    i = 0
+    table_json = []
+    for dtype, shape, n in table:
+        table_json.append([dtype, list(shape),
+            [len(chunk) for chunk in chunks[i:i + n]]])
+        i += n
+    table_json = json_dumps(table_json)
+    header = _HEADER.pack(MAGIC, VERSION, flags, len(table_json), len(tree))
+    return ''.join([header, table_json, tree] + chunks)
+
+def loads(blob, threads=None):
+    """Deserialize engine metadata from the binary `blob`.
+
+    Decompress the arrays, if compressed, using a pool of `threads`
+    threads, by default one per CPU.
+    """
+    blob = str(blob)
+    if len(blob) < _HEADER.size:
+        raise ValueError('Truncated engine metadata')
+    magic, version, flags, table_len, tree_len = _HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError('Not binary engine metadata')
+    if version != VERSION:
+        raise ValueError('Unknown engine metadata version: %r' % (version,))
+    offset = _HEADER.size
+    table = json.loads(blob[offset:offset + table_len])
+    offset += table_len
+    tree = blob[offset:offset + tree_len]
+    offset += tree_len
+    chunks = []
+    for _dtype, _shape, chunk_lengths in table:
+        for chunk_length in chunk_lengths:
+            chunks.append(blob[offset:offset + chunk_length])
+            offset += chunk_length
+    if offset != len(blob):
+        raise ValueError('Truncated engine metadata')
+    if flags & FLAG_ZLIB:
+        chunks = _parallel_map(zlib.decompress, chunks, threads)
+    arrays = []
+    i = 0
+    for dtype, shape, chunk_lengths in table:
+        data = ''.join(chunks[i:i + len(chunk_lengths)])
+        i += len(chunk_lengths)
+        array = numpy.frombuffer(data, dtype=numpy.dtype(str(dtype)))
+        arrays.append(array.reshape(shape).tolist())
+    def decode(obj):
+        if len(obj) == 1 and _ARRAY in obj:
+            return arrays[obj[_ARRAY]]
+        return obj
+    return json.loads(tree, object_hook=decode)
+
+def _encode(obj, arrays):
+    if isinstance(obj, dict):
+        if _ARRAY in obj:
+            raise ValueError('Reserved key in engine metadata: %r' % (_ARRAY,))
+        return {key: _encode(value, arrays) for key, value in obj.iteritems()}
+    elif isinstance(obj, (list, tuple)):
+        array = _numeric_array(obj)
+        if array is not None:
+            arrays.append(array)
+            return {_ARRAY: len(arrays) - 1}
+        return [_encode(value, arrays) for value in obj]
+    else:
+        return obj
+
+def _numeric_array(obj):
+    """Return `obj` as a numpy array, or None if that would change it.
+
+    Only lists of floats, lists of integers, and rectangular lists of
+    such lists, all of one type, are returned, so that converting the
+    array back to lists yields exactly the same values.
+    """
+    if len(obj) == 0:
+        return None
+    if isinstance(obj[0], (list, tuple)):
+        if len(set(map(len, obj))) != 1 or len(obj[0]) == 0:
+            return None
+        if not all(isinstance(row, (list, tuple)) for row in obj):
+            return None
+        types = set(type(x) for row in obj for x in row)
+    else:
+        types = set(map(type, obj))
+    if types == set([float]):
+        dtype = '<f8'
+    elif types and types <= set([int, long]):
+        dtype = '<i8'
+    else:
+        return None
+    array = numpy.array(obj, dtype=object)
+    if array.size < MIN_ARRAY_SIZE:
+        return None
+    try:
+        return array.astype(dtype)
+    except OverflowError:
+        return None
+
+def _parallel_map(f, items, threads):
+    if len(items) < 2 or threads == 1:
+        return map(f, items)
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(f, items)
+    finally:
+        pool.close()
+        pool.join()
@@ -24,6 +24,7 @@ import csv
 import gzip
 import itertools
 import json
+import numpy
 import os
 import tempfile
 
@@ -48,6 +49,7 @@ from bayeslite.core import bayesdb_variable_numbers
 from bayeslite.core import bayesdb_variable_stattype
 
 from bayeslite.backend import BayesDB_Backend
+from bayeslite.backends.cache import BackendCache
 from bayeslite.backend import bayesdb_backend_version
 
 from bayeslite.exception import BQLError
@@ -158,11 +160,10 @@ class LoomBackend(BayesDB_Backend):
         os.environ['LOOM_STORE'] = self.loom_store_path
         if not os.path.isdir(self.loom_store_path):
             os.makedirs(self.loom_store_path)
-        # The cache is a dictionary whose keys are bayeslite.BayesDB objects,
-        # and whose values are dictionaries (one cache per bdb). We need
-        # self._cache to have separate caches for each bdb because the same
+        # The cache holds separate entries for each bdb because the same
         # instance of LoomBackend may be used across multiple bdb instances.
-        self._cache = dict()
+        # Servers of generators evicted from it are closed.
+        self._cache = BackendCache(evict=self._evict_servers)
 
 
     def name(self):
@@ -223,6 +224,7 @@ class LoomBackend(BayesDB_Backend):
                 (generator_id, table_rowid, loom_rowid)
                 VALUES %s
         ''' % (insertions,))
+        self._del_cache_entry(bdb, generator_id, 'loom_rowids')
 
     def _store_encoding_info(self, bdb, generator_id):
         encoding_path = os.path.join(
@@ -548,6 +550,27 @@ class LoomBackend(BayesDB_Backend):
         ''' % (','.join(map(str, modelnos)),), (generator_id, colno0, colno1))
         return [c for (c,) in cursor]
 
+    def column_dependence_probabilities(self,
+            bdb, generator_id, modelnos, colnos):
+        if modelnos is None:
+            modelnos = range(self._get_num_models(bdb, generator_id))
+        index = {colno: i for i, colno in enumerate(colnos)}
+        kinds = {modelno: [None] * len(colnos) for modelno in modelnos}
+        cursor = bdb.sql_execute('''
+            SELECT modelno, colno, kind_id
+            FROM bayesdb_loom_column_kind_partition
+            WHERE generator_id = ?
+                AND modelno in (%s)
+        ''' % (','.join(map(str, modelnos)),), (generator_id,))
+        for modelno, colno, kind_id in cursor:
+            if colno in index:
+                kinds[modelno][index[colno]] = kind_id
+        depprobs = numpy.zeros((len(colnos), len(colnos)))
+        for modelno in modelnos:
+            kind_ids = numpy.array(kinds[modelno])
+            depprobs += kind_ids[:, numpy.newaxis] == kind_ids[numpy.newaxis, :]
+        return depprobs / len(modelnos)
+
     def _get_kind_id(self, bdb, generator_id, modelno, colno):
         """Return kind_id (view assignment) of colno in modelno."""
         cursor = bdb.sql_execute('''
@@ -864,6 +887,48 @@ class LoomBackend(BayesDB_Backend):
         conditional_score = server.score(conditional_case)
         return and_score - conditional_score
 
+    def logpdf_joint_many(self, bdb, generator_id, modelnos, queries):
+        population_id = bayesdb_generator_population(bdb, generator_id)
+        ordered_column_names = self._get_ordered_column_names(bdb, generator_id)
+        server = self._get_query_server(bdb, generator_id)
+
+        # Look up each variable name and each value's loom form once for
+        # the whole batch, and score each distinct conditional case once.
+        names = {}
+        def column_name(colno):
+            if colno not in names:
+                names[colno] = bayesdb_variable_name(
+                    bdb, population_id, None, colno)
+            return names[colno]
+        values = {}
+        def convert(colno, value):
+            if (colno, value) not in values:
+                values[colno, value] = self._convert_to_proper_stattype(
+                    bdb, generator_id, colno, value)
+            return values[colno, value]
+        conditional_scores = {}
+
+        results = []
+        for _rowid, targets, constraints in queries:
+            and_case = OrderedDict(
+                [(a, None) for a in ordered_column_names])
+            conditional_case = OrderedDict(
+                [(a, None) for a in ordered_column_names])
+            for (colno, value) in targets:
+                and_case[column_name(colno)] = convert(colno, value)
+                conditional_case[column_name(colno)] = None
+            for (colno, value) in constraints:
+                processed_value = convert(colno, value)
+                and_case[column_name(colno)] = processed_value
+                conditional_case[column_name(colno)] = processed_value
+            conditional_case = tuple(conditional_case.values())
+            if conditional_case not in conditional_scores:
+                conditional_scores[conditional_case] = server.score(
+                    list(conditional_case))
+            results.append(server.score(and_case.values())
+                - conditional_scores[conditional_case])
+        return results
+
     def _convert_to_proper_stattype(self, bdb, generator_id, colno, value):
         """Convert a value returned by the logpdf_joint method parameters into a
         form that Loom can handle. For instance, convert from an integer to
@@ -900,12 +965,25 @@ class LoomBackend(BayesDB_Backend):
 
     def _get_is_incorporated_rowid(self, bdb, generator_id, rowid):
         """Return True iff the rowid is incorporated in the loom model."""
+        return rowid in self._get_loom_rowids(bdb, generator_id)
+
+    def _get_loom_rowids(self, bdb, generator_id):
+        """Return dict mapping table rowids to loom rowids.
+
+        It is cached for the life of the generator, because the mapping
+        is written only when the generator is created.
+        """
+        loom_rowids = self._get_cache_entry(bdb, generator_id, 'loom_rowids')
+        if loom_rowids is not None:
+            return loom_rowids
         cursor = bdb.sql_execute('''
-            SELECT COUNT(*)
+            SELECT table_rowid, loom_rowid
             FROM bayesdb_loom_rowid_mapping
-            WHERE generator_id = ? AND table_rowid = ?
-        ''', (generator_id, rowid))
-        return cursor_value(cursor) > 0
+            WHERE generator_id = ?
+        ''', (generator_id,))
+        loom_rowids = dict(cursor)
+        self._set_cache_entry(bdb, generator_id, 'loom_rowids', loom_rowids)
+        return loom_rowids
 
     def _get_loom_rank(self, bdb, generator_id, colno):
         """Return the loom rank (column number) for the given colno."""
@@ -941,9 +1019,11 @@ class LoomBackend(BayesDB_Backend):
         """Return instance of loom.query.QueryServer for the Loom project."""
         server = self._get_cache_entry(bdb, generator_id, 'query_server')
         if server is not None:
+            self._cache.hit()
             return server
-        project_path = self._get_loom_project_path(bdb, generator_id)
-        server = loom.query.get_server(project_path)
+        with self._cache.miss():
+            project_path = self._get_loom_project_path(bdb, generator_id)
+            server = loom.query.get_server(project_path)
         self._set_cache_entry(bdb, generator_id, 'query_server', server)
         return server
 
@@ -960,9 +1040,11 @@ class LoomBackend(BayesDB_Backend):
         """Return instance of loom.preql.PreQL for the Loom project."""
         server = self._get_cache_entry(bdb, generator_id, 'preql_server')
         if server is not None:
+            self._cache.hit()
             return server
-        project_path = self._get_loom_project_path(bdb, generator_id)
-        server = loom.tasks.query(project_path)
+        with self._cache.miss():
+            project_path = self._get_loom_project_path(bdb, generator_id)
+            server = loom.tasks.query(project_path)
         self._set_cache_entry(bdb, generator_id, 'preql_server', server)
         return server
 
@@ -975,37 +1057,27 @@ class LoomBackend(BayesDB_Backend):
 
     # Cache management.
 
-    def _retrieve_cache(self, bdb):
-        """Fetch the cache for the given bdb object."""
-        if bdb in self._cache:
-            return self._cache[bdb]
-        self._cache[bdb] = dict()
-        return self._cache[bdb]
+    def cache_stats(self):
+        """Return statistics about the cache of query servers."""
+        return self._cache.stats()
+
+    def _evict_servers(self, generator_id, entries):
+        """Close the servers of a generator evicted from the cache."""
+        for key in ['query_server', 'preql_server']:
+            if entries.get(key) is not None:
+                entries[key].close()
 
     def _set_cache_entry(self, bdb, generator_id, key, value):
         """Set cache entry."""
-        cache = self._retrieve_cache(bdb)
-        if generator_id not in cache:
-            cache[generator_id] = dict()
-        cache[generator_id][key] = value
+        self._cache.set(bdb, generator_id, key, value)
 
     def _get_cache_entry(self, bdb, generator_id, key):
         """Return cache entry, or None if generator_id or key do not exist."""
-        cache = self._retrieve_cache(bdb)
-        if generator_id not in cache:
-            return None
-        if key not in cache[generator_id]:
-            return None
-        return cache[generator_id][key]
+        return self._cache.get(bdb, generator_id, key)
 
     def _del_cache_entry(self, bdb, generator_id, key):
         """Delete cache entry, use None to clear dict for generator_id."""
-        cache = self._retrieve_cache(bdb)
-        if generator_id in cache:
-            if key is None:
-                del cache[generator_id]
-            elif key in cache[generator_id]:
-                del cache[generator_id][key]
+        self._cache.delete(bdb, generator_id, key)
 
 def _is_nominal(stattype):
     return casefold(stattype) in ['nominal', 'unbounded_nominal']
@@ -287,6 +287,31 @@ class NIGNormalBackend(bayeslite.backend.BayesDB_Backend):
                      for colno in targets]
                     for _ in range(num_samples)]
 
+    def simulate_joint_many(
+            self, bdb, generator_id, modelnos, queries, num_samples=1,
+            accuracy=None):
+        # Note: The constraints are irrelevant for the same reason as
+        # in simulate_joint.
+        with bdb.savepoint():
+            if modelnos is None:
+                modelnos = self._modelnos(bdb, generator_id)
+            (all_mus, all_sigmas) = self._all_mus_sigmas(bdb, generator_id)
+            deviations = self._deviation_colnos(bdb, generator_id)
+            def simulate_1(mus, sigmas, colno):
+                if colno < 0:
+                    return self.prng.gauss(0, sigmas[deviations[colno]])
+                else:
+                    return self.prng.gauss(mus[colno], sigmas[colno])
+            results = []
+            for _rowid, targets, _constraints in queries:
+                modelno = self.prng.choice(modelnos)
+                mus = all_mus[modelno]
+                sigmas = all_sigmas[modelno]
+                results.append([[simulate_1(mus, sigmas, colno)
+                                 for colno in targets]
+                                for _ in range(num_samples)])
+            return results
+
     def _simulate_1(self, bdb, generator_id, mus, sigmas, colno):
         if colno < 0:
             dev_colno = colno
@@ -331,6 +356,33 @@ class NIGNormalBackend(bayeslite.backend.BayesDB_Backend):
         modelwise = [model_log_pdf(m) for m in sorted(all_mus.keys())]
         return logmeanexp(modelwise)
 
+    def logpdf_joint_many(self, bdb, generator_id, modelnos, queries):
+        # Note: The constraints are irrelevant for the same reason as
+        # in simulate_joint.
+        (all_mus, all_sigmas) = self._all_mus_sigmas(bdb, generator_id)
+        deviations = self._deviation_colnos(bdb, generator_id)
+        def logpdf_1(mus, sigmas, colno, x):
+            if colno < 0:
+                return logpdf_gaussian(x, 0, sigmas[deviations[colno]])
+            else:
+                return logpdf_gaussian(x, mus[colno], sigmas[colno])
+        def query_log_pdf(targets):
+            # XXX Ignore modelnos and aggregate over all of them.
+            return logmeanexp([
+                sum(logpdf_1(all_mus[m], all_sigmas[m], colno, x)
+                    for colno, x in targets)
+                for m in sorted(all_mus.keys())
+            ])
+        return [query_log_pdf(targets) for _rowid, targets, _c in queries]
+
+    def _deviation_colnos(self, bdb, generator_id):
+        cursor = bdb.sql_execute('''
+            SELECT deviation_colno, observed_colno
+                FROM bayesdb_nig_normal_deviation
+                WHERE generator_id = ?
+        ''', (generator_id,))
+        return dict(cursor)
+
     def _logpdf_1(self, bdb, generator_id, mus, sigmas, colno, x):
         if colno < 0:
             dev_colno = colno
@@ -388,6 +440,18 @@ class NIGNormalBackend(bayeslite.backend.BayesDB_Backend):
         mus, _sigmas = self._model_mus_sigmas(bdb, generator_id, modelno)
         return (mus[colno], 1.)
 
+    def predict_confidence_many(self, bdb, generator_id, modelnos, queries,
+            numsamples=None):
+        if modelnos is None:
+            modelnos = self._modelnos(bdb, generator_id)
+        (all_mus, _all_sigmas) = self._all_mus_sigmas(bdb, generator_id)
+        def predict_1(colno):
+            if colno < 0:
+                return (0, 1)   # deviation of mode from mean is zero
+            modelno = self.prng.choice(modelnos)
+            return (all_mus[modelno][colno], 1.)
+        return [predict_1(colno) for _rowid, colno in queries]
+
     def insert(self, bdb, generator_id, item):
         (_, colno, value) = item
         # Theoretically, I am supposed to detect and report attempted
@@ -15,6 +15,7 @@
 #   limitations under the License.
 
 import apsw
+import collections
 import contextlib
 import numpy.random
 import random
@@ -82,6 +83,10 @@ class BayesDB(object):
         self._sqlite3 = apsw.Connection(pathname)
         self._txn_depth = 0     # managed in txn.py
         self._cache = None      # managed in txn.py
+        self._catalog = None    # managed in core.py
+        self._plan_stamp = 0    # managed in bql.py
+        self._plans = collections.OrderedDict()
+        self.plan_cache_size = 128
         self.backends = {}
         self.tracer = None
         self.sql_tracer = None
@@ -105,6 +110,21 @@ class BayesDB(object):
         self._sqlite3.createmodule('bql_mutinf', bqlvtab.MutinfModule(self))
         self._sqlite3.cursor().execute(
             'create virtual table temp.bql_mutinf using bql_mutinf')
+        self._sqlite3.createmodule('bql_depprob', bqlvtab.DepProbModule(self))
+        self._sqlite3.cursor().execute(
+            'create virtual table temp.bql_depprob using bql_depprob')
+        self._sqlite3.createmodule('bql_similarity',
+            bqlvtab.SimilarityModule(self))
+        self._sqlite3.cursor().execute(
+            'create virtual table temp.bql_similarity using bql_similarity')
+        self._sqlite3.createmodule('bql_predprob',
+            bqlvtab.PredProbModule(self))
+        self._sqlite3.cursor().execute(
+            'create virtual table temp.bql_predprob using bql_predprob')
+        self._sqlite3.createmodule('bql_prediction',
+            bqlvtab.PredictionModule(self))
+        self._sqlite3.cursor().execute(
+            'create virtual table temp.bql_prediction using bql_prediction')
 
         # Set up math utilities.
         bqlmath.bayesdb_install_bqlmath(self._sqlite3, self)
@@ -265,7 +285,26 @@ class BayesDB(object):
             tracer.error(qid, e)
             raise
 
+    def prepare(self, string):
+        """Parse a BQL query once and return a prepared statement for it.
+
+        The argument `string` is as for :meth:`~BayesDB.execute`.  The
+        result has an `execute` method taking only the bindings, which
+        skips parsing and, where possible, compiling the query again.
+        """
+        return bql.PreparedStatement(self, string, self._parse_phrase(string))
+
     def _do_execute(self, string, bindings):
+        # Plans are cached by query text, most recently used last.
+        plan = self._plans.pop(string, None)
+        if plan is None:
+            plan = self.prepare(string)
+        self._plans[string] = plan
+        while self.plan_cache_size < len(self._plans):
+            self._plans.popitem(last=False)
+        return plan._do_execute(string, bindings)
+
+    def _parse_phrase(self, string):
         phrases = parse.parse_bql_string(string)
         phrase = None
         try:
@@ -278,8 +317,7 @@ class BayesDB(object):
             pass
         else:
             raise ValueError('>1 phrase in string')
-        cursor = bql.execute_phrase(self, phrase, bindings)
-        return self._empty_cursor if cursor is None else cursor
+        return phrase
 
     def sql_execute(self, string, bindings=None):
         """Execute a SQL query on the underlying SQLite database.
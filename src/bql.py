@@ -41,8 +41,13 @@ from bayeslite.util import casefold
 from bayeslite.util import cursor_value
 
 
-def execute_phrase(bdb, phrase, bindings=()):
-    """Execute the BQL AST phrase `phrase` and return a cursor of results."""
+def execute_phrase(bdb, phrase, bindings=(), plan=None):
+    """Execute the BQL AST phrase `phrase` and return a cursor of results.
+
+    If `plan` is a :class:`PreparedStatement` for `phrase`, reuse its
+    compiled SQL if it is still valid, or remember the compiled SQL in
+    it for next time.
+    """
     if isinstance(phrase, ast.Parametrized):
         n_numpar = phrase.n_numpar
         nampar_map = phrase.nampar_map
@@ -57,13 +62,24 @@ def execute_phrase(bdb, phrase, bindings=()):
         # Compile the query in the transaction in case we need to
         # execute subqueries to determine column lists.  Compiling is
         # a quick tree descent, so this should be fast.
-        out = compiler.Output(n_numpar, nampar_map, bindings)
-        with bdb.savepoint():
-            compiler.compile_query(bdb, phrase, out)
+        out = None if plan is None else plan._lookup(bdb)
+        if out is None:
+            out = compiler.Output(n_numpar, nampar_map, bindings)
+            with bdb.savepoint():
+                compiler.compile_query(bdb, phrase, out)
+            if plan is not None:
+                plan._remember(bdb, out)
+        else:
+            out = out.rebind(bindings)
         winders, unwinders = out.getwindings()
         return execute_wound(bdb, winders, unwinders, out.getvalue(),
             out.getbindings())
 
+    # Anything but a query may change the catalog or the models, so
+    # invalidate all compiled plans and the in-memory catalog.
+    bdb._plan_stamp += 1
+    bdb._catalog = None
+
     if isinstance(phrase, ast.Begin):
         txn.bayesdb_begin_transaction(bdb)
         return empty_cursor(bdb)
@@ -949,6 +965,74 @@ def rename_table(bdb, old, new):
 def empty_cursor(bdb):
     return None
 
+def bayesdb_plan_stamp(bdb):
+    """Return a stamp that changes whenever compiled plans may be stale.
+
+    The stamp covers BQL commands executed in `bdb`, SQL schema
+    changes, and changes committed by other connections to the same
+    database.
+    """
+    schema_version = cursor_value(bdb.sql_execute('PRAGMA schema_version'))
+    data_version = cursor_value(bdb.sql_execute('PRAGMA data_version'))
+    return (bdb._plan_stamp, schema_version, data_version)
+
+class PreparedStatement(object):
+    """BQL phrase parsed once, and compiled once if it is a query.
+
+    Obtain one with :meth:`bayeslite.BayesDB.prepare`, and execute it
+    any number of times with different bindings.  The compiled SQL of
+    a query is reused until the catalog or the models change.  Queries
+    whose compilation involves executing subqueries, such as
+    ``SIMULATE`` or ``ESTIMATE ... IN THE CONTEXT OF (ESTIMATE ...)``,
+    are recompiled every time.
+    """
+
+    def __init__(self, bdb, string, phrase):
+        self._bdb = bdb
+        self._string = string
+        self._phrase = phrase
+        self._stamp = None
+        self._out = None
+
+    @property
+    def string(self):
+        return self._string
+
+    def execute(self, bindings=None):
+        """Execute the prepared statement and return a cursor for its results.
+
+        The argument `bindings` is a sequence or dictionary of
+        bindings for parameters in the query, or ``None`` to supply no
+        bindings.
+        """
+        bdb = self._bdb
+        if bindings is None:
+            bindings = ()
+        return bdb._maybe_trace(
+            bdb.tracer, self._do_execute, self._string, bindings)
+
+    def _do_execute(self, _string, bindings):
+        bdb = self._bdb
+        cursor = execute_phrase(bdb, self._phrase, bindings, plan=self)
+        return bdb._empty_cursor if cursor is None else cursor
+
+    def _lookup(self, bdb):
+        # Within a transaction, the catalog may be rolled back under
+        # us without notice, so neither use nor remember plans there.
+        if self._out is None or bdb._txn_depth != 0:
+            return None
+        if self._stamp != bayesdb_plan_stamp(bdb):
+            self._stamp = None
+            self._out = None
+            return None
+        return self._out
+
+    def _remember(self, bdb, out):
+        if bdb._txn_depth != 0 or not out.getcacheable():
+            return
+        self._stamp = bayesdb_plan_stamp(bdb)
+        self._out = out
+
 def execute_wound(bdb, winders, unwinders, sql, bindings):
     if len(winders) == 0 and len(unwinders) == 0:
         return bdb.sql_execute(sql, bindings)
@@ -981,9 +1065,11 @@ class BayesDBCursor(object):
     def __iter__(self):
         return self
     def next(self):
-        return self._cursor.next()
+        with txn.bayesdb_caching(self._bdb):
+            return self._cursor.next()
     def fetchone(self):
-        return self._cursor.fetchone()
+        with txn.bayesdb_caching(self._bdb):
+            return self._cursor.fetchone()
     def fetchvalue(self):
         return cursor_value(self)
     def fetchmany(self, size=1):
@@ -293,6 +293,16 @@ def bql_column_dependence_probability(
     depprobs = map(generator_depprob, generator_ids)
     return stats.arithmetic_mean(depprobs)
 
+def _bql_column_dependence_probabilities(
+        bdb, population_id, generator_id, modelnos, colnos):
+    def generator_depprobs(generator_id):
+        backend = core.bayesdb_generator_backend(bdb, generator_id)
+        return numpy.asarray(backend.column_dependence_probabilities(
+            bdb, generator_id, modelnos, colnos), dtype=float)
+    generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
+    depprobs = map(generator_depprobs, generator_ids)
+    return sum(depprobs) / len(depprobs)
+
 # Two-column function:  MUTUAL INFORMATION [OF <col0> WITH <col1>]
 def bql_column_mutual_information(
         bdb, population_id, generator_id, modelnos, colnos0, colnos1,
@@ -425,6 +435,17 @@ def bql_row_similarity(
     similarities = map(generator_similarity, generator_ids)
     return stats.arithmetic_mean(similarities)
 
+def _bql_row_similarities(bdb, population_id, generator_id, modelnos, rowids,
+        target_rowids, colno):
+    def generator_similarities(generator_id):
+        backend = core.bayesdb_generator_backend(bdb, generator_id)
+        return numpy.asarray(backend.row_similarities(
+            bdb, generator_id, modelnos, rowids, target_rowids, [colno]),
+            dtype=float)
+    generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
+    similarities = map(generator_similarities, generator_ids)
+    return sum(similarities) / len(similarities)
+
 # Row function:  PREDICTIVE RELEVANCE TO (<target_row>)
 #  [<AND HYPOTHETICAL ROWS WITH VALUES ((...))] IN THE CONTEXT OF <column>
 def bql_row_predictive_relevance(
@@ -485,6 +506,37 @@ def bql_row_column_predictive_probability(
     r = logmeanexp(predprobs)
     return ieee_exp(r)
 
+def _bql_row_column_predictive_probabilities(
+        bdb, population_id, generator_id, modelnos, rowids, targets,
+        constraints):
+    # Batched bql_row_column_predictive_probability over many rows, with
+    # targets and constraints as lists of colnos.
+    fresh_rowid = core.bayesdb_population_fresh_row_id(bdb, population_id)
+    values = _retrieve_rows_values(
+        bdb, population_id, rowids, targets + constraints)
+    def present(colnos, row_values):
+        return [(c, row_values[c]) for c in colnos
+            if row_values.get(c) is not None]
+    queries = []
+    indices = []
+    for i, rowid in enumerate(rowids):
+        cgpm_targets = present(targets, values[rowid])
+        # If all targets have NULL values, the result is None.
+        if len(cgpm_targets) == 0:
+            continue
+        cgpm_constraints = present(constraints, values[rowid])
+        queries.append((fresh_rowid, cgpm_targets, cgpm_constraints))
+        indices.append(i)
+    def generator_predprobs(generator_id):
+        backend = core.bayesdb_generator_backend(bdb, generator_id)
+        return backend.logpdf_joint_many(bdb, generator_id, modelnos, queries)
+    generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
+    predprobs = map(generator_predprobs, generator_ids)
+    results = [None] * len(rowids)
+    for k, i in enumerate(indices):
+        results[i] = ieee_exp(logmeanexp([p[k] for p in predprobs]))
+    return results
+
 ### Predict and simulate
 
 def bql_predict(
@@ -518,6 +570,33 @@ def bql_predict_confidence(
     # XXX Whattakludge!
     return json.dumps({'value': value, 'confidence': confidence})
 
+def _bql_predict_confidences(
+        bdb, population_id, generator_id, modelnos, rowids, colno, numsamples):
+    # Batched bql_predict_confidence over many rows.  Returns a list of
+    # (value, confidence) pairs.
+    # XXX Randomly sample 1 generator from the population for each row, until
+    # we figure out how to aggregate imputations across different hypotheses.
+    if generator_id is None:
+        generator_ids = core.bayesdb_population_generators(bdb, population_id)
+        indices = bdb.np_prng.randint(0, high=len(generator_ids),
+            size=len(rowids))
+        row_generator_ids = [generator_ids[index] for index in indices]
+    else:
+        row_generator_ids = [generator_id] * len(rowids)
+    results = [None] * len(rowids)
+    for generator_id in sorted(set(row_generator_ids)):
+        indices = [
+            i for i, row_generator_id in enumerate(row_generator_ids)
+            if row_generator_id == generator_id
+        ]
+        backend = core.bayesdb_generator_backend(bdb, generator_id)
+        predictions = backend.predict_confidence_many(
+            bdb, generator_id, modelnos, [(rowids[i], colno) for i in indices],
+            numsamples=numsamples)
+        for i, prediction in zip(indices, predictions):
+            results[i] = prediction
+    return results
+
 # XXX Whattakludge!
 def bql_json_get(bdb, blob, key):
     return json.loads(blob)[key]
@@ -599,6 +678,25 @@ def _retrieve_rowid_constraints(bdb, population_id, constraints):
         ]
     return rowid, constraints
 
+def _retrieve_rows_values(bdb, population_id, rowids, colnos):
+    # Return a dict mapping each rowid to a dict of the values of the
+    # manifest variables in colnos, reading the rows in one query.
+    colnos = sorted(set(colno for colno in colnos if 0 <= colno))
+    values = {rowid: {} for rowid in rowids}
+    if not colnos or not rowids:
+        return values
+    table_name = core.bayesdb_population_table(bdb, population_id)
+    qt = sqlite3_quote_name(table_name)
+    qcns = ','.join(
+        sqlite3_quote_name(
+            core.bayesdb_variable_name(bdb, population_id, None, colno))
+        for colno in colnos)
+    cursor = bdb.sql_execute('SELECT _rowid_, %s FROM %s WHERE _rowid_ IN (%s)'
+        % (qcns, qt, ','.join(str(int(rowid)) for rowid in rowids)))
+    for row in cursor:
+        values[row[0]] = dict(zip(colnos, row[1:]))
+    return values
+
 def _retrieve_generator_ids(bdb, population_id, generator_id):
     if generator_id is None:
         return core.bayesdb_population_generators(bdb, population_id)
@@ -16,8 +16,12 @@
 
 import apsw
 import json
+import math
 
 import bayeslite.bqlfn as bqlfn
+import bayeslite.core as core
+
+from bayeslite.sqlite3_util import sqlite3_quote_name
 
 
 class Mutinf(object):
@@ -209,6 +213,617 @@ class MutinfCursor(object):
         self._mi = _flatten2(mis)
 
 
+class DepProb(object):
+    DEPPROB = 0
+    POPULATION_ID = 1
+    GENERATOR_ID = 2
+    MODELNOS = 3
+    COLNO0 = 4
+    COLNO1 = 5
+
+
+class DepProbModule(object):
+
+    def __init__(self, bdb):
+        self._bdb = bdb
+
+    def Connect(self, connection, _modulename, _databasename, _tablename,
+            *_args):
+        schema = '''
+            create table t(
+                depprob real not null,
+                population_id integer not null,
+                generator_id integer,
+                modelnos text,                  -- json list
+                colno0 integer not null,
+                colno1 integer not null
+            )
+        '''
+        table = DepProbTable(self._bdb)
+        return schema, table
+
+    Create = Connect
+
+
+class DepProbTable(object):
+
+    def __init__(self, bdb):
+        self._bdb = bdb
+
+    def Open(self):
+        return DepProbCursor(self._bdb)
+
+    def BestIndex(self, constraints, _orderbys):
+        need = 1 << DepProb.POPULATION_ID
+        have = 0
+        arguments = [-1] * (DepProb.COLNO1 + 1)
+        for i, (c, op) in enumerate(constraints):
+            if op != apsw.SQLITE_INDEX_CONSTRAINT_EQ:
+                continue
+            if c not in (DepProb.POPULATION_ID, DepProb.GENERATOR_ID,
+                    DepProb.MODELNOS, DepProb.COLNO0, DepProb.COLNO1):
+                continue
+            arguments[c] = i
+            have |= 1 << c
+        if need & ~have:
+            # XXX Report clearer error message with names.
+            raise Exception('Missing constraints: %x' % (need & ~have,))
+
+        # Pass the arguments through to the cursor's Filter function in
+        # column order.
+        index_info = [None] * len(constraints)
+        count = _Count()
+        for c, i in enumerate(arguments):
+            if have & (1 << c):
+                index_info[i] = count.next()
+
+        # The whole matrix is computed once per cursor, after which
+        # each pair is a lookup.  Make sure sqlite3 prefers to pass the
+        # pair of columns in, rather than scanning the whole matrix for
+        # every pair it joins against.
+        cost = 1.
+        if not have & (1 << DepProb.COLNO0):
+            cost *= 1000.
+        if not have & (1 << DepProb.COLNO1):
+            cost *= 1000.
+        return (index_info, have, None, False, cost)
+
+
+class DepProbCursor(object):
+
+    def __init__(self, bdb):
+        self._bdb = bdb
+        self._rowid = None
+        self._key = None
+        self._colnos = None
+        self._index = None
+        self._depprobs = None
+        self._indices0 = None
+        self._indices1 = None
+
+    def Close(self):
+        pass
+
+    def Column(self, number):
+        if number == -1:
+            return self._rowid
+        i = self._indices0[self._rowid // len(self._indices1)]
+        j = self._indices1[self._rowid % len(self._indices1)]
+        if number == DepProb.DEPPROB:
+            return float(self._depprobs[i, j])
+        elif number == DepProb.COLNO0:
+            return self._colnos[i]
+        elif number == DepProb.COLNO1:
+            return self._colnos[j]
+        else:
+            return self._key[number - DepProb.POPULATION_ID]
+
+    def Next(self):
+        self._rowid += 1
+
+    def Rowid(self):
+        return self._rowid
+
+    def Eof(self):
+        return not self._rowid < len(self._indices0) * len(self._indices1)
+
+    def Filter(self, indexnum, indexname, constraintargs):
+        self._rowid = 0
+
+        # DepProbTable.BestIndex should have guaranteed the required
+        # arguments were passed through, in column order.
+        assert indexnum & (1 << DepProb.POPULATION_ID)
+        arguments = iter(constraintargs)
+        def argument(c):
+            return arguments.next() if indexnum & (1 << c) else None
+        population_id = argument(DepProb.POPULATION_ID)
+        generator_id = argument(DepProb.GENERATOR_ID)
+        modelnos = argument(DepProb.MODELNOS)
+        colno0 = argument(DepProb.COLNO0)
+        colno1 = argument(DepProb.COLNO1)
+
+        # Compute the matrix for all variables at once, unless we
+        # already have it from a previous Filter.
+        key = (population_id, generator_id, modelnos)
+        if key != self._key:
+            self._colnos = core.bayesdb_variable_numbers(
+                self._bdb, population_id, generator_id)
+            self._index = {colno: i for i, colno in enumerate(self._colnos)}
+            self._depprobs = bqlfn._bql_column_dependence_probabilities(
+                self._bdb, population_id, generator_id,
+                bqlfn._retrieve_modelnos(modelnos), self._colnos)
+            self._key = key
+
+        # Enumerate the pairs asked for, or all of them.
+        def indices(colno):
+            if colno is None:
+                return range(len(self._colnos))
+            if colno in self._index:
+                return [self._index[colno]]
+            return []
+        self._indices0 = indices(colno0)
+        self._indices1 = indices(colno1)
+
+
+class Similarity(object):
+    SIMILARITY = 0
+    POPULATION_ID = 1
+    GENERATOR_ID = 2
+    MODELNOS = 3
+    COLNO = 4
+    ROWID0 = 5
+    ROWID1 = 6
+
+
+class SimilarityModule(object):
+
+    def __init__(self, bdb):
+        self._bdb = bdb
+
+    def Connect(self, connection, _modulename, _databasename, _tablename,
+            *_args):
+        schema = '''
+            create table t(
+                similarity real,
+                population_id integer not null,
+                generator_id integer,
+                modelnos text,                  -- json list
+                colno integer not null,
+                rowid0 integer not null,
+                rowid1 integer not null
+            )
+        '''
+        table = SimilarityTable(self._bdb)
+        return schema, table
+
+    Create = Connect
+
+
+class SimilarityTable(object):
+
+    def __init__(self, bdb):
+        self._bdb = bdb
+
+    def Open(self):
+        return SimilarityCursor(self._bdb)
+
+    def BestIndex(self, constraints, _orderbys):
+        need = 0
+        need |= 1 << Similarity.POPULATION_ID
+        need |= 1 << Similarity.COLNO
+        have = 0
+        arguments = [-1] * (Similarity.ROWID0 + 1)
+        for i, (c, op) in enumerate(constraints):
+            if op != apsw.SQLITE_INDEX_CONSTRAINT_EQ:
+                continue
+            # We take rowid1 only from a scan: a lookup of one pair of
+            # rows at a time would defeat computing similarities a block
+            # of rows at a time.
+            if c not in (Similarity.POPULATION_ID, Similarity.GENERATOR_ID,
+                    Similarity.MODELNOS, Similarity.COLNO, Similarity.ROWID0):
+                continue
+            arguments[c] = i
+            have |= 1 << c
+        if need & ~have:
+            # XXX Report clearer error message with names.
+            raise Exception('Missing constraints: %x' % (need & ~have,))
+
+        # Pass the arguments through to the cursor's Filter function in
+        # column order.
+        index_info = [None] * len(constraints)
+        count = _Count()
+        for c, i in enumerate(arguments):
+            if have & (1 << c):
+                index_info[i] = count.next()
+
+        cost = 1000.
+        if not have & (1 << Similarity.ROWID0):
+            cost *= 1000.
+        return (index_info, have, None, False, cost)
+
+
+class SimilarityCursor(object):
+
+    # Number of similarities to compute at once, which bounds the
+    # memory we use for a block of rows.
+    BLOCK_SIZE = 1 << 20
+
+    def __init__(self, bdb):
+        self._bdb = bdb
+        self._rowid = None
+        self._key = None
+        self._rowids = None
+        self._index = None
+        self._block_start = None
+        self._block = None
+        self._indices0 = None
+
+    def Close(self):
+        pass
+
+    def Column(self, number):
+        if number == -1:
+            return self._rowid
+        i = self._indices0[self._rowid // len(self._rowids)]
+        j = self._rowid % len(self._rowids)
+        if number == Similarity.SIMILARITY:
+            similarity = self._similarity(i, j)
+            return None if math.isnan(similarity) else similarity
+        elif number == Similarity.ROWID0:
+            return self._rowids[i]
+        elif number == Similarity.ROWID1:
+            return self._rowids[j]
+        else:
+            return self._key[number - Similarity.POPULATION_ID]
+
+    def Next(self):
+        self._rowid += 1
+
+    def Rowid(self):
+        return self._rowid
+
+    def Eof(self):
+        return not self._rowid < len(self._indices0) * len(self._rowids)
+
+    def Filter(self, indexnum, indexname, constraintargs):
+        self._rowid = 0
+
+        # SimilarityTable.BestIndex should have guaranteed the required
+        # arguments were passed through, in column order.
+        assert indexnum & (1 << Similarity.POPULATION_ID)
+        assert indexnum & (1 << Similarity.COLNO)
+        arguments = iter(constraintargs)
+        def argument(c):
+            return arguments.next() if indexnum & (1 << c) else None
+        population_id = argument(Similarity.POPULATION_ID)
+        generator_id = argument(Similarity.GENERATOR_ID)
+        modelnos = argument(Similarity.MODELNOS)
+        colno = argument(Similarity.COLNO)
+        rowid0 = argument(Similarity.ROWID0)
+
+        # Find the rows of the population, unless we already have them
+        # from a previous Filter.
+        key = (population_id, generator_id, modelnos, colno)
+        if key != self._key:
+            table_name = core.bayesdb_population_table(
+                self._bdb, population_id)
+            qt = sqlite3_quote_name(table_name)
+            cursor = self._bdb.sql_execute(
+                'SELECT _rowid_ FROM %s ORDER BY _rowid_' % (qt,))
+            self._rowids = [rowid for (rowid,) in cursor]
+            self._index = {rowid: i for i, rowid in enumerate(self._rowids)}
+            self._block_start = None
+            self._block = None
+            self._key = key
+
+        # Enumerate the rows asked for, or all of them.
+        if rowid0 is None:
+            self._indices0 = range(len(self._rowids))
+        elif rowid0 in self._index:
+            self._indices0 = [self._index[rowid0]]
+        else:
+            self._indices0 = []
+
+    def _similarity(self, i, j):
+        # Compute the similarities of a block of rows starting at i to
+        # all rows, unless we already have them from the last block.
+        start = self._block_start
+        if start is None or not (start <= i < start + len(self._block)):
+            population_id, generator_id, modelnos, colno = self._key
+            n = max(1, self.BLOCK_SIZE // len(self._rowids))
+            self._block = bqlfn._bql_row_similarities(
+                self._bdb, population_id, generator_id,
+                bqlfn._retrieve_modelnos(modelnos), self._rowids[i:i + n],
+                self._rowids, colno)
+            self._block_start = start = i
+        return float(self._block[i - start, j])
+
+
+class PredProb(object):
+    PREDPROB = 0
+    POPULATION_ID = 1
+    GENERATOR_ID = 2
+    MODELNOS = 3
+    TARGETS = 4
+    CONSTRAINTS = 5
+    TABLE_ROWID = 6
+
+
+class PredProbModule(object):
+
+    def __init__(self, bdb):
+        self._bdb = bdb
+
+    def Connect(self, connection, _modulename, _databasename, _tablename,
+            *_args):
+        schema = '''
+            create table t(
+                predprob real,
+                population_id integer not null,
+                generator_id integer,
+                modelnos text,                  -- json list
+                targets text not null,          -- json list
+                constraints text not null,      -- json list
+                table_rowid integer not null
+            )
+        '''
+        table = PredProbTable(self._bdb)
+        return schema, table
+
+    Create = Connect
+
+
+class PredProbTable(object):
+
+    def __init__(self, bdb):
+        self._bdb = bdb
+
+    def Open(self):
+        return PredProbCursor(self._bdb)
+
+    def BestIndex(self, constraints, _orderbys):
+        return _row_block_best_index(constraints, [
+            PredProb.POPULATION_ID, PredProb.TARGETS, PredProb.CONSTRAINTS,
+        ], [
+            PredProb.GENERATOR_ID, PredProb.MODELNOS,
+        ], PredProb.TABLE_ROWID)
+
+
+class Prediction(object):
+    VALUE = 0
+    CONFIDENCE = 1
+    PREDICTION = 2
+    POPULATION_ID = 3
+    GENERATOR_ID = 4
+    MODELNOS = 5
+    COLNO = 6
+    NUMSAMPLES = 7
+    TABLE_ROWID = 8
+
+
+class PredictionModule(object):
+
+    def __init__(self, bdb):
+        self._bdb = bdb
+
+    def Connect(self, connection, _modulename, _databasename, _tablename,
+            *_args):
+        schema = '''
+            create table t(
+                value,
+                confidence real,
+                prediction text,                -- json dict
+                population_id integer not null,
+                generator_id integer,
+                modelnos text,                  -- json list
+                colno integer not null,
+                numsamples integer,
+                table_rowid integer not null
+            )
+        '''
+        table = PredictionTable(self._bdb)
+        return schema, table
+
+    Create = Connect
+
+
+class PredictionTable(object):
+
+    def __init__(self, bdb):
+        self._bdb = bdb
+
+    def Open(self):
+        return PredictionCursor(self._bdb)
+
+    def BestIndex(self, constraints, _orderbys):
+        return _row_block_best_index(constraints, [
+            Prediction.POPULATION_ID, Prediction.COLNO,
+        ], [
+            Prediction.GENERATOR_ID, Prediction.MODELNOS,
+            Prediction.NUMSAMPLES,
+        ], Prediction.TABLE_ROWID)
+
+
+def _row_block_best_index(constraints, needed, optional, table_rowid):
+    need = 0
+    for c in needed:
+        need |= 1 << c
+    have = 0
+    arguments = [-1] * (table_rowid + 1)
+    for i, (c, op) in enumerate(constraints):
+        if op != apsw.SQLITE_INDEX_CONSTRAINT_EQ:
+            continue
+        if c not in needed and c not in optional and c != table_rowid:
+            continue
+        arguments[c] = i
+        have |= 1 << c
+    if need & ~have:
+        # XXX Report clearer error message with names.
+        raise Exception('Missing constraints: %x' % (need & ~have,))
+
+    # Pass the arguments through to the cursor's Filter function in
+    # column order.
+    index_info = [None] * len(constraints)
+    count = _Count()
+    for c, i in enumerate(arguments):
+        if have & (1 << c):
+            index_info[i] = count.next()
+
+    # Looking up one row is cheap; computing all of them is not.
+    cost = 1000.
+    if not have & (1 << table_rowid):
+        cost *= 1000.
+    return (index_info, have, None, False, cost)
+
+
+class _RowBlockCursor(object):
+    """Cursor computing a row function a block of rows at a time.
+
+    SQLite asks for one row at a time, by looking up each rowid of the
+    base table in turn as it scans it.  Rather than calling the backend
+    once per row, on a miss we compute the function for a block of the
+    rows following the one asked for, which the scan will ask for next.
+    The block doubles while the scan uses all of it, and shrinks when
+    the scan skips rows -- e.g., because a WHERE clause filters them --
+    so that we compute little more than is asked for.
+
+    Subclasses define TABLE_ROWID, the column number of the rowid, and
+    _compute(rowids), returning a list of the results for rowids.
+    """
+
+    # Maximum number of rows to compute at once.
+    BLOCK_SIZE = 1 << 12
+
+    def __init__(self, bdb):
+        self._bdb = bdb
+        self._rowid = None
+        self._key = None
+        self._table = None
+        self._rowids = None
+        self._block = {}
+        self._block_hits = 0
+        self._block_rowid = None
+
+    def Close(self):
+        pass
+
+    def Next(self):
+        self._rowid += 1
+
+    def Rowid(self):
+        return self._rowid
+
+    def Eof(self):
+        return not self._rowid < len(self._rowids)
+
+    def Filter(self, indexnum, indexname, constraintargs):
+        self._rowid = 0
+        arguments = iter(constraintargs)
+        key = tuple(
+            arguments.next() if indexnum & (1 << c) else None
+            for c in range(self.TABLE_ROWID))
+        table_rowid = arguments.next() \
+            if indexnum & (1 << self.TABLE_ROWID) else None
+
+        # Forget the last block if the function has changed.
+        if key != self._key:
+            population_id = key[self.POPULATION_ID]
+            table_name = core.bayesdb_population_table(
+                self._bdb, population_id)
+            self._table = sqlite3_quote_name(table_name)
+            self._block = {}
+            self._block_hits = 0
+            self._block_rowid = None
+            self._key = key
+
+        # Enumerate the rows asked for, or all of them.
+        if table_rowid is None:
+            cursor = self._bdb.sql_execute(
+                'SELECT _rowid_ FROM %s ORDER BY _rowid_' % (self._table,))
+            self._rowids = [rowid for (rowid,) in cursor]
+        elif table_rowid in self._block:
+            self._rowids = [table_rowid]
+        else:
+            cursor = self._bdb.sql_execute(
+                'SELECT _rowid_ FROM %s WHERE _rowid_ = ?' % (self._table,),
+                (table_rowid,))
+            self._rowids = [rowid for (rowid,) in cursor]
+
+    def _result(self):
+        rowid = self._rowids[self._rowid]
+        if rowid not in self._block:
+            # Compute the next block of rows, twice as many as the scan
+            # used of the last block.
+            n = min(self.BLOCK_SIZE, max(1, 2*self._block_hits))
+            cursor = self._bdb.sql_execute('''
+                SELECT _rowid_ FROM %s WHERE _rowid_ >= ?
+                    ORDER BY _rowid_ LIMIT ?
+            ''' % (self._table,), (rowid, n))
+            rowids = [rowid_ for (rowid_,) in cursor]
+            self._block = dict(zip(rowids, self._compute(rowids)))
+            self._block_hits = 0
+            self._block_rowid = None
+        if rowid != self._block_rowid:
+            self._block_hits += 1
+            self._block_rowid = rowid
+        return self._block[rowid]
+
+
+class PredProbCursor(_RowBlockCursor):
+
+    POPULATION_ID = PredProb.POPULATION_ID
+    TABLE_ROWID = PredProb.TABLE_ROWID
+
+    def Column(self, number):
+        if number == -1:
+            return self._rowid
+        elif number == PredProb.PREDPROB:
+            return self._result()
+        elif number == PredProb.TABLE_ROWID:
+            return self._rowids[self._rowid]
+        else:
+            return self._key[number]
+
+    def _compute(self, rowids):
+        _predprob, population_id, generator_id, modelnos, targets, \
+            constraints = self._key
+        return bqlfn._bql_row_column_predictive_probabilities(
+            self._bdb, population_id, generator_id,
+            bqlfn._retrieve_modelnos(modelnos), rowids, json.loads(targets),
+            json.loads(constraints))
+
+
+class PredictionCursor(_RowBlockCursor):
+
+    POPULATION_ID = Prediction.POPULATION_ID
+    TABLE_ROWID = Prediction.TABLE_ROWID
+
+    def Column(self, number):
+        if number == -1:
+            return self._rowid
+        elif number == Prediction.VALUE:
+            value, _confidence = self._result()
+            return value
+        elif number == Prediction.CONFIDENCE:
+            _value, confidence = self._result()
+            return confidence
+        elif number == Prediction.PREDICTION:
+            value, confidence = self._result()
+            # XXX Whattakludge!  Same as bql_predict_confidence.
+            return json.dumps({'value': value, 'confidence': confidence})
+        elif number == Prediction.TABLE_ROWID:
+            return self._rowids[self._rowid]
+        else:
+            return self._key[number]
+
+    def _compute(self, rowids):
+        _value, _confidence, _prediction, population_id, generator_id, \
+            modelnos, colno, numsamples = self._key
+        return bqlfn._bql_predict_confidences(
+            self._bdb, population_id, generator_id,
+            bqlfn._retrieve_modelnos(modelnos), rowids, colno, numsamples)
+
+
 ### Utilities
 
 def _flatten2(xss):
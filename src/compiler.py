@@ -30,6 +30,7 @@ To compile a parsed BQL query:
 
 import StringIO
 import contextlib
+import copy
 import json
 
 import bayeslite.ast as ast
@@ -63,11 +64,36 @@ class Output(object):
         self._select = []               # map of output index -> input index
         self._winders = []              # list of pre-query (sql, bindings)
         self._unwinders = []            # list of post-query (sql, bindings)
+        self._volatile = False          # true if output depends on data
 
     def subquery(self):
-        """Return an output accumulator for a subquery."""
+        """Return an output accumulator for a subquery.
+
+        Subqueries are executed at compile-time, so the accumulated
+        output is thereafter not reusable with other bindings.
+        """
+        self._volatile = True
         return Output(self._n_numpar, self._nampar_map, self._bindings)
 
+    def rebind(self, bindings):
+        """Return a copy of the accumulated output with new `bindings`.
+
+        Only valid if :meth:`getcacheable` is true.
+        """
+        assert not self._volatile
+        out = copy.copy(self)
+        out._bindings = bindings
+        return out
+
+    def getcacheable(self):
+        """True if the output may be reused with other bindings.
+
+        False if compiling it required executing subqueries or winding
+        temporary tables, whose results may depend on the bindings or
+        on the contents of the database.
+        """
+        return not self._volatile
+
     def getvalue(self):
         """Return the accumulated output."""
         return self._stringio.getvalue()
@@ -181,6 +207,7 @@ class Output(object):
         self.write_numpar(n)
 
     def winder(self, sql, bindings):
+        self._volatile = True
         self._winders.append((sql, bindings))
     def unwinder(self, sql, bindings):
         self._unwinders.append((sql, bindings))
@@ -373,17 +400,23 @@ def compile_infer_explicit(bdb, infer, named, out):
             raise BQLError(bdb, 'No such generator: %s' % (infer.generator,))
         generator_id = core.bayesdb_get_generator(
             bdb, population_id, infer.generator)
+    # Compute row-wise BQL functions only for the rows that survive a
+    # LIMIT, if we can, and otherwise for many rows at once.
+    late = row_late(infer, True)
+    batches = [] if late else row_batches(bdb, population_id, generator_id,
+        infer.columns, query_expressions(infer), True)
+    # Compute each row-wise BQL function that occurs repeatedly once.
+    commons = row_commons(bdb, population_id, generator_id, infer.columns,
+        query_expressions(infer), batches, True)
     bql_compiler = BQLCompiler_1Row_Infer(population_id, generator_id,
-        infer.modelnos)
+        infer.modelnos, batch_exps=row_batch_exps(batches),
+        common_exps=row_common_exps(commons))
     columns = expand_select_columns(
         bdb, infer.columns, named, bql_compiler, out)
     compile_select_columns(bdb, columns, named, bql_compiler, out)
-    table_name = core.bayesdb_population_table(bdb, population_id)
-    qt = sqlite3_quote_name(table_name)
-    out.write(' FROM %s' % (qt,))
-    if infer.condition is not None:
-        out.write(' WHERE ')
-        compile_expression(bdb, infer.condition, bql_compiler, out)
+    compile_row_from(bdb, population_id, generator_id, infer.modelnos,
+        batches, commons, infer.condition, bql_compiler, out,
+        limit=(infer.order, infer.limit) if late else None)
     if infer.grouping is not None:
         assert 0 < len(infer.grouping.keys)
         first = True
@@ -399,27 +432,9 @@ def compile_infer_explicit(bdb, infer, named, out):
             compile_expression(bdb, infer.grouping.condition, bql_compiler,
                 out)
     if infer.order is not None:
-        assert 0 < len(infer.order)
-        first = True
-        for order in infer.order:
-            if first:
-                out.write(' ORDER BY ')
-                first = False
-            else:
-                out.write(', ')
-            compile_expression(bdb, order.expression, bql_compiler, out)
-            if order.sense == ast.ORD_ASC:
-                pass
-            elif order.sense == ast.ORD_DESC:
-                out.write(' DESC')
-            else:
-                assert False, 'Invalid order sense: %s' % (repr(order.sense),)
-    if infer.limit is not None:
-        out.write(' LIMIT ')
-        compile_expression(bdb, infer.limit.limit, bql_compiler, out)
-        if infer.limit.offset is not None:
-            out.write(' OFFSET ')
-            compile_expression(bdb, infer.limit.offset, bql_compiler, out)
+        compile_order_by(bdb, infer.order, bql_compiler, out)
+    if infer.limit is not None and not late:
+        compile_limit(bdb, infer.limit, bql_compiler, out)
 
 def compile_infer_auto(bdb, infer, out):
     assert isinstance(infer, ast.InferAuto)
@@ -475,18 +490,24 @@ def compile_estimate(bdb, estimate, out):
                 (estimate.generator,))
         generator_id = core.bayesdb_get_generator(
             bdb, population_id, estimate.generator)
+    # Compute row-wise BQL functions only for the rows that survive a
+    # LIMIT, if we can, and otherwise for many rows at once.
+    late = row_late(estimate, False)
+    batches = [] if late else row_batches(bdb, population_id, generator_id,
+        estimate.columns, query_expressions(estimate), False)
+    # Compute each row-wise BQL function that occurs repeatedly once.
+    commons = row_commons(bdb, population_id, generator_id, estimate.columns,
+        query_expressions(estimate), batches, False)
     bql_compiler = BQLCompiler_1Row(population_id, generator_id,
-        estimate.modelnos)
+        estimate.modelnos, batch_exps=row_batch_exps(batches),
+        common_exps=row_common_exps(commons))
     named = True
     columns = expand_select_columns(
         bdb, estimate.columns, named, bql_compiler, out)
     compile_select_columns(bdb, columns, named, bql_compiler, out)
-    table_name = core.bayesdb_population_table(bdb, population_id)
-    qt = sqlite3_quote_name(table_name)
-    out.write(' FROM %s' % (qt,))
-    if estimate.condition is not None:
-        out.write(' WHERE ')
-        compile_expression(bdb, estimate.condition, bql_compiler, out)
+    compile_row_from(bdb, population_id, generator_id, estimate.modelnos,
+        batches, commons, estimate.condition, bql_compiler, out,
+        limit=(estimate.order, estimate.limit) if late else None)
     if estimate.grouping is not None:
         assert 0 < len(estimate.grouping.keys)
         first = True
@@ -502,27 +523,33 @@ def compile_estimate(bdb, estimate, out):
             compile_expression(bdb, estimate.grouping.condition, bql_compiler,
                 out)
     if estimate.order is not None:
-        assert 0 < len(estimate.order)
-        first = True
-        for order in estimate.order:
-            if first:
-                out.write(' ORDER BY ')
-                first = False
-            else:
-                out.write(', ')
-            compile_expression(bdb, order.expression, bql_compiler, out)
-            if order.sense == ast.ORD_ASC:
-                pass
-            elif order.sense == ast.ORD_DESC:
-                out.write(' DESC')
-            else:
-                assert False, 'Invalid order sense: %s' % (repr(order.sense),)
-    if estimate.limit is not None:
-        out.write(' LIMIT ')
-        compile_expression(bdb, estimate.limit.limit, bql_compiler, out)
-        if estimate.limit.offset is not None:
-            out.write(' OFFSET ')
-            compile_expression(bdb, estimate.limit.offset, bql_compiler, out)
+        compile_order_by(bdb, estimate.order, bql_compiler, out)
+    if estimate.limit is not None and not late:
+        compile_limit(bdb, estimate.limit, bql_compiler, out)
+
+def compile_order_by(bdb, order, bql_compiler, out):
+    assert 0 < len(order)
+    first = True
+    for term in order:
+        if first:
+            out.write(' ORDER BY ')
+            first = False
+        else:
+            out.write(', ')
+        compile_expression(bdb, term.expression, bql_compiler, out)
+        if term.sense == ast.ORD_ASC:
+            pass
+        elif term.sense == ast.ORD_DESC:
+            out.write(' DESC')
+        else:
+            assert False, 'Invalid order sense: %s' % (repr(term.sense),)
+
+def compile_limit(bdb, limit, bql_compiler, out):
+    out.write(' LIMIT ')
+    compile_expression(bdb, limit.limit, bql_compiler, out)
+    if limit.offset is not None:
+        out.write(' OFFSET ')
+        compile_expression(bdb, limit.offset, bql_compiler, out)
 
 def compile_estimate_by(bdb, estby, out):
     assert isinstance(estby, ast.EstBy)
@@ -934,8 +961,22 @@ def compile_estpaircols(bdb, estpaircols, out):
                 (estpaircols.generator,))
         generator_id = core.bayesdb_get_generator(
             bdb, population_id, estpaircols.generator)
+    # Dependence probability of every pair of columns can be computed
+    # all at once from the column partitions, so if the query asks for
+    # it, join with the bql_depprob virtual table, which computes the
+    # whole matrix up front, rather than calling the backend pair by
+    # pair.
+    expressions = [exp for exp, _name in estpaircols.columns]
+    if estpaircols.condition is not None:
+        expressions.append(estpaircols.condition)
+    if estpaircols.order is not None:
+        expressions.extend(order.expression for order in estpaircols.order)
+    depprob = any(isinstance(subexp, ast.ExpBQLDepProb)
+        for exp in expressions
+        for subexp in expression_subexpressions(exp))
     bql_compiler = BQLCompiler_2Col(population_id, generator_id,
-        estpaircols.modelnos, colno0_exp, colno1_exp)
+        estpaircols.modelnos, colno0_exp, colno1_exp,
+        depprob_exp=('d.depprob' if depprob else None))
     out.write('SELECT'
         ' %d AS population_id, v0.name AS name0, v1.name AS name1' %
         (population_id,))
@@ -954,10 +995,19 @@ def compile_estpaircols(bdb, estpaircols, out):
     out.write(' FROM'
         ' bayesdb_population AS p,'
         ' bayesdb_variable AS v0,'
-        ' bayesdb_variable AS v1'
-        ' WHERE p.id = %(population_id)d'
+        ' bayesdb_variable AS v1')
+    if depprob:
+        out.write(', bql_depprob AS d')
+    out.write(' WHERE p.id = %(population_id)d'
         ' AND v0.population_id = p.id AND v1.population_id = p.id' %
               {'population_id': population_id})
+    if depprob:
+        out.write(' AND d.population_id = %d' % (population_id,))
+        if generator_id is not None:
+            out.write(' AND d.generator_id = %d' % (generator_id,))
+        if estpaircols.modelnos is not None:
+            out.write(' AND d.modelnos = %s' % (nullorq(estpaircols.modelnos),))
+        out.write(' AND d.colno0 = v0.colno AND d.colno1 = v1.colno')
     if generator_id is None:
         out.write(' AND v0.generator_id IS NULL')
         out.write(' AND v1.generator_id IS NULL')
@@ -1019,8 +1069,30 @@ def compile_estpairrow(bdb, estpairrow, out):
             bdb, population_id, estpairrow.generator)
     rowid0_exp = 'r0._rowid_'
     rowid1_exp = 'r1._rowid_'
+    # Similarities of all pairs of rows can be computed a block of rows
+    # at a time from the row partitions, so for each context variable
+    # of SIMILARITY in the query, join with a bql_similarity virtual
+    # table rather than calling the backend pair by pair.
+    expressions = [selcol.expression for selcol in estpairrow.columns
+        if isinstance(selcol, ast.SelColExp)]
+    if estpairrow.condition is not None:
+        expressions.append(estpairrow.condition)
+    if estpairrow.order is not None:
+        expressions.extend(order.expression for order in estpairrow.order)
+    similarity_colnos = []
+    for exp in expressions:
+        for subexp in expression_subexpressions(exp):
+            colno = similarity_context_colno(
+                bdb, population_id, generator_id, subexp)
+            if colno is not None and colno not in similarity_colnos:
+                similarity_colnos.append(colno)
+    similarity_exps = {
+        colno: 's%d.similarity' % (i,)
+        for i, colno in enumerate(similarity_colnos)
+    }
     bql_compiler = BQLCompiler_2Row(population_id, generator_id,
-        estpairrow.modelnos, rowid0_exp, rowid1_exp)
+        estpairrow.modelnos, rowid0_exp, rowid1_exp,
+        similarity_exps=similarity_exps)
     out.write('SELECT %s AS rowid0, %s AS rowid1,' % (rowid0_exp, rowid1_exp))
     named = True
     columns = expand_select_columns(
@@ -1030,8 +1102,22 @@ def compile_estpairrow(bdb, estpairrow, out):
     table_name = core.bayesdb_population_table(bdb, population_id)
     qt = sqlite3_quote_name(table_name)
     out.write(' FROM %s AS r0, %s AS r1' % (qt, qt))
+    for i in range(len(similarity_colnos)):
+        out.write(', bql_similarity AS s%d' % (i,))
+    conjunction = ' WHERE '
+    for i, colno in enumerate(similarity_colnos):
+        out.write('%ss%d.population_id = %d' % (conjunction, i, population_id))
+        conjunction = ' AND '
+        if generator_id is not None:
+            out.write(' AND s%d.generator_id = %d' % (i, generator_id))
+        if estpairrow.modelnos is not None:
+            out.write(' AND s%d.modelnos = %s' %
+                (i, nullorq(estpairrow.modelnos)))
+        out.write(' AND s%d.colno = %d' % (i, colno))
+        out.write(' AND s%d.rowid0 = %s AND s%d.rowid1 = %s' %
+            (i, rowid0_exp, i, rowid1_exp))
     if estpairrow.condition is not None:
-        out.write(' WHERE ')
+        out.write(conjunction)
         compile_expression(bdb, estpairrow.condition, bql_compiler, out)
     if estpairrow.order is not None:
         assert 0 < len(estpairrow.order)
@@ -1136,6 +1222,15 @@ class BQLCompiler_Const(IBQLCompiler):
             assert False, 'Invalid BQL function: %s' % (repr(bql),)
 
 class BQLCompiler_1Row(BQLCompiler_Const):
+    def __init__(self, population_id, generator_id, modelnos,
+            batch_exps=None, common_exps=None):
+        super(BQLCompiler_1Row, self).__init__(
+            population_id, generator_id, modelnos)
+        assert batch_exps is None or isinstance(batch_exps, dict)
+        assert common_exps is None or isinstance(common_exps, dict)
+        self.batch_exps = batch_exps or {}
+        self.common_exps = common_exps or {}
+
     @override(IBQLCompiler)
     def implicit_reference_var_colno_exp(self, bdb):
         raise BQLError(bdb, 'No implicit BQL population variable')
@@ -1147,79 +1242,21 @@ class BQLCompiler_1Row(BQLCompiler_Const):
         generator_id = self.generator_id
         modelnos = self.modelnos
         rowid_col = '_rowid_'   # XXX Don't hard-code this.
-        if isinstance(bql, ast.ExpBQLPredProb):
-            if not bql.targets:
-                raise BQLError(bdb, 'Predictive probability at row'
-                    ' needs targets.')
-            duplicates = [t for t in bql.targets if t in bql.constraints]
-            if duplicates:
-                raise BQLError(bdb,
-                    'Duplicate identifiers in targets and constraints: %s.'
-                    % (duplicates,))
-            def report_unknown_variables(colnos):
-                """Throws a BQLError if c in colnos is not in the population."""
-                unknown = [
-                    colno for colno in colnos
-                    if not core.bayesdb_has_variable(
-                        bdb, population_id, generator_id, colno)
-                ]
-                if unknown:
-                    population = core.bayesdb_population_name(
-                        bdb, population_id)
-                    raise BQLError(bdb,
-                        'No such variables in population %s: %s' %
-                        (population, unknown))
-            # If * in targets, use all variables except those in constraints.
-            if ast.ColListAll() in bql.targets:
-                if len(bql.targets) > 1:
-                    raise BQLError(bdb,'Cannot use (*) with other targets.')
-                # Use generator_id as not to retrieve latent variables.
-                constraints = [c.columns[0] for c in bql.constraints]
-                report_unknown_variables(constraints)
-                colnos_all = core.bayesdb_variable_numbers(
-                    bdb, population_id, None)
-                colnos_constraints = [
-                    core.bayesdb_variable_number(
-                        bdb, population_id, generator_id, constraint)
-                    for constraint in constraints
-                ]
-                colnos_targets = [
-                    colno for colno in colnos_all
-                    if colno not in colnos_constraints
-                ]
-            # If * in constraints, use all variables except those in targets.
-            elif ast.ColListAll() in bql.constraints:
-                if len(bql.constraints) > 1:
-                    raise BQLError(bdb,'Cannot use (*) with other constraints.')
-                colnos_all = core.bayesdb_variable_numbers(
-                    bdb, population_id, None)
-                targets = [c.columns[0] for c in bql.targets]
-                report_unknown_variables(targets)
-                colnos_targets = [
-                    core.bayesdb_variable_number(
-                        bdb, population_id, generator_id, target)
-                    for target in targets
-                ]
-                colnos_constraints = [
-                    colno for colno in colnos_all
-                    if colno not in colnos_targets
-                ]
-            # If no *, use the variables exactly as specified in the query.
-            else:
-                targets = [c.columns[0] for c in bql.targets]
-                constraints = [c.columns[0] for c in bql.constraints]
-                report_unknown_variables(targets)
-                report_unknown_variables(constraints)
-                colnos_targets = [
-                    core.bayesdb_variable_number(
-                        bdb, population_id, generator_id, target)
-                    for target in targets
-                ]
-                colnos_constraints = [
-                    core.bayesdb_variable_number(
-                        bdb, population_id, generator_id, constraint)
-                    for constraint in constraints
-                ]
+        key = expression_key(bql)
+        if key in self.common_exps:
+            out.write(self.common_exps[key])
+        elif row_invariant(bql):
+            # SQLite evaluates an uncorrelated scalar subquery once per
+            # query, rather than once per row like a bare function call.
+            with compiling_paren(bdb, out, '(SELECT ', ')'):
+                super(BQLCompiler_1Row, self).compile_bql(bdb, bql, out)
+        elif isinstance(bql, ast.ExpBQLPredProb):
+            key = row_batch_key(bdb, population_id, generator_id, bql)
+            if key in self.batch_exps:
+                out.write(self.batch_exps[key]['predprob'])
+                return
+            colnos_targets, colnos_constraints = predprob_colnos(
+                bdb, population_id, generator_id, bql)
             out.write('bql_row_column_predictive_probability(%d, %s, %s' %(
                 population_id, nullor(generator_id), nullorq(modelnos)))
             out.write(', %s, \'%s\', \'%s\')' % (
@@ -1265,13 +1302,22 @@ class BQLCompiler_1Row_Infer(BQLCompiler_1Row):
         generator_id = self.generator_id
         modelnos = self.modelnos
         rowid_col = '_rowid_' # XXX Don't hard-code this.
-        if isinstance(bql, ast.ExpBQLPredict):
+        if expression_key(bql) in self.common_exps:
+            out.write(self.common_exps[expression_key(bql)])
+        elif isinstance(bql, ast.ExpBQLPredict):
             assert bql.column is not None
             if not core.bayesdb_has_variable(bdb, population_id, generator_id,
                     bql.column):
                 population = core.bayesdb_population_name(bdb, population_id)
                 raise BQLError(bdb, 'No such column in population %s: %s' %
                     (population, bql.column))
+            key = row_batch_key(bdb, population_id, generator_id, bql)
+            if key in self.batch_exps:
+                columns = self.batch_exps[key]
+                out.write('CASE WHEN %s < ' % (columns['confidence'],))
+                compile_expression(bdb, bql.confidence, self, out)
+                out.write(' THEN NULL ELSE %s END' % (columns['value'],))
+                return
             colno = core.bayesdb_variable_number(bdb, population_id,
                 generator_id, bql.column)
             out.write('bql_predict(%d, %s, %s' %
@@ -1291,6 +1337,10 @@ class BQLCompiler_1Row_Infer(BQLCompiler_1Row):
                 population = core.bayesdb_population_name(bdb, population_id)
                 raise BQLError(bdb, 'No such variable in population %s: %s' %
                     (population, bql.column))
+            key = row_batch_key(bdb, population_id, generator_id, bql)
+            if key in self.batch_exps:
+                out.write(self.batch_exps[key]['prediction'])
+                return
             colno = core.bayesdb_variable_number(bdb, population_id,
                 generator_id, bql.column)
             out.write('bql_predict_confidence(%d, %s, %s' %
@@ -1306,17 +1356,19 @@ class BQLCompiler_1Row_Infer(BQLCompiler_1Row):
 
 class BQLCompiler_2Row(IBQLCompiler):
     def __init__(self, population_id, generator_id, modelnos, rowid0_exp,
-            rowid1_exp):
+            rowid1_exp, similarity_exps=None):
         assert isinstance(population_id, int)
         assert generator_id is None or isinstance(generator_id, int)
         assert modelnos is None or isinstance(modelnos, list)
         assert isinstance(rowid0_exp, str)
         assert isinstance(rowid1_exp, str)
+        assert similarity_exps is None or isinstance(similarity_exps, dict)
         self.population_id = population_id
         self.generator_id = generator_id
         self.modelnos = modelnos
         self.rowid0_exp = rowid0_exp
         self.rowid1_exp = rowid1_exp
+        self.similarity_exps = similarity_exps or {}
 
     @override(IBQLCompiler)
     def implicit_reference_var_colno_exp(self, bdb):
@@ -1341,6 +1393,11 @@ class BQLCompiler_2Row(IBQLCompiler):
             if bql.ofcondition is not None or bql.tocondition is not None:
                 raise BQLError(bdb, 'Similarity needs no row'
                     ' in 2-row context.')
+            colno = similarity_context_colno(
+                bdb, population_id, generator_id, bql)
+            if colno in self.similarity_exps:
+                out.write(self.similarity_exps[colno])
+                return
             out.write('bql_row_similarity(%d, %s, %s' %
                 (population_id, nullor(generator_id), nullorq(modelnos)))
             out.write(', %s, %s' % (self.rowid0_exp, self.rowid1_exp))
@@ -1423,16 +1480,18 @@ class BQLCompiler_1Col(BQLCompiler_Const):
 
 class BQLCompiler_2Col(BQLCompiler_Const):
     def __init__(self, population_id, generator_id, modelnos,
-            colno0_exp, colno1_exp):
+            colno0_exp, colno1_exp, depprob_exp=None):
         assert isinstance(population_id, int)
         assert generator_id is None or isinstance(generator_id, int)
         assert modelnos is None or isinstance(modelnos, list)
         assert isinstance(colno0_exp, str)
         assert isinstance(colno1_exp, str)
+        assert depprob_exp is None or isinstance(depprob_exp, str)
         super(BQLCompiler_2Col, self).__init__(population_id, generator_id,
             modelnos)
         self.colno0_exp = colno0_exp
         self.colno1_exp = colno1_exp
+        self.depprob_exp = depprob_exp
 
     @override(IBQLCompiler)
     def implicit_reference_var_colno_exp(self, bdb):
@@ -1447,6 +1506,11 @@ class BQLCompiler_2Col(BQLCompiler_Const):
         if isinstance(bql, ast.ExpBQLProbDensity):
             compile_pdf_joint(bdb, population_id, generator_id, modelnos,
                 bql.targets, bql.constraints, self, out)
+        elif isinstance(bql, ast.ExpBQLDepProb) and \
+                self.depprob_exp is not None:
+            if bql.column0 is not None or bql.column1 is not None:
+                raise BQLError(bdb, 'Dependence probability needs no columns.')
+            out.write(self.depprob_exp)
         elif isinstance(bql, ast.ExpBQLDepProb):
             compile_bql_2col_0(bdb, population_id, generator_id, modelnos,
                 'bql_column_dependence_probability',
@@ -1586,6 +1650,459 @@ def compile_similarity(bdb, population_id, generator_id, modelnos, ofcondition,
         bdb, population_id, generator_id, column, bql_compiler, out)
     out.write(')')
 
+def predprob_colnos(bdb, population_id, generator_id, bql):
+    """Return the target and constraint colnos of PREDICTIVE PROBABILITY.
+
+    Raises BQLError if `bql` names no targets, unknown variables, or
+    variables both as targets and as constraints.
+    """
+    assert isinstance(bql, ast.ExpBQLPredProb)
+    if not bql.targets:
+        raise BQLError(bdb, 'Predictive probability at row'
+            ' needs targets.')
+    duplicates = [t for t in bql.targets if t in bql.constraints]
+    if duplicates:
+        raise BQLError(bdb,
+            'Duplicate identifiers in targets and constraints: %s.'
+            % (duplicates,))
+    def report_unknown_variables(colnos):
+        """Throws a BQLError if c in colnos is not in the population."""
+        unknown = [
+            colno for colno in colnos
+            if not core.bayesdb_has_variable(
+                bdb, population_id, generator_id, colno)
+        ]
+        if unknown:
+            population = core.bayesdb_population_name(
+                bdb, population_id)
+            raise BQLError(bdb,
+                'No such variables in population %s: %s' %
+                (population, unknown))
+    # If * in targets, use all variables except those in constraints.
+    if ast.ColListAll() in bql.targets:
+        if len(bql.targets) > 1:
+            raise BQLError(bdb,'Cannot use (*) with other targets.')
+        # Use generator_id as not to retrieve latent variables.
+        constraints = [c.columns[0] for c in bql.constraints]
+        report_unknown_variables(constraints)
+        colnos_all = core.bayesdb_variable_numbers(
+            bdb, population_id, None)
+        colnos_constraints = [
+            core.bayesdb_variable_number(
+                bdb, population_id, generator_id, constraint)
+            for constraint in constraints
+        ]
+        colnos_targets = [
+            colno for colno in colnos_all
+            if colno not in colnos_constraints
+        ]
+    # If * in constraints, use all variables except those in targets.
+    elif ast.ColListAll() in bql.constraints:
+        if len(bql.constraints) > 1:
+            raise BQLError(bdb,'Cannot use (*) with other constraints.')
+        colnos_all = core.bayesdb_variable_numbers(
+            bdb, population_id, None)
+        targets = [c.columns[0] for c in bql.targets]
+        report_unknown_variables(targets)
+        colnos_targets = [
+            core.bayesdb_variable_number(
+                bdb, population_id, generator_id, target)
+            for target in targets
+        ]
+        colnos_constraints = [
+            colno for colno in colnos_all
+            if colno not in colnos_targets
+        ]
+    # If no *, use the variables exactly as specified in the query.
+    else:
+        targets = [c.columns[0] for c in bql.targets]
+        constraints = [c.columns[0] for c in bql.constraints]
+        report_unknown_variables(targets)
+        report_unknown_variables(constraints)
+        colnos_targets = [
+            core.bayesdb_variable_number(
+                bdb, population_id, generator_id, target)
+            for target in targets
+        ]
+        colnos_constraints = [
+            core.bayesdb_variable_number(
+                bdb, population_id, generator_id, constraint)
+            for constraint in constraints
+        ]
+    return colnos_targets, colnos_constraints
+
+def row_batch_key(bdb, population_id, generator_id, exp):
+    """Return the key of the batch stage that can compute 1-row `exp`.
+
+    Returns None unless `exp` is PREDICTIVE PROBABILITY, or PREDICT or
+    PREDICT CONFIDENCE of a known variable with a constant number of
+    samples.  Expressions with the same key share a stage.
+    """
+    if isinstance(exp, ast.ExpBQLPredProb):
+        colnos_targets, colnos_constraints = predprob_colnos(
+            bdb, population_id, generator_id, exp)
+        return ('predprob',
+            json.dumps(colnos_targets), json.dumps(colnos_constraints))
+    elif isinstance(exp, (ast.ExpBQLPredict, ast.ExpBQLPredictConf)):
+        if not core.bayesdb_has_variable(
+                bdb, population_id, generator_id, exp.column):
+            return None
+        colno = core.bayesdb_variable_number(
+            bdb, population_id, generator_id, exp.column)
+        if exp.nsamples is None:
+            nsamples = None
+        elif isinstance(exp.nsamples, ast.ExpLit) and \
+                isinstance(exp.nsamples.value, ast.LitInt):
+            nsamples = exp.nsamples.value.value
+        else:
+            return None
+        return ('prediction', colno, nsamples)
+    else:
+        return None
+
+def row_batches(bdb, population_id, generator_id, columns, expressions,
+        infer):
+    """Return the keys of the batch stages for a 1-row query.
+
+    `columns` are the query's select columns and `expressions` the
+    rest of its expressions, in which to find PREDICTIVE PROBABILITY,
+    and, if `infer` is true, PREDICT.  Returns no stages if the query
+    selects `*`, which would select the stages' columns too.
+    """
+    if any(isinstance(selcol, ast.SelColAll) for selcol in columns):
+        return []
+    batches = []
+    for exp in row_expressions(columns, expressions, infer):
+        for subexp in expression_subexpressions(exp):
+            if not infer and isinstance(subexp,
+                    (ast.ExpBQLPredict, ast.ExpBQLPredictConf)):
+                continue
+            key = row_batch_key(bdb, population_id, generator_id, subexp)
+            if key is not None and key not in batches:
+                batches.append(key)
+    return batches
+
+def row_expressions(columns, expressions, infer):
+    """Return the expressions of a 1-row query's select `columns`,
+    followed by its other `expressions`.
+
+    If `infer` is true, PREDICT columns count as PREDICT CONFIDENCE.
+    """
+    expressions = [selcol.expression for selcol in columns
+        if isinstance(selcol, ast.SelColExp)] + list(expressions)
+    if infer:
+        expressions += [ast.ExpBQLPredictConf(selcol.column, selcol.nsamples)
+            for selcol in columns if isinstance(selcol, ast.PredCol)]
+    return expressions
+
+def row_batch_exps(batches):
+    """Return a dict mapping each batch stage to its columns by name."""
+    batch_exps = {}
+    for i, key in enumerate(batches):
+        if key[0] == 'predprob':
+            names = ['predprob']
+        else:
+            names = ['value', 'confidence', 'prediction']
+        batch_exps[key] = {name: 'bql_%s%d' % (name, i) for name in names}
+    return batch_exps
+
+def compile_row_batches(bdb, population_id, generator_id, modelnos,
+        batches, out):
+    """Compile the FROM clause of a 1-row query with batch stages.
+
+    Row-wise PREDICTIVE PROBABILITY and PREDICT are computed for many
+    rows at once by joining the population's table with bql_predprob
+    and bql_prediction virtual tables by rowid, rather than calling the
+    backend one row at a time.  The join is wrapped in a subquery named
+    after the table, with the table's columns and rowid, so that the
+    rest of the query reads as if it were on the table alone.
+    """
+    table_name = core.bayesdb_population_table(bdb, population_id)
+    qt = sqlite3_quote_name(table_name)
+    if not batches:
+        out.write(' FROM %s' % (qt,))
+        return
+    batch_exps = row_batch_exps(batches)
+    out.write(' FROM (SELECT %s.*' % (qt,))
+    for token in ['_rowid_', 'rowid', 'oid']:
+        out.write(', %s._rowid_ AS %s' % (qt, token))
+    for i, key in enumerate(batches):
+        for name, column in sorted(batch_exps[key].items()):
+            out.write(', b%d.%s AS %s' % (i, name, column))
+    out.write(' FROM %s' % (qt,))
+    for i, key in enumerate(batches):
+        if key[0] == 'predprob':
+            out.write(', bql_predprob AS b%d' % (i,))
+        else:
+            out.write(', bql_prediction AS b%d' % (i,))
+    conjunction = ' WHERE '
+    for i, key in enumerate(batches):
+        out.write('%sb%d.population_id = %d' % (conjunction, i, population_id))
+        conjunction = ' AND '
+        if generator_id is not None:
+            out.write(' AND b%d.generator_id = %d' % (i, generator_id))
+        if modelnos is not None:
+            out.write(' AND b%d.modelnos = %s' % (i, nullorq(modelnos)))
+        if key[0] == 'predprob':
+            _predprob, targets, constraints = key
+            out.write(' AND b%d.targets = \'%s\'' % (i, targets))
+            out.write(' AND b%d.constraints = \'%s\'' % (i, constraints))
+        else:
+            _prediction, colno, nsamples = key
+            out.write(' AND b%d.colno = %d' % (i, colno))
+            if nsamples is not None:
+                out.write(' AND b%d.numsamples = %d' % (i, nsamples))
+        out.write(' AND b%d.table_rowid = %s._rowid_' % (i, qt))
+    out.write(') AS %s' % (qt,))
+
+def row_commons(bdb, population_id, generator_id, columns, expressions,
+        batches, infer):
+    """Return the BQL expressions a 1-row query computes more than once.
+
+    Returns a list of ``(<key>, <expression>)`` pairs, keyed by
+    :func:`expression_key`, of the row-wise BQL expressions that occur
+    more than once among the query's select `columns` and other
+    `expressions`.  Row-invariant expressions, which are computed once
+    per query, and expressions computed by the `batches` stages, which
+    are computed once per row anyway, are excluded.  Returns none if
+    the query selects `*`, like :func:`row_batches`.
+    """
+    if any(isinstance(selcol, ast.SelColAll) for selcol in columns):
+        return []
+    counts = {}
+    commons = []
+    for exp in row_expressions(columns, expressions, infer):
+        for subexp in expression_subexpressions(exp):
+            if not ast.is_bql(subexp):
+                continue
+            if not infer and isinstance(subexp,
+                    (ast.ExpBQLPredict, ast.ExpBQLPredictConf)):
+                continue
+            if row_invariant(subexp) or not row_local(subexp):
+                continue
+            if row_batch_key(bdb, population_id, generator_id, subexp) \
+                    in batches:
+                continue
+            key = expression_key(subexp)
+            if key not in counts:
+                counts[key] = 0
+                commons.append((key, subexp))
+            counts[key] += 1
+    return [(key, exp) for key, exp in commons if 1 < counts[key]]
+
+def row_common_exps(commons):
+    """Return a dict mapping each common expression's key to its name."""
+    return {key: 'bql_exp%d' % (i,) for i, (key, _exp) in enumerate(commons)}
+
+def compile_row_from(bdb, population_id, generator_id, modelnos, batches,
+        commons, condition, bql_compiler, out, limit=None):
+    """Compile the FROM and WHERE clauses of a 1-row query.
+
+    Each of the `commons` expressions is computed once per row in a
+    subquery named after the table, and referred to by name outside
+    it.  Conjuncts of `condition` that do not refer to them filter the
+    rows inside the subquery, before they are computed.  Conjuncts are
+    evaluated cheapest first, by :func:`cheapest_conjuncts`.
+
+    If `limit` is an ``(<order>, <limit>)`` pair, the rows are
+    filtered by `condition`, ordered, and limited first, by
+    :func:`compile_row_limit`; the caller must then order them again,
+    and must not limit them again.
+    """
+    if limit is not None:
+        assert not batches
+    if not commons:
+        if limit is not None:
+            compile_row_limit(bdb, population_id, condition, limit[0],
+                limit[1], bql_compiler, out)
+            return
+        compile_row_batches(bdb, population_id, generator_id, modelnos,
+            batches, out)
+        if condition is not None:
+            conjuncts = expression_conjuncts(condition)
+            ordered = cheapest_conjuncts(conjuncts, bql_compiler.common_exps)
+            if ordered == conjuncts:
+                out.write(' WHERE ')
+                compile_expression(bdb, condition, bql_compiler, out)
+            else:
+                compile_conjunction(bdb, ordered, bql_compiler, out)
+        return
+    table_name = core.bayesdb_population_table(bdb, population_id)
+    qt = sqlite3_quote_name(table_name)
+    common_exps = bql_compiler.common_exps
+    inner_compiler = copy.copy(bql_compiler)
+    inner_compiler.common_exps = {}
+    inner_conjuncts = []
+    outer_conjuncts = []
+    if condition is not None and limit is None:
+        for conjunct in expression_conjuncts(condition):
+            if any(expression_key(subexp) in common_exps
+                    for subexp in expression_subexpressions(conjunct)):
+                outer_conjuncts.append(conjunct)
+            else:
+                inner_conjuncts.append(conjunct)
+    out.write(' FROM (SELECT %s.*' % (qt,))
+    if not batches and limit is None:
+        for token in ['_rowid_', 'rowid', 'oid']:
+            out.write(', %s._rowid_ AS %s' % (qt, token))
+    for key, exp in commons:
+        out.write(', ')
+        compile_expression(bdb, exp, inner_compiler, out)
+        out.write(' AS %s' % (common_exps[key],))
+    if limit is not None:
+        compile_row_limit(bdb, population_id, condition, limit[0], limit[1],
+            inner_compiler, out)
+    else:
+        compile_row_batches(bdb, population_id, generator_id, modelnos,
+            batches, out)
+    compile_conjunction(bdb, cheapest_conjuncts(inner_conjuncts, {}),
+        inner_compiler, out)
+    # A subquery with a LIMIT or OFFSET is never flattened into the
+    # query around it, which would copy each expression back into
+    # every place that refers to it.
+    out.write(' LIMIT -1 OFFSET 0) AS %s' % (qt,))
+    compile_conjunction(bdb, cheapest_conjuncts(outer_conjuncts, common_exps),
+        bql_compiler, out)
+
+def compile_conjunction(bdb, conjuncts, bql_compiler, out):
+    for i, conjunct in enumerate(conjuncts):
+        out.write(' AND ' if i else ' WHERE ')
+        compile_expression(bdb, conjunct, bql_compiler, out)
+
+# Static cost of computing a row-wise BQL function for one row, in rough
+# units of model evaluations: densities are cheaper than simulations,
+# which are cheaper than estimates of information.
+bql_row_costs = {
+    ast.ExpBQLPredProb:         1,
+    ast.ExpBQLProbDensity:      1,
+    ast.ExpBQLSim:              1,
+    ast.ExpBQLPredict:          2,
+    ast.ExpBQLPredictConf:      2,
+    ast.ExpBQLPredRel:          2,
+    ast.ExpBQLMutInf:           3,
+    ast.ExpBQLProbEst:          3,
+}
+
+def condition_cost(exp, common_exps):
+    """Return the static cost of evaluating condition `exp` for one row.
+
+    Row-invariant BQL functions are computed once per query, and the
+    `common_exps` once per row whether or not the condition is
+    evaluated, so they are free, as is plain SQL.
+    """
+    cost = 0
+    for subexp in expression_subexpressions(exp):
+        if not ast.is_bql(subexp) or row_invariant(subexp):
+            continue
+        if expression_key(subexp) in common_exps:
+            continue
+        cost += bql_row_costs.get(type(subexp), 1)
+    return cost
+
+def cheapest_conjuncts(conjuncts, common_exps):
+    """Return `conjuncts` in order of increasing :func:`condition_cost`.
+
+    SQLite evaluates the terms of a WHERE clause in order, skipping
+    the rest for a row as soon as one fails, so putting plain SQL
+    first and the costliest BQL last spares the model rows that a
+    cheaper term would have dropped.  Conjuncts of equal cost keep
+    their order.
+    """
+    return sorted(conjuncts,
+        key=lambda conjunct: condition_cost(conjunct, common_exps))
+
+def row_late(query, infer):
+    """True if a 1-row `query` can be limited before computing BQL.
+
+    That is, if it has a LIMIT, computes row-wise BQL functions only
+    in its select columns, and filters and orders rows by plain SQL
+    alone -- so that the rows that survive the LIMIT can be found
+    before computing anything for them.  Aggregates, GROUP BY, and
+    DISTINCT need every row; ORDER BY by select column number or name
+    cannot be computed before the select columns.  Function
+    applications in select columns may be aggregates.
+    """
+    if query.limit is None or query.grouping is not None:
+        return False
+    if isinstance(query, ast.Estimate) and \
+            query.quantifier == ast.SELQUANT_DISTINCT:
+        return False
+    if any(isinstance(selcol, ast.SelColAll) for selcol in query.columns):
+        return False
+    names = set()
+    for selcol in query.columns:
+        if isinstance(selcol, ast.SelColExp) and selcol.name is not None:
+            names.add(casefold(selcol.name))
+        elif isinstance(selcol, ast.PredCol):
+            names.add(casefold(selcol.column if selcol.name is None
+                else selcol.name))
+            if selcol.confname is not None:
+                names.add(casefold(selcol.confname))
+    late = False
+    for exp in row_expressions(query.columns, [], infer):
+        for subexp in expression_subexpressions(exp):
+            if isinstance(subexp, (ast.ExpApp, ast.ExpAppStar)):
+                return False
+            if ast.is_bql(subexp) and not row_invariant(subexp):
+                late = True
+    for exp in query_expressions(query):
+        for subexp in expression_subexpressions(exp):
+            if ast.is_bql(subexp) and not row_invariant(subexp):
+                return False
+    for term in query.order or []:
+        if isinstance(term.expression, ast.ExpLit):
+            return False
+        if isinstance(term.expression, ast.ExpCol) and \
+                term.expression.table is None and \
+                casefold(term.expression.column) in names:
+            return False
+    return late
+
+def compile_row_limit(bdb, population_id, condition, order, limit,
+        bql_compiler, out):
+    """Compile the FROM clause of a 1-row query limited before BQL.
+
+    The rows are filtered by `condition`, ordered by `order`, and
+    limited by `limit` in a subquery named after the table, with the
+    table's columns and rowid, so that the BQL functions in the select
+    columns are computed only for the rows that survive.
+    """
+    table_name = core.bayesdb_population_table(bdb, population_id)
+    qt = sqlite3_quote_name(table_name)
+    out.write(' FROM (SELECT %s.*' % (qt,))
+    for token in ['_rowid_', 'rowid', 'oid']:
+        out.write(', %s._rowid_ AS %s' % (qt, token))
+    out.write(' FROM %s' % (qt,))
+    if condition is not None:
+        out.write(' WHERE ')
+        compile_expression(bdb, condition, bql_compiler, out)
+    if order is not None:
+        compile_order_by(bdb, order, bql_compiler, out)
+    compile_limit(bdb, limit, bql_compiler, out)
+    out.write(') AS %s' % (qt,))
+
+def similarity_context_colno(bdb, population_id, generator_id, exp):
+    """Return the context variable of a 2-row SIMILARITY `exp`.
+
+    Returns None unless `exp` is SIMILARITY of no particular rows in
+    the context of a single known variable.
+    """
+    if not isinstance(exp, ast.ExpBQLSim):
+        return None
+    if exp.ofcondition is not None or exp.tocondition is not None:
+        return None
+    if exp.column is None or len(exp.column) != 1:
+        return None
+    if not isinstance(exp.column[0], ast.ColListLit):
+        return None
+    if len(exp.column[0].columns) != 1:
+        return None
+    column = exp.column[0].columns[0]
+    if not core.bayesdb_has_variable(bdb, population_id, generator_id, column):
+        return None
+    return core.bayesdb_variable_number(
+        bdb, population_id, generator_id, column)
+
 def compile_predictive_relevance_2row_2(bdb, population_id, generator_id,
         modelnos, ofcondition, tocondition, hypotheticals, column,
         bql_compiler, out):
@@ -1779,6 +2296,140 @@ def compile_bql_2col_0(bdb, population_id, generator_id, modelnos, bqlfn,
         extra(bdb, population_id, generator_id, bql, bql_compiler, out)
     out.write(')')
 
+def query_expressions(query):
+    """Return the expressions of the WHERE, GROUP BY, HAVING, and ORDER
+    BY clauses of a 1-row `query`."""
+    expressions = []
+    if query.condition is not None:
+        expressions.append(query.condition)
+    if query.grouping is not None:
+        expressions.extend(query.grouping.keys)
+        if query.grouping.condition:
+            expressions.append(query.grouping.condition)
+    if query.order is not None:
+        expressions.extend(order.expression for order in query.order)
+    return expressions
+
+def expression_subexpressions(exp):
+    """Yield `exp` and its subexpressions, outermost first.
+
+    Does not descend into subqueries, which are compiled in their own
+    context, nor into the arguments of BQL functions.
+    """
+    yield exp
+    for child in expression_children(exp):
+        for subexp in expression_subexpressions(child):
+            yield subexp
+
+def expression_children(exp):
+    """Return the immediate non-BQL subexpressions of `exp`."""
+    if isinstance(exp, (ast.ExpCollate, ast.ExpInQuery, ast.ExpCast)):
+        return [exp.expression]
+    elif isinstance(exp, ast.ExpInExp):
+        return [exp.expression] + list(exp.expressions)
+    elif isinstance(exp, (ast.ExpApp, ast.ExpOp)):
+        return list(exp.operands)
+    elif isinstance(exp, ast.ExpCase):
+        children = [] if exp.key is None else [exp.key]
+        for condition, result in exp.whens:
+            children += [condition, result]
+        if exp.otherwise is not None:
+            children.append(exp.otherwise)
+        return children
+    else:
+        return []
+
+def row_invariant(exp):
+    """True if `exp` has the same value in every row of a 1-row query.
+
+    Column references and subqueries may vary by row, and so may
+    function applications, which may be aggregates or nondeterministic.
+    Of the BQL functions, only those of columns, and probability
+    densities of constant values, are invariant.
+    """
+    if isinstance(exp, (ast.ExpLit, ast.ExpNumpar, ast.ExpNampar)):
+        return True
+    elif isinstance(exp,
+            (ast.ExpOp, ast.ExpCollate, ast.ExpCast, ast.ExpInExp,
+             ast.ExpCase)):
+        return all(row_invariant(child) for child in expression_children(exp))
+    elif isinstance(exp,
+            (ast.ExpBQLDepProb, ast.ExpBQLCorrel, ast.ExpBQLCorrelPval,
+             ast.ExpBQLMutInf, ast.ExpBQLProbDensity)):
+        return all(row_invariant(e) for e in bql_arguments(exp))
+    else:
+        return False
+
+def row_local(exp):
+    """True if `exp` can be computed from one row of a 1-row query alone.
+
+    Subqueries and function applications, which may be aggregates, are
+    not row-local.
+    """
+    if isinstance(exp, (ast.ExpLit, ast.ExpNumpar, ast.ExpNampar, ast.ExpCol)):
+        return True
+    elif isinstance(exp,
+            (ast.ExpOp, ast.ExpCollate, ast.ExpCast, ast.ExpInExp,
+             ast.ExpCase)):
+        return all(row_local(child) for child in expression_children(exp))
+    elif ast.is_bql(exp):
+        arguments = bql_arguments(exp)
+        return arguments is not None and all(map(row_local, arguments))
+    else:
+        return False
+
+def bql_arguments(exp):
+    """Return the expressions given as arguments to BQL function `exp`.
+
+    Conditions naming rows are compiled as subqueries of their own, and
+    are not arguments.  Returns None for BQL functions that are macros
+    or are not functions of rows.
+    """
+    if isinstance(exp, (ast.ExpBQLPredProb, ast.ExpBQLSim, ast.ExpBQLDepProb,
+            ast.ExpBQLCorrel, ast.ExpBQLCorrelPval)):
+        return []
+    elif isinstance(exp, ast.ExpBQLProbDensity):
+        return [e for _col, e in list(exp.targets) + list(exp.constraints)]
+    elif isinstance(exp, ast.ExpBQLPredRel):
+        return [e for values in exp.hypotheticals or [] for _col, e in values]
+    elif isinstance(exp, ast.ExpBQLMutInf):
+        exps = [e for _col, e in exp.constraints or []]
+        if exp.nsamples:
+            exps.append(exp.nsamples)
+        return exps
+    elif isinstance(exp, ast.ExpBQLPredict):
+        exps = [exp.confidence]
+        if exp.nsamples is not None:
+            exps.append(exp.nsamples)
+        return exps
+    elif isinstance(exp, ast.ExpBQLPredictConf):
+        return [] if exp.nsamples is None else [exp.nsamples]
+    else:
+        return None
+
+def expression_key(exp):
+    """Return a hashable key for `exp`, equal for equivalent expressions.
+
+    Names are compared case-insensitively; string literals are not.
+    """
+    if isinstance(exp, ast.LitString):
+        return exp
+    elif isinstance(exp, tuple):
+        return (type(exp).__name__,) + tuple(map(expression_key, exp))
+    elif isinstance(exp, list):
+        return tuple(map(expression_key, exp))
+    elif isinstance(exp, basestring):
+        return casefold(exp)
+    else:
+        return exp
+
+def expression_conjuncts(exp):
+    """Return the list of expressions whose conjunction is `exp`."""
+    if isinstance(exp, ast.ExpOp) and exp.operator == ast.OP_BOOLAND:
+        return [conjunct for operand in exp.operands
+            for conjunct in expression_conjuncts(operand)]
+    return [exp]
+
 def compile_nobql_expression(bdb, exp, out):
     bql_compiler = BQLCompiler_None()
     compile_expression(bdb, exp, bql_compiler, out)
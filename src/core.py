@@ -42,10 +42,112 @@ modelno)`` or ``(generator_name, modelno)``.
 """
 
 from bayeslite.exception import BQLError
+from bayeslite.sqlite3_util import sqlite3_exec_1
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
 from bayeslite.util import cursor_value
 
+class _Catalog(object):
+    """In-memory copy of the populations, generators, and variables.
+
+    Loaded in bulk on first use by :func:`_catalog`, and discarded when
+    anything is written through the connection, when a transaction is
+    rolled back, or when another connection changes the database.
+    """
+
+    def __init__(self, bdb):
+        self.changes = bdb._sqlite3.totalchanges()
+        self.versions = _catalog_versions(bdb)
+        self.populations = {}       # population id -> (name, table)
+        self.population_ids = {}    # folded name -> population id
+        self.generators = {}        # generator id -> (name, popid, backend)
+        self.generator_ids = {}     # folded name -> generator id
+        self.variables = {}         # (popid, colno) -> (genid, name, stattype)
+        self.variable_colnos = {}   # (popid, genid, folded name) -> colno
+        self.variable_numbers = {}  # (popid, genid) -> sorted colnos
+        cursor = bdb.sql_execute(
+            'SELECT id, name, tabname FROM bayesdb_population')
+        for population_id, name, table in cursor:
+            self.populations[population_id] = (name, table)
+            self.population_ids[casefold(name)] = population_id
+        cursor = bdb.sql_execute(
+            'SELECT id, name, population_id, backend FROM bayesdb_generator')
+        for generator_id, name, population_id, backend in cursor:
+            self.generators[generator_id] = (name, population_id, backend)
+            self.generator_ids[casefold(name)] = generator_id
+        cursor = bdb.sql_execute('SELECT population_id, generator_id, colno,'
+            ' name, stattype FROM bayesdb_variable')
+        for population_id, generator_id, colno, name, stattype in cursor:
+            self.add_variable(population_id, generator_id, colno, name,
+                stattype)
+
+    def add_variable(self, population_id, generator_id, colno, name,
+            stattype):
+        self.variables[population_id, colno] = (generator_id, name, stattype)
+        self.variable_colnos[population_id, generator_id, casefold(name)] = \
+            colno
+        self.variable_numbers.clear()
+
+    def variable(self, population_id, generator_id, colno):
+        variable = self.variables.get((population_id, colno))
+        if variable is None:
+            return None
+        if variable[0] is not None and variable[0] != generator_id:
+            return None
+        return variable
+
+    def variable_colno(self, population_id, generator_id, name):
+        if not isinstance(name, (str, unicode)):
+            return None
+        name = casefold(name)
+        colno = self.variable_colnos.get((population_id, None, name))
+        if colno is None and generator_id is not None:
+            colno = self.variable_colnos.get((population_id, generator_id, name))
+        return colno
+
+def _catalog_versions(bdb):
+    # Changes committed by other connections bump data_version;
+    # changes to any table definitions bump schema_version.
+    return (
+        sqlite3_exec_1(bdb._sqlite3, 'PRAGMA schema_version'),
+        sqlite3_exec_1(bdb._sqlite3, 'PRAGMA data_version'),
+    )
+
+def _catalog(bdb):
+    """Return the in-memory catalog of `bdb`, reloading it if stale.
+
+    Within a transaction, other connections cannot change what we see,
+    so the versions need be checked only once per transaction.
+    """
+    catalog = bdb._catalog
+    if catalog is not None and \
+            catalog.changes != bdb._sqlite3.totalchanges():
+        catalog = None
+    cache = bdb._cache
+    if catalog is not None and \
+            (cache is None or cache.get('catalog') is not catalog) and \
+            catalog.versions != _catalog_versions(bdb):
+        catalog = None
+    if catalog is None:
+        catalog = bdb._catalog = _Catalog(bdb)
+    if cache is not None:
+        cache['catalog'] = catalog
+    return catalog
+
+def _catalog_add_variable(bdb, population_id, generator_id, colno, name,
+        stattype):
+    # If the catalog was current until we inserted the variable, keep
+    # it current rather than discarding it.
+    catalog = bdb._catalog
+    if catalog is not None and \
+            catalog.changes + 1 == bdb._sqlite3.totalchanges():
+        catalog.add_variable(population_id, generator_id, colno, name,
+            stattype)
+        catalog.changes += 1
+
+def _catalog_key(name):
+    return casefold(name) if isinstance(name, (str, unicode)) else name
+
 def bayesdb_has_table(bdb, name):
     """True if there is a table named `name` in `bdb`.
 
@@ -202,8 +304,7 @@ def bayesdb_table_has_rowid(bdb, table, rowid):
 
 def bayesdb_has_population(bdb, name):
     """True if there is a population named `name` in `bdb`."""
-    sql = 'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?'
-    return 0 != cursor_value(bdb.sql_execute(sql, (name,)))
+    return _catalog_key(name) in _catalog(bdb).population_ids
 
 def bayesdb_get_population(bdb, name):
     """Return the id of the population named `name` in `bdb`.
@@ -214,44 +315,40 @@ def bayesdb_get_population(bdb, name):
     `bdb` must have a population named `name`.  If you're not sure,
     call :func:`bayesdb_has_population` first.
     """
-    sql = 'SELECT id FROM bayesdb_population WHERE name = ?'
-    cursor = bdb.sql_execute(sql, (name,))
+    population_ids = _catalog(bdb).population_ids
     try:
-        row = cursor.next()
-    except StopIteration:
+        population_id = population_ids[_catalog_key(name)]
+    except KeyError:
         raise ValueError('No such population: %r' % (repr(name),))
     else:
-        assert isinstance(row[0], int)
-        return row[0]
+        assert isinstance(population_id, int)
+        return population_id
 
 def bayesdb_population_name(bdb, population_id):
     """Return the name of the population with given `population_id`."""
-    sql = 'SELECT name FROM bayesdb_population WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (population_id,))
     try:
-        row = cursor.next()
-    except StopIteration:
+        name, _table = _catalog(bdb).populations[population_id]
+    except KeyError:
         raise ValueError('No such population id: %r' % (repr(population_id),))
     else:
-        return row[0]
+        return name
 
 def bayesdb_population_table(bdb, population_id):
     """Return the name of table of the population with id `id`."""
-    sql = 'SELECT tabname FROM bayesdb_population WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (population_id,))
     try:
-        row = cursor.next()
-    except StopIteration:
+        _name, table = _catalog(bdb).populations[population_id]
+    except KeyError:
         raise ValueError('No such population id: %r' % (repr(population_id),))
     else:
-        return row[0]
+        return table
 
 def bayesdb_population_generators(bdb, population_id):
     """Return list of generators for population_id."""
-    cursor = bdb.sql_execute('''
-        SELECT id FROM bayesdb_generator WHERE population_id = ?
-    ''', (population_id,))
-    return [generator_id for (generator_id,) in cursor]
+    generators = _catalog(bdb).generators
+    return sorted(generator_id
+        for generator_id, (_name, generator_population_id, _backend)
+            in generators.iteritems()
+        if generator_population_id == population_id)
 
 def bayesdb_population_is_implicit(bdb, population_id):
     """True if the population with id `id` is implicit."""
@@ -301,6 +398,7 @@ def bayesdb_add_variable(bdb, population_id, name, stattype):
             (population_id, name, colno, stattype)
             VALUES (?, ?, ?, ?)
     ''', (population_id, name, colno, stattype))
+    _catalog_add_variable(bdb, population_id, None, colno, name, stattype)
 
 def bayesdb_has_variable(bdb, population_id, generator_id, name):
     """True if the population has a given variable.
@@ -308,23 +406,17 @@ def bayesdb_has_variable(bdb, population_id, generator_id, name):
     generator_id is None for manifest variables and the id of a
     generator for variables that may be latent.
     """
-    cursor = bdb.sql_execute('''
-        SELECT COUNT(*) FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-                AND name = ?
-    ''', (population_id, generator_id, name))
-    return cursor_value(cursor) != 0
+    catalog = _catalog(bdb)
+    return catalog.variable_colno(population_id, generator_id, name) \
+        is not None
 
 def bayesdb_variable_number(bdb, population_id, generator_id, name):
     """Return the column number of a population variable."""
-    cursor = bdb.sql_execute('''
-        SELECT colno FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-                AND name = ?
-    ''', (population_id, generator_id, name))
-    return cursor_value(cursor)
+    colno = _catalog(bdb).variable_colno(population_id, generator_id, name)
+    if colno is None:
+        raise ValueError('No such variable in population %r: %r'
+            % (population_id, name))
+    return colno
 
 def bayesdb_variable_names(bdb, population_id, generator_id):
     """Return a list of the names of columns modeled in `population_id`."""
@@ -334,45 +426,36 @@ def bayesdb_variable_names(bdb, population_id, generator_id):
 
 def bayesdb_variable_numbers(bdb, population_id, generator_id):
     """Return a list of the numbers of columns modeled in `population_id`."""
-    cursor = bdb.sql_execute('''
-        SELECT colno FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-            ORDER BY colno ASC
-    ''', (population_id, generator_id))
-    return [colno for (colno,) in cursor]
+    catalog = _catalog(bdb)
+    key = (population_id, generator_id)
+    if key not in catalog.variable_numbers:
+        catalog.variable_numbers[key] = sorted(colno
+            for (variable_population_id, colno) in catalog.variables
+            if variable_population_id == population_id
+                and catalog.variable(population_id, generator_id, colno)
+                    is not None)
+    return list(catalog.variable_numbers[key])
 
 def bayesdb_variable_name(bdb, population_id, generator_id, colno):
     """Return the name of a population variable."""
-    cursor = bdb.sql_execute('''
-        SELECT name FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-                AND colno = ?
-    ''', (population_id, generator_id, colno))
-    return cursor_value(cursor)
+    variable = _catalog(bdb).variable(population_id, generator_id, colno)
+    if variable is None:
+        raise ValueError('No such variable in population %r: %r'
+            % (population_id, colno))
+    _generator_id, name, _stattype = variable
+    return name
 
 def bayesdb_colno_to_variable_names(bdb, population_id, generator_id):
     """Return a dictionary that maps column number to variable name in population."""
-    cursor = bdb.sql_execute('''
-        SELECT colno, name FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-    ''', (population_id, generator_id))
-    return {colno: name for (colno, name) in cursor}
+    catalog = _catalog(bdb)
+    colnos = bayesdb_variable_numbers(bdb, population_id, generator_id)
+    return {colno: catalog.variables[population_id, colno][1]
+        for colno in colnos}
 
 def bayesdb_variable_stattype(bdb, population_id, generator_id, colno):
     """Return the statistical type of a population variable."""
-    sql = '''
-        SELECT stattype FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-                AND colno = ?
-    '''
-    cursor = bdb.sql_execute(sql, (population_id, generator_id, colno))
-    try:
-        row = cursor.next()
-    except StopIteration:
+    variable = _catalog(bdb).variable(population_id, generator_id, colno)
+    if variable is None:
         population = bayesdb_population_name(bdb, population_id)
         sql = '''
             SELECT COUNT(*)
@@ -391,9 +474,8 @@ def bayesdb_variable_stattype(bdb, population_id, generator_id, colno):
         else:
             raise ValueError('Variable not modeled in population %s: %d'
                 % (population, colno))
-    else:
-        assert len(row) == 1
-        return row[0]
+    _generator_id, _name, stattype = variable
+    return stattype
 
 def bayesdb_add_latent(bdb, population_id, generator_id, var, stattype):
     """Add a generator's latent variable to a population.
@@ -411,6 +493,8 @@ def bayesdb_add_latent(bdb, population_id, generator_id, var, stattype):
                 (population_id, generator_id, colno, name, stattype)
                 VALUES (?, ?, ?, ?, ?)
         ''', (population_id, generator_id, colno, var, stattype))
+        _catalog_add_variable(bdb, population_id, generator_id, colno, var,
+            stattype)
         return colno
 
 def bayesdb_has_latent(bdb, population_id, var):
@@ -461,16 +545,14 @@ def bayesdb_has_generator(bdb, population_id, name):
     defined for that population. Otherwise, when `population_id` is None, the
     `name` may be of any generator.
     """
-    if population_id is None:
-        sql = 'SELECT COUNT(*) FROM bayesdb_generator WHERE name = ?'
-        cursor = bdb.sql_execute(sql, (name,))
-    else:
-        sql = '''
-            SELECT COUNT(*) FROM bayesdb_generator
-                WHERE name = ? AND population_id = ?
-        '''
-        cursor = bdb.sql_execute(sql, (name, population_id))
-    return 0 != cursor_value(cursor)
+    catalog = _catalog(bdb)
+    generator_id = catalog.generator_ids.get(_catalog_key(name))
+    if generator_id is None:
+        return False
+    _name, generator_population_id, _backend = \
+        catalog.generators[generator_id]
+    return population_id is None or \
+        generator_population_id == population_id
 
 def bayesdb_get_generator(bdb, population_id, name):
     """Return the id of the generator named `name` in `bdb`.
@@ -481,48 +563,34 @@ def bayesdb_get_generator(bdb, population_id, name):
     `bdb` must have a generator named `name`.  If you're not sure,
     call :func:`bayesdb_has_generator` first.
     """
-    if population_id is None:
-        sql = 'SELECT id FROM bayesdb_generator WHERE name = ?'
-        cursor = bdb.sql_execute(sql, (name,))
-    else:
-        sql = '''
-            SELECT id FROM bayesdb_generator
-                WHERE name = ? AND population_id = ?
-        '''
-        cursor = bdb.sql_execute(sql, (name, population_id))
-    try:
-        row = cursor.next()
-    except StopIteration:
+    if not bayesdb_has_generator(bdb, population_id, name):
         raise ValueError('No such generator: %s' % (repr(name),))
-    else:
-        assert isinstance(row[0], int)
-        return row[0]
+    generator_id = _catalog(bdb).generator_ids[_catalog_key(name)]
+    assert isinstance(generator_id, int)
+    return generator_id
 
 def bayesdb_generator_name(bdb, generator_id):
     """Return the name of the generator with given `generator_id`."""
-    sql = 'SELECT name FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (generator_id,))
     try:
-        row = cursor.next()
-    except StopIteration:
+        name, _population_id, _backend = \
+            _catalog(bdb).generators[generator_id]
+    except KeyError:
         raise ValueError('No such generator id: %r' % (repr(generator_id),))
     else:
-        return row[0]
+        return name
 
 def bayesdb_generator_backend(bdb, generator_id):
     """Return the backend of the generator with given `generator_id`."""
-    sql = 'SELECT backend FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (generator_id,))
     try:
-        row = cursor.next()
-    except StopIteration:
+        name, _population_id, backend = \
+            _catalog(bdb).generators[generator_id]
+    except KeyError:
         raise ValueError('No such generator: %s' % (repr(generator_id),))
     else:
-        if row[0] not in bdb.backends:
-            name = bayesdb_generator_name(bdb, generator_id)
+        if backend not in bdb.backends:
             raise ValueError('Backend of generator %s not registered: %s' %
-                (repr(name), repr(row[0])))
-        return bdb.backends[row[0]]
+                (repr(name), repr(backend)))
+        return bdb.backends[backend]
 
 def bayesdb_generator_table(bdb, generator_id):
     """Return name of table of the generator with given `generator_id`."""
@@ -531,15 +599,13 @@ def bayesdb_generator_table(bdb, generator_id):
 
 def bayesdb_generator_population(bdb, generator_id):
     """Return id of population of the generator with given `generator_id`."""
-    sql = 'SELECT population_id FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (generator_id,))
     try:
-        row = cursor.next()
-    except StopIteration:
+        _name, population_id, _backend = \
+            _catalog(bdb).generators[generator_id]
+    except KeyError:
         raise ValueError('No such generator: %s' % (repr(generator_id),))
     else:
-        assert len(row) == 1
-        return row[0]
+        return population_id
 
 def bayesdb_generator_is_implicit(bdb, generator_id):
     """True if the generator with given `generator_id` is implicit."""
@@ -38,6 +38,9 @@ def bayesdb_savepoint(bdb):
     try:
         with sqlite3_savepoint(bdb._sqlite3):
             yield
+    except:
+        bayesdb_txn_rolledback(bdb)
+        raise
     finally:
         bayesdb_txn_pop(bdb)
 
@@ -48,6 +51,7 @@ def bayesdb_savepoint_rollback(bdb):
         with sqlite3_savepoint_rollback(bdb._sqlite3):
             yield
     finally:
+        bayesdb_txn_rolledback(bdb)
         bayesdb_txn_pop(bdb)
 
 @contextlib.contextmanager
@@ -59,6 +63,9 @@ def bayesdb_transaction(bdb):
     try:
         with sqlite3_transaction(bdb._sqlite3):
             yield
+    except:
+        bayesdb_txn_rolledback(bdb)
+        raise
     finally:
         assert bdb._txn_depth == 1
         bdb._txn_depth = 0
@@ -75,6 +82,7 @@ def bayesdb_rollback_transaction(bdb):
     if bdb._txn_depth == 0:
         raise BayesDBTxnError(bdb, 'Not in a transaction!')
     bdb.sql_execute("ROLLBACK")
+    bayesdb_txn_rolledback(bdb)
     bdb._txn_depth = 0
     bayesdb_txn_fini(bdb)
 
@@ -115,6 +123,10 @@ def bayesdb_txn_fini(bdb):
     assert bdb._cache is not None
     bdb._cache = None
 
+def bayesdb_txn_rolledback(bdb):
+    # The in-memory catalog may describe changes that were just undone.
+    bdb._catalog = None
+
 class BayesDBTxnError(BayesDBException):
     """Transaction errors in a BayesDB."""
 
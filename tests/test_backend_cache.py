@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import gc
+
+from bayeslite.backends.cache import BackendCache
+
+class Handle(object):
+    pass
+
+def test_backend_cache_lru():
+    evicted = []
+    cache = BackendCache(max_bytes=10,
+        evict=lambda generator_id, entries: evicted.append(generator_id))
+    bdb = Handle()
+    cache.set(bdb, 1, 'engine', 'a', 4)
+    cache.set(bdb, 2, 'engine', 'b', 4)
+    assert cache.get(bdb, 1, 'engine') == 'a'
+    # Generator 2 is now the least recently used.
+    cache.set(bdb, 3, 'engine', 'c', 4)
+    assert evicted == [2]
+    assert cache.get(bdb, 2, 'engine') is None
+    assert cache.get(bdb, 1, 'engine') == 'a'
+    assert cache.stats()['bytes'] == 8
+    # Replacing an entry replaces its size.
+    cache.set(bdb, 3, 'engine', 'c', 6)
+    assert evicted == [2]
+    assert cache.stats()['bytes'] == 10
+    # The most recently used generator is kept even if over budget.
+    cache.set(bdb, 3, 'engine', 'c', 20)
+    assert evicted == [2, 1]
+    assert cache.get(bdb, 3, 'engine') == 'c'
+    cache.delete(bdb, 3, None)
+    assert cache.stats()['bytes'] == 0
+    assert cache.stats()['generators'] == 0
+    assert cache.stats()['evictions'] == 2
+    assert cache.set_max_bytes(None) == 10
+
+def test_backend_cache_weak():
+    evicted = []
+    cache = BackendCache(
+        evict=lambda generator_id, entries: evicted.append(entries))
+    bdb0 = Handle()
+    bdb1 = Handle()
+    cache.set(bdb0, 1, 'engine', 'a', 4)
+    cache.set(bdb1, 1, 'engine', 'b', 4)
+    assert cache.get(bdb0, 1, 'engine') == 'a'
+    assert cache.get(bdb1, 1, 'engine') == 'b'
+    del bdb0
+    gc.collect()
+    assert evicted == [{'engine': 'a'}]
+    assert cache.get(bdb1, 1, 'engine') == 'b'
+    assert cache.stats()['bytes'] == 4
+
+def test_backend_cache_stats():
+    cache = BackendCache()
+    cache.hit()
+    with cache.miss():
+        pass
+    with cache.miss():
+        pass
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['load_seconds'] >= 0
@@ -59,7 +59,38 @@ def bql2sql(string, setup=None):
             out.write(';')
         return out.getvalue()
 
+def batched_t1(*stages):
+    """Return the FROM clause of a 1-row query on t1 with batch stages.
+
+    Each stage is ('predprob', targets, constraints) or ('prediction',
+    colno, nsamples).
+    """
+    columns = []
+    tables = []
+    conditions = []
+    for i, stage in enumerate(stages):
+        if stage[0] == 'predprob':
+            columns.append('b%d.predprob AS bql_predprob%d' % (i, i))
+            tables.append('bql_predprob AS b%d' % (i,))
+            conditions.append('b%d.population_id = 1'
+                ' AND b%d.targets = \'%s\' AND b%d.constraints = \'%s\''
+                % (i, i, stage[1], i, stage[2]))
+        else:
+            columns.extend('b%d.%s AS bql_%s%d' % (i, name, name, i)
+                for name in ['confidence', 'prediction', 'value'])
+            tables.append('bql_prediction AS b%d' % (i,))
+            conditions.append('b%d.population_id = 1 AND b%d.colno = %d'
+                % (i, i, stage[1]))
+            if stage[2] is not None:
+                conditions[-1] += ' AND b%d.numsamples = %d' % (i, stage[2])
+        conditions[-1] += ' AND b%d.table_rowid = "t1"._rowid_' % (i,)
+    return ' FROM (SELECT "t1".*, "t1"._rowid_ AS _rowid_,' \
+        ' "t1"._rowid_ AS rowid, "t1"._rowid_ AS oid, %s' \
+        ' FROM "t1", %s WHERE %s) AS "t1"' % \
+        (', '.join(columns), ', '.join(tables), ' AND '.join(conditions))
+
 # XXX Kludgey mess.  Please reorganize.
+
 def bql2sqlparam(string):
     with bayeslite.bayesdb_open(':memory:') as bdb:
         test_core.t1_schema(bdb)
@@ -440,56 +471,64 @@ def test_select_trivial():
 def test_estimate_bql():
     # PREDICTIVE PROBABILITY
     assert bql2sql('estimate predictive probability of weight from p1;') == \
-        'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[3]\', \'[]\')' \
-            ' FROM "t1";'
+        'SELECT bql_predprob0' \
+            ' FROM (SELECT "t1".*, "t1"._rowid_ AS _rowid_,' \
+                ' "t1"._rowid_ AS rowid, "t1"._rowid_ AS oid,' \
+                ' b0.predprob AS bql_predprob0' \
+                ' FROM "t1", bql_predprob AS b0' \
+                ' WHERE b0.population_id = 1' \
+                    ' AND b0.targets = \'[3]\' AND b0.constraints = \'[]\'' \
+                    ' AND b0.table_rowid = "t1"._rowid_)' \
+            ' AS "t1";'
     assert bql2sql('estimate predictive probability of (age, weight) '
             'from p1;') == \
-        'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[2, 3]\', \'[]\')' \
-            ' FROM "t1";'
+        'SELECT bql_predprob0' + batched_t1(('predprob', '[2, 3]', '[]')) + ';'
     assert bql2sql('estimate predictive probability of (age, weight) given '
             '(label) from p1;') == \
-        'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[2, 3]\', \'[1]\')' \
-            ' FROM "t1";'
+        'SELECT bql_predprob0' + batched_t1(('predprob', '[2, 3]', '[1]')) + \
+            ';'
     assert bql2sql('estimate predictive probability of (*) from p1;') == \
-        'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[1, 2, 3]\', \'[]\')' \
-            ' FROM "t1";'
+        'SELECT bql_predprob0' + \
+            batched_t1(('predprob', '[1, 2, 3]', '[]')) + ';'
     assert bql2sql('estimate predictive probability of (*) given (age, weight) '
             'from p1;') == \
-        'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[1]\', \'[2, 3]\')' \
-            ' FROM "t1";'
+        'SELECT bql_predprob0' + batched_t1(('predprob', '[1]', '[2, 3]')) + \
+            ';'
     assert bql2sql('estimate predictive probability of age given (*) '
             'from p1;') == \
-        'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[2]\', \'[1, 3]\')' \
-            ' FROM "t1";'
+        'SELECT bql_predprob0' + batched_t1(('predprob', '[2]', '[1, 3]')) + \
+            ';'
     assert bql2sql('estimate label, predictive probability of weight'
             ' from p1;') \
         == \
-        'SELECT "label", ' \
-            'bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[3]\', \'[]\')' \
-            ' FROM "t1";'
+        'SELECT "label", bql_predprob0' + \
+            batched_t1(('predprob', '[3]', '[]')) + ';'
     assert bql2sql('estimate predictive probability of weight, label'
             ' from p1;') \
         == \
-        'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[3]\', \'[]\'),' \
-            ' "label"' \
-            ' FROM "t1";'
+        'SELECT bql_predprob0, "label"' + \
+            batched_t1(('predprob', '[3]', '[]')) + ';'
     assert bql2sql('estimate predictive probability of weight + 1'
             ' from p1;') == \
-        'SELECT (bql_row_column_predictive_probability(1, NULL, NULL, '\
-                '_rowid_, \'[3]\', \'[]\') + 1)' \
-            ' FROM "t1";'
+        'SELECT (bql_predprob0 + 1)' + \
+            batched_t1(('predprob', '[3]', '[]')) + ';'
     assert bql2sql('estimate predictive probability of weight given (*) + 1'
             ' from p1;') == \
-        'SELECT (bql_row_column_predictive_probability(1, NULL, NULL, '\
-                '_rowid_, \'[3]\', \'[1, 2]\') + 1)' \
+        'SELECT (bql_predprob0 + 1)' + \
+            batched_t1(('predprob', '[3]', '[1, 2]')) + ';'
+    # The same PREDICTIVE PROBABILITY in several places shares one stage.
+    assert bql2sql('estimate predictive probability of weight from p1'
+            ' where predictive probability of weight > 0.5'
+            ' order by predictive probability of age;') == \
+        'SELECT bql_predprob0' + \
+            batched_t1(('predprob', '[3]', '[]'),
+                ('predprob', '[2]', '[]')) + \
+            ' WHERE (bql_predprob0 > 0.5) ORDER BY bql_predprob1;'
+    # Selecting * computes row by row, since * would select the stages.
+    assert bql2sql('estimate *, predictive probability of weight from p1;') \
+        == \
+        'SELECT *, bql_row_column_predictive_probability(1, NULL, NULL,' \
+                ' _rowid_, \'[3]\', \'[]\')' \
             ' FROM "t1";'
     # PREDICTIVE PROBABILITY parse and compilation errors.
     with pytest.raises(parse.BQLParseError):
@@ -523,17 +562,20 @@ def test_estimate_bql():
             'from p1;')
     # PROBABILITY DENISTY.
     assert bql2sql('estimate probability density of weight = 20 from p1;') == \
-        'SELECT bql_pdf_joint(1, NULL, NULL, 3, 20) FROM "t1";'
+        'SELECT (SELECT bql_pdf_joint(1, NULL, NULL, 3, 20)) FROM "t1";'
     assert bql2sql('estimate probability density of weight = 20'
             ' given (age = 8)'
             ' from p1;') == \
-        'SELECT bql_pdf_joint(1, NULL, NULL, 3, 20, NULL, 2, 8) FROM "t1";'
+        'SELECT (SELECT bql_pdf_joint(1, NULL, NULL, 3, 20, NULL, 2, 8))' \
+            ' FROM "t1";'
     assert bql2sql('estimate probability density of (weight = 20, age = 8)'
             ' from p1;') == \
-        'SELECT bql_pdf_joint(1, NULL, NULL, 3, 20, 2, 8) FROM "t1";'
+        'SELECT (SELECT bql_pdf_joint(1, NULL, NULL, 3, 20, 2, 8))' \
+            ' FROM "t1";'
     assert bql2sql('estimate probability density of (weight = 20, age = 8)'
             " given (label = 'mumble') from p1;") == \
-        "SELECT bql_pdf_joint(1, NULL, NULL, 3, 20, 2, 8, NULL, 1, 'mumble')" \
+        'SELECT (SELECT' \
+            " bql_pdf_joint(1, NULL, NULL, 3, 20, 2, 8, NULL, 1, 'mumble'))" \
             ' FROM "t1";'
     assert bql2sql('estimate probability density of weight = (c + 1)'
             ' from p1;') == \
@@ -572,8 +614,9 @@ def test_estimate_bql():
         ' (SELECT _rowid_ FROM "t1" WHERE ("rowid" = 5)), 2) FROM "t1";'
     assert bql2sql('estimate dependence probability of age with weight'
             ' from p1;') == \
-        'SELECT bql_column_dependence_probability(1, NULL, NULL, 2, 3) '\
-        'FROM "t1";'
+        'SELECT (SELECT' \
+            ' bql_column_dependence_probability(1, NULL, NULL, 2, 3))' \
+            ' FROM "t1";'
     with pytest.raises(bayeslite.BQLError):
         # Need both rows fixed.
         bql2sql('estimate similarity to (rowid=2) in the context of r by p1')
@@ -588,13 +631,13 @@ def test_estimate_bql():
         bql2sql('estimate dependence probability from p1;')
     assert bql2sql('estimate mutual information of age with weight' +
         ' from p1;') == \
-        'SELECT bql_column_mutual_information('\
-            '1, NULL, NULL, \'[2]\', \'[3]\', NULL)'\
+        'SELECT (SELECT bql_column_mutual_information('\
+            '1, NULL, NULL, \'[2]\', \'[3]\', NULL))'\
         ' FROM "t1";'
     assert bql2sql('estimate mutual information of age with weight' +
         ' using 42 samples from p1;') == \
-        'SELECT bql_column_mutual_information('\
-            '1, NULL, NULL, \'[2]\', \'[3]\', 42)'\
+        'SELECT (SELECT bql_column_mutual_information('\
+            '1, NULL, NULL, \'[2]\', \'[3]\', 42))'\
         ' FROM "t1";'
     with pytest.raises(bayeslite.BQLError):
         # Need both columns fixed.
@@ -611,7 +654,42 @@ def test_estimate_bql():
         bql2sql('estimate mutual information using 42 samples from p1;')
     # XXX Should be SELECT, not ESTIMATE, here?
     assert bql2sql('estimate correlation of age with weight from p1;') == \
-        'SELECT bql_column_correlation(1, NULL, NULL, 2, 3) FROM "t1";'
+        'SELECT (SELECT bql_column_correlation(1, NULL, NULL, 2, 3))' \
+            ' FROM "t1";'
+    assert bql2sql('estimate age from p1'
+            ' where dependence probability of age with weight > 0.5;') == \
+        'SELECT "age" FROM "t1" WHERE ((SELECT' \
+            ' bql_column_dependence_probability(1, NULL, NULL, 2, 3)) > 0.5);'
+    # Repeated row-wise functions are computed once per row, after any
+    # conditions that do not need them.
+    assert bql2sql('estimate probability density of weight = age as d'
+            ' from p1 where age > 3'
+            ' and (probability density of weight = age) > 0.5'
+            ' order by probability density of weight = age;') == \
+        'SELECT bql_exp0 AS "d"' \
+            ' FROM (SELECT "t1".*, "t1"._rowid_ AS _rowid_,' \
+                ' "t1"._rowid_ AS rowid, "t1"._rowid_ AS oid,' \
+                ' bql_pdf_joint(1, NULL, NULL, 3, "age") AS bql_exp0' \
+                ' FROM "t1" WHERE ("age" > 3) LIMIT -1 OFFSET 0) AS "t1"' \
+            ' WHERE (bql_exp0 > 0.5) ORDER BY bql_exp0;'
+    assert bql2sql('estimate predictive probability of age,'
+            ' probability density of weight = age from p1'
+            ' order by probability density of weight = age;') == \
+        'SELECT bql_predprob0, bql_exp0' \
+            ' FROM (SELECT "t1".*,' \
+                ' bql_pdf_joint(1, NULL, NULL, 3, "age") AS bql_exp0' + \
+                batched_t1(('predprob', '[2]', '[]')) + \
+                ' LIMIT -1 OFFSET 0) AS "t1"' \
+            ' ORDER BY bql_exp0;'
+    # Conditions are evaluated cheapest first.
+    assert bql2sql('estimate age from p1 where'
+            ' (mutual information of age with weight given (label = label))'
+            ' > 0.1 and (probability density of weight = age) > 0.5'
+            ' and label = \'go\';') == \
+        'SELECT "age" FROM "t1" WHERE ("label" = \'go\')' \
+            ' AND (bql_pdf_joint(1, NULL, NULL, 3, "age") > 0.5)' \
+            ' AND (bql_column_mutual_information(1, NULL, NULL,' \
+                ' \'[2]\', \'[3]\', NULL, 1, "label") > 0.1);'
     with pytest.raises(bayeslite.BQLError):
         # Need both columns fixed.
         bql2sql('estimate correlation with age from p1;')
@@ -630,13 +708,54 @@ def test_predict_outside_infer():
 def test_infer_explicit_predict_confidence():
     assert bql2sql('infer explicit predict age with confidence 0.9'
             ' from p1;') == \
-        'SELECT bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, NULL) FROM "t1";'
+        'SELECT CASE WHEN bql_confidence0 < 0.9 THEN NULL' \
+            ' ELSE bql_value0 END' \
+            ' FROM (SELECT "t1".*, "t1"._rowid_ AS _rowid_,' \
+                ' "t1"._rowid_ AS rowid, "t1"._rowid_ AS oid,' \
+                ' b0.confidence AS bql_confidence0,' \
+                ' b0.prediction AS bql_prediction0,' \
+                ' b0.value AS bql_value0' \
+                ' FROM "t1", bql_prediction AS b0' \
+                ' WHERE b0.population_id = 1 AND b0.colno = 2' \
+                    ' AND b0.table_rowid = "t1"._rowid_)' \
+            ' AS "t1";'
 
 def test_infer_explicit_predict_confidence_nsamples():
     assert bql2sql('infer explicit'
             ' predict age with confidence 0.9 using 42 samples'
             ' from p1;') == \
-        'SELECT bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, 42) FROM "t1";'
+        'SELECT CASE WHEN bql_confidence0 < 0.9 THEN NULL' \
+            ' ELSE bql_value0 END' + \
+            batched_t1(('prediction', 2, 42)) + ';'
+
+def test_infer_explicit_predict_confidence_nsamples_expression():
+    # Only a constant number of samples can be computed in a batch.
+    assert bql2sql('infer explicit'
+            ' predict age with confidence 0.9 using (1+2) samples'
+            ' from p1;') == \
+        'SELECT bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, (1 + 2))' \
+            ' FROM "t1";'
+
+def test_infer_explicit_predict_order_limit():
+    # Rows ordered and limited by plain columns are limited before
+    # predicting anything for them.
+    assert bql2sql('infer explicit id, predict age with confidence 0.9'
+            ' from p1 where label = \'foo\' order by id limit 10 offset 5;') \
+        == \
+        'SELECT "id", bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, NULL)' \
+            ' FROM (SELECT "t1".*, "t1"._rowid_ AS _rowid_,' \
+                ' "t1"._rowid_ AS rowid, "t1"._rowid_ AS oid' \
+                ' FROM "t1" WHERE ("label" = \'foo\')' \
+                ' ORDER BY "id" LIMIT 10 OFFSET 5) AS "t1"' \
+            ' ORDER BY "id";'
+    # Rows ordered by predictions need all predictions first.
+    assert bql2sql('infer explicit id, predict age with confidence 0.9'
+            ' from p1 order by predict age with confidence 0.9 limit 10;') == \
+        'SELECT "id", CASE WHEN bql_confidence0 < 0.9 THEN NULL' \
+            ' ELSE bql_value0 END' + \
+            batched_t1(('prediction', 2, None)) + \
+            ' ORDER BY CASE WHEN bql_confidence0 < 0.9 THEN NULL' \
+            ' ELSE bql_value0 END LIMIT 10;'
 
 def test_infer_explicit_verbatim_and_predict_confidence():
     assert bql2sql('infer explicit rowid, age,'
@@ -645,8 +764,8 @@ def test_infer_explicit_verbatim_and_predict_confidence():
             ' bql_json_get(c2, \'value\') AS "age",' \
             ' bql_json_get(c2, \'confidence\') AS "age_conf"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, NULL)' \
-                ' AS c2 FROM "t1");'
+                ' bql_prediction0 AS c2' + \
+            batched_t1(('prediction', 2, None)) + ');'
 
 def test_infer_explicit_verbatim_and_predict_noconfidence():
     assert bql2sql('infer explicit rowid, age,'
@@ -654,8 +773,8 @@ def test_infer_explicit_verbatim_and_predict_noconfidence():
         'SELECT c0 AS "rowid", c1 AS "age",' \
             ' bql_json_get(c2, \'value\') AS "age"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, NULL)' \
-                ' AS c2 FROM "t1");'
+                ' bql_prediction0 AS c2' + \
+            batched_t1(('prediction', 2, None)) + ');'
 
 def test_infer_explicit_verbatim_and_predict_confidence_nsamples():
     assert bql2sql('infer explicit rowid, age,'
@@ -664,8 +783,8 @@ def test_infer_explicit_verbatim_and_predict_confidence_nsamples():
             ' bql_json_get(c2, \'value\') AS "age",' \
             ' bql_json_get(c2, \'confidence\') AS "age_conf"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, 42)' \
-                ' AS c2 FROM "t1");'
+                ' bql_prediction0 AS c2' + \
+            batched_t1(('prediction', 2, 42)) + ');'
 
 def test_infer_explicit_verbatim_and_predict_noconfidence_nsamples():
     assert bql2sql('infer explicit rowid, age,'
@@ -673,8 +792,8 @@ def test_infer_explicit_verbatim_and_predict_noconfidence_nsamples():
         'SELECT c0 AS "rowid", c1 AS "age",' \
             ' bql_json_get(c2, \'value\') AS "age"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, 42)' \
-                ' AS c2 FROM "t1");'
+                ' bql_prediction0 AS c2' + \
+            batched_t1(('prediction', 2, 42)) + ');'
 
 def test_infer_explicit_verbatim_and_predict_confidence_as():
     assert bql2sql('infer explicit rowid, age,'
@@ -683,8 +802,8 @@ def test_infer_explicit_verbatim_and_predict_confidence_as():
             ' bql_json_get(c2, \'value\') AS "age_inf",' \
             ' bql_json_get(c2, \'confidence\') AS "age_conf"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, NULL)' \
-                ' AS c2 FROM "t1");'
+                ' bql_prediction0 AS c2' + \
+            batched_t1(('prediction', 2, None)) + ');'
 
 def test_infer_explicit_verbatim_and_predict_noconfidence_as():
     assert bql2sql('infer explicit rowid, age,'
@@ -692,8 +811,8 @@ def test_infer_explicit_verbatim_and_predict_noconfidence_as():
         'SELECT c0 AS "rowid", c1 AS "age",' \
             ' bql_json_get(c2, \'value\') AS "age_inf"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, NULL)' \
-                ' AS c2 FROM "t1");'
+                ' bql_prediction0 AS c2' + \
+            batched_t1(('prediction', 2, None)) + ');'
 
 def test_infer_explicit_verbatim_and_predict_confidence_as_nsamples():
     assert bql2sql('infer explicit rowid, age,'
@@ -703,8 +822,8 @@ def test_infer_explicit_verbatim_and_predict_confidence_as_nsamples():
             ' bql_json_get(c2, \'value\') AS "age_inf",' \
             ' bql_json_get(c2, \'confidence\') AS "age_conf"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, 87)' \
-                ' AS c2 FROM "t1");'
+                ' bql_prediction0 AS c2' + \
+            batched_t1(('prediction', 2, 87)) + ');'
 
 def test_infer_explicit_verbatim_and_predict_noconfidence_as_nsamples():
     assert bql2sql('infer explicit rowid, age,'
@@ -713,18 +832,18 @@ def test_infer_explicit_verbatim_and_predict_noconfidence_as_nsamples():
         'SELECT c0 AS "rowid", c1 AS "age",' \
             ' bql_json_get(c2, \'value\') AS "age_inf"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, 87)' \
-                ' AS c2 FROM "t1");'
+                ' bql_prediction0 AS c2' + \
+            batched_t1(('prediction', 2, 87)) + ');'
 
 def test_infer_auto():
     assert bql2sql('infer rowid, age, weight from p1') \
         == \
         'SELECT "rowid" AS "rowid",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0, NULL))' \
-            ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, NULL, NULL, _rowid_, 3, 0, NULL))' \
-            ' AS "weight"' \
-        ' FROM "t1";'
+        ' "IFNULL"("age", CASE WHEN bql_confidence0 < 0 THEN NULL' \
+            ' ELSE bql_value0 END) AS "age",' \
+        ' "IFNULL"("weight", CASE WHEN bql_confidence1 < 0 THEN NULL' \
+            ' ELSE bql_value1 END) AS "weight"' + \
+        batched_t1(('prediction', 2, None), ('prediction', 3, None)) + ';'
 
 def test_infer_auto_nsamples():
     assert bql2sql('infer rowid, age, weight using (1+2) samples from p1') \
@@ -741,12 +860,11 @@ def test_infer_auto_with_confidence():
     assert bql2sql('infer rowid, age, weight with confidence 0.9 from p1') \
         == \
         'SELECT "rowid" AS "rowid",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, NULL))' \
-            ' AS "age",' \
-        ' "IFNULL"("weight",'\
-                ' bql_predict(1, NULL, NULL, _rowid_, 3, 0.9, NULL))' \
-            ' AS "weight"' \
-        ' FROM "t1";'
+        ' "IFNULL"("age", CASE WHEN bql_confidence0 < 0.9 THEN NULL' \
+            ' ELSE bql_value0 END) AS "age",' \
+        ' "IFNULL"("weight", CASE WHEN bql_confidence1 < 0.9 THEN NULL' \
+            ' ELSE bql_value1 END) AS "weight"' + \
+        batched_t1(('prediction', 2, None), ('prediction', 3, None)) + ';'
 
 def test_infer_auto_with_confidence_nsamples():
     assert bql2sql('infer rowid, age, weight with confidence 0.9'
@@ -767,12 +885,11 @@ def test_infer_auto_with_confidence_where():
             ' where label = \'foo\'') \
         == \
         'SELECT "rowid" AS "rowid",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, NULL))' \
-            ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, NULL, NULL, _rowid_, 3, 0.9,'\
-                ' NULL))' \
-            ' AS "weight"' \
-        ' FROM "t1"' \
+        ' "IFNULL"("age", CASE WHEN bql_confidence0 < 0.9 THEN NULL' \
+            ' ELSE bql_value0 END) AS "age",' \
+        ' "IFNULL"("weight", CASE WHEN bql_confidence1 < 0.9 THEN NULL' \
+            ' ELSE bql_value1 END) AS "weight"' + \
+        batched_t1(('prediction', 2, None), ('prediction', 3, None)) + \
         ' WHERE ("label" = \'foo\');'
 
 def test_infer_auto_with_confidence_nsamples_where():
@@ -782,11 +899,11 @@ def test_infer_auto_with_confidence_nsamples_where():
             ' where label = \'foo\'') \
         == \
         'SELECT "rowid" AS "rowid",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, 42))' \
-            ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, NULL, NULL, _rowid_, 3, 0.9, 42))' \
-            ' AS "weight"' \
-        ' FROM "t1"' \
+        ' "IFNULL"("age", CASE WHEN bql_confidence0 < 0.9 THEN NULL' \
+            ' ELSE bql_value0 END) AS "age",' \
+        ' "IFNULL"("weight", CASE WHEN bql_confidence1 < 0.9 THEN NULL' \
+            ' ELSE bql_value1 END) AS "weight"' + \
+        batched_t1(('prediction', 2, 42), ('prediction', 3, 42)) + \
         ' WHERE ("label" = \'foo\');'
 
 def test_infer_auto_with_confidence_nsamples_where_predict():
@@ -795,14 +912,15 @@ def test_infer_auto_with_confidence_nsamples_where_predict():
                 ' = \'foo\'') \
         == \
         'SELECT "rowid" AS "rowid",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, NULL))' \
-            ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, NULL, NULL, _rowid_, 3, 0.9,' \
-                ' NULL))' \
-            ' AS "weight"' \
-        ' FROM "t1"' \
+        ' "IFNULL"("age", CASE WHEN bql_confidence0 < 0.9 THEN NULL' \
+            ' ELSE bql_value0 END) AS "age",' \
+        ' "IFNULL"("weight", CASE WHEN bql_confidence1 < 0.9 THEN NULL' \
+            ' ELSE bql_value1 END) AS "weight"' + \
+        batched_t1(('prediction', 2, None), ('prediction', 3, None),
+            ('prediction', 1, None)) + \
         ' WHERE ("ifnull"("label",' \
-                ' bql_predict(1, NULL, NULL, _rowid_, 1, 0.7, NULL))' \
+                ' CASE WHEN bql_confidence2 < 0.7 THEN NULL' \
+                    ' ELSE bql_value2 END)' \
             ' = \'foo\');'
 
 def test_infer_auto_with_confidence_nsamples_where_predict_nsamples():
@@ -814,36 +932,42 @@ def test_infer_auto_with_confidence_nsamples_where_predict_nsamples():
                 ' = \'foo\'') \
         == \
         'SELECT "rowid" AS "rowid",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, 42))' \
-            ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, NULL, NULL, _rowid_, 3, 0.9, 42))' \
-            ' AS "weight"' \
-        ' FROM "t1"' \
+        ' "IFNULL"("age", CASE WHEN bql_confidence0 < 0.9 THEN NULL' \
+            ' ELSE bql_value0 END) AS "age",' \
+        ' "IFNULL"("weight", CASE WHEN bql_confidence1 < 0.9 THEN NULL' \
+            ' ELSE bql_value1 END) AS "weight"' + \
+        batched_t1(('prediction', 2, 42), ('prediction', 3, 42),
+            ('prediction', 1, 73)) + \
         ' WHERE ("ifnull"("label",' \
-                ' bql_predict(1, NULL, NULL, _rowid_, 1, 0.7, 73))' \
+                ' CASE WHEN bql_confidence2 < 0.7 THEN NULL' \
+                    ' ELSE bql_value2 END)' \
             ' = \'foo\');'
 
 def test_infer_auto_star():
-    assert bql2sql('infer rowid, * from p1') == \
+    assert bql2sql('infer rowid, * from p1') \
+        == \
         'SELECT "rowid" AS "rowid", "id" AS "id",' \
-        ' "IFNULL"("label", bql_predict(1, NULL, NULL, _rowid_, 1, 0, NULL))' \
-            ' AS "label",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0, NULL))' \
-            ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, NULL, NULL, _rowid_, 3, 0, NULL))' \
-            ' AS "weight"' \
-        ' FROM "t1";'
+        ' "IFNULL"("label", CASE WHEN bql_confidence0 < 0 THEN NULL' \
+            ' ELSE bql_value0 END) AS "label",' \
+        ' "IFNULL"("age", CASE WHEN bql_confidence1 < 0 THEN NULL' \
+            ' ELSE bql_value1 END) AS "age",' \
+        ' "IFNULL"("weight", CASE WHEN bql_confidence2 < 0 THEN NULL' \
+            ' ELSE bql_value2 END) AS "weight"' + \
+        batched_t1(('prediction', 1, None), ('prediction', 2, None),
+            ('prediction', 3, None)) + ';'
 
 def test_infer_auto_star_nsamples():
-    assert bql2sql('infer rowid, * using 1 samples from p1') == \
+    assert bql2sql('infer rowid, * using 1 samples from p1') \
+        == \
         'SELECT "rowid" AS "rowid", "id" AS "id",' \
-        ' "IFNULL"("label", bql_predict(1, NULL, NULL, _rowid_, 1, 0, 1))' \
-            ' AS "label",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0, 1))' \
-            ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, NULL, NULL, _rowid_, 3, 0, 1))' \
-            ' AS "weight"' \
-        ' FROM "t1";'
+        ' "IFNULL"("label", CASE WHEN bql_confidence0 < 0 THEN NULL' \
+            ' ELSE bql_value0 END) AS "label",' \
+        ' "IFNULL"("age", CASE WHEN bql_confidence1 < 0 THEN NULL' \
+            ' ELSE bql_value1 END) AS "age",' \
+        ' "IFNULL"("weight", CASE WHEN bql_confidence2 < 0 THEN NULL' \
+            ' ELSE bql_value2 END) AS "weight"' + \
+        batched_t1(('prediction', 1, 1), ('prediction', 2, 1),
+            ('prediction', 3, 1)) + ';'
 
 def test_estimate_columns_trivial():
     prefix0 = 'SELECT v.name AS name'
@@ -996,12 +1120,19 @@ def test_estimate_pairwise_trivial():
     infix0 += ' AND v0.generator_id IS NULL'
     infix0 += ' AND v1.generator_id IS NULL'
     infix += infix0
+    infixd = ' FROM bayesdb_population AS p,'
+    infixd += ' bayesdb_variable AS v0,'
+    infixd += ' bayesdb_variable AS v1,'
+    infixd += ' bql_depprob AS d'
+    infixd += ' WHERE p.id = 1'
+    infixd += ' AND v0.population_id = p.id AND v1.population_id = p.id'
+    infixd += ' AND d.population_id = 1'
+    infixd += ' AND d.colno0 = v0.colno AND d.colno1 = v1.colno'
+    infixd += ' AND v0.generator_id IS NULL'
+    infixd += ' AND v1.generator_id IS NULL'
     assert bql2sql('estimate dependence probability'
             ' from pairwise columns of p1;') == \
-        prefix + \
-        'bql_column_dependence_probability(1, NULL, NULL, v0.colno,'\
-            ' v1.colno)' + \
-        infix + ';'
+        prefix + 'd.depprob AS value' + infixd + ';'
     assert bql2sql('estimate mutual information'
             ' from pairwise columns of p1 where'
             ' (probability density of age = 0) > 0.5;') == \
@@ -1045,10 +1176,7 @@ def test_estimate_pairwise_trivial():
     assert bql2sql('estimate correlation from pairwise columns of p1'
             ' where dependence probability > 0.5;') == \
         prefix + 'bql_column_correlation(1, NULL, NULL, v0.colno, v1.colno)' + \
-        infix + ' AND' \
-        ' (bql_column_dependence_probability(1, NULL, NULL, v0.colno,' \
-                ' v1.colno)' \
-            ' > 0.5);'
+        ' AS value' + infixd + ' AND (d.depprob > 0.5);'
     with pytest.raises(bayeslite.BQLError):
         # Must omit both columns.
         bql2sql('estimate dependence probability'
@@ -1110,12 +1238,11 @@ def test_estimate_pairwise_trivial():
             ' from pairwise columns of p1'
             ' where depprob > 0.5 order by mutinf desc') == \
         prefix + \
-        'bql_column_dependence_probability(1, NULL, NULL, v0.colno, v1.colno)' \
-        ' AS "depprob",' \
+        'd.depprob AS "depprob",' \
         ' bql_column_mutual_information(1, NULL, NULL,'\
         ' \'[\' || v0.colno || \']\', \'[\' || v1.colno || \']\', NULL)'\
         ' AS "mutinf"' \
-        + infix0 + \
+        + infixd + \
         ' AND ("depprob" > 0.5)' \
         ' ORDER BY "mutinf" DESC;'
 
@@ -1124,9 +1251,20 @@ def test_estimate_pairwise_row():
     infix = ' AS value FROM "t1" AS r0, "t1" AS r1'
     assert bql2sql('estimate similarity in the context of age' +
             ' from pairwise p1;') == \
-        prefix + ', bql_row_similarity(1, NULL, NULL,'\
-            ' r0._rowid_, r1._rowid_, 2)' + \
-        infix + ';'
+        prefix + ', s0.similarity' + infix + ', bql_similarity AS s0' \
+        ' WHERE s0.population_id = 1 AND s0.colno = 2' \
+        ' AND s0.rowid0 = r0._rowid_ AND s0.rowid1 = r1._rowid_;'
+    assert bql2sql('estimate similarity in the context of age' +
+            ' from pairwise p1'
+            ' where similarity in the context of weight > 0.5'
+            ' and rowid0 < rowid1;') == \
+        prefix + ', s0.similarity' + infix + \
+        ', bql_similarity AS s0, bql_similarity AS s1' \
+        ' WHERE s0.population_id = 1 AND s0.colno = 2' \
+        ' AND s0.rowid0 = r0._rowid_ AND s0.rowid1 = r1._rowid_' \
+        ' AND s1.population_id = 1 AND s1.colno = 3' \
+        ' AND s1.rowid0 = r0._rowid_ AND s1.rowid1 = r1._rowid_' \
+        ' AND ((s1.similarity > 0.5) AND ("rowid0" < "rowid1"));'
     with pytest.raises(bayeslite.BQLError):
         # PREDICT is a 1-row function.
         bql2sql('estimate predict age with confidence 0.9 from pairwise t1;')
@@ -1135,14 +1273,15 @@ def test_estimate_pairwise_selected_columns():
     assert bql2sql('estimate dependence probability'
             ' from pairwise columns of p1 for label, age') == \
         'SELECT 1 AS population_id, v0.name AS name0, v1.name AS name1,' \
-        ' bql_column_dependence_probability(1, NULL, NULL,' \
-                ' v0.colno, v1.colno)' \
-            ' AS value' \
+        ' d.depprob AS value' \
         ' FROM bayesdb_population AS p,' \
         ' bayesdb_variable AS v0,' \
-        ' bayesdb_variable AS v1' \
+        ' bayesdb_variable AS v1,' \
+        ' bql_depprob AS d' \
         ' WHERE p.id = 1' \
         ' AND v0.population_id = p.id AND v1.population_id = p.id' \
+        ' AND d.population_id = 1' \
+        ' AND d.colno0 = v0.colno AND d.colno1 = v1.colno' \
         ' AND v0.generator_id IS NULL AND v1.generator_id IS NULL' \
         ' AND v0.colno IN (1, 2) AND v1.colno IN (1, 2);'
     assert bql2sql('estimate dependence probability'
@@ -1150,14 +1289,15 @@ def test_estimate_pairwise_selected_columns():
             ' for (ESTIMATE * FROM COLUMNS OF p1'
                 ' ORDER BY name DESC LIMIT 2)') == \
         'SELECT 1 AS population_id, v0.name AS name0, v1.name AS name1,' \
-        ' bql_column_dependence_probability(1, NULL, NULL, v0.colno,' \
-                ' v1.colno)' \
-            ' AS value' \
+        ' d.depprob AS value' \
         ' FROM bayesdb_population AS p,' \
         ' bayesdb_variable AS v0,' \
-        ' bayesdb_variable AS v1' \
+        ' bayesdb_variable AS v1,' \
+        ' bql_depprob AS d' \
         ' WHERE p.id = 1' \
         ' AND v0.population_id = p.id AND v1.population_id = p.id' \
+        ' AND d.population_id = 1' \
+        ' AND d.colno0 = v0.colno AND d.colno1 = v1.colno' \
         ' AND v0.generator_id IS NULL AND v1.generator_id IS NULL' \
         ' AND v0.colno IN (3, 1) AND v1.colno IN (3, 1);'
 
@@ -1273,23 +1413,53 @@ def test_modeledby_usingmodels_trival():
         bdb.execute('create generator m1 for p1 using cgpm;')
     assert bql2sql('estimate predictive probability of weight + 1'
             ' from p1 modeled by m1 using models 1-3, 5;', setup=setup) == \
-        'SELECT (bql_row_column_predictive_probability(1, 1, \'[1, 2, 3, 5]\','\
-                ' _rowid_, \'[3]\', \'[]\') + 1)' \
-            ' FROM "t1";'
+        'SELECT (bql_predprob0 + 1)' \
+            ' FROM (SELECT "t1".*, "t1"._rowid_ AS _rowid_,' \
+                ' "t1"._rowid_ AS rowid, "t1"._rowid_ AS oid,' \
+                ' b0.predprob AS bql_predprob0' \
+                ' FROM "t1", bql_predprob AS b0' \
+                ' WHERE b0.population_id = 1 AND b0.generator_id = 1' \
+                    ' AND b0.modelnos = \'[1, 2, 3, 5]\'' \
+                    ' AND b0.targets = \'[3]\' AND b0.constraints = \'[]\'' \
+                    ' AND b0.table_rowid = "t1"._rowid_)' \
+            ' AS "t1";'
     assert bql2sql(
         'infer rowid, age, weight from p1 modeled by m1 using model 7',
             setup=setup) == \
         'SELECT "rowid" AS "rowid",' \
-        ' "IFNULL"("age", bql_predict(1, 1, \'[7]\', _rowid_, 2, 0, NULL))' \
-            ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, 1, \'[7]\', _rowid_, 3, 0, NULL))' \
-            ' AS "weight"' \
-        ' FROM "t1";'
+        ' "IFNULL"("age", CASE WHEN bql_confidence0 < 0 THEN NULL' \
+            ' ELSE bql_value0 END) AS "age",' \
+        ' "IFNULL"("weight", CASE WHEN bql_confidence1 < 0 THEN NULL' \
+            ' ELSE bql_value1 END) AS "weight"' \
+        ' FROM (SELECT "t1".*, "t1"._rowid_ AS _rowid_,' \
+            ' "t1"._rowid_ AS rowid, "t1"._rowid_ AS oid,' \
+            ' b0.confidence AS bql_confidence0,' \
+            ' b0.prediction AS bql_prediction0, b0.value AS bql_value0,' \
+            ' b1.confidence AS bql_confidence1,' \
+            ' b1.prediction AS bql_prediction1, b1.value AS bql_value1' \
+            ' FROM "t1", bql_prediction AS b0, bql_prediction AS b1' \
+            ' WHERE b0.population_id = 1 AND b0.generator_id = 1' \
+                ' AND b0.modelnos = \'[7]\' AND b0.colno = 2' \
+                ' AND b0.table_rowid = "t1"._rowid_' \
+                ' AND b1.population_id = 1 AND b1.generator_id = 1' \
+                ' AND b1.modelnos = \'[7]\' AND b1.colno = 3' \
+                ' AND b1.table_rowid = "t1"._rowid_)' \
+        ' AS "t1";'
     assert bql2sql('infer explicit predict age with confidence 0.9'
             ' from p1 using models 0, 3-5;',
             setup=setup) == \
-        'SELECT bql_predict(1, NULL, \'[0, 3, 4, 5]\', _rowid_, 2, 0.9, NULL)'\
-        ' FROM "t1";'
+        'SELECT CASE WHEN bql_confidence0 < 0.9 THEN NULL' \
+            ' ELSE bql_value0 END' \
+            ' FROM (SELECT "t1".*, "t1"._rowid_ AS _rowid_,' \
+                ' "t1"._rowid_ AS rowid, "t1"._rowid_ AS oid,' \
+                ' b0.confidence AS bql_confidence0,' \
+                ' b0.prediction AS bql_prediction0,' \
+                ' b0.value AS bql_value0' \
+                ' FROM "t1", bql_prediction AS b0' \
+                ' WHERE b0.population_id = 1' \
+                    ' AND b0.modelnos = \'[0, 3, 4, 5]\' AND b0.colno = 2' \
+                    ' AND b0.table_rowid = "t1"._rowid_)' \
+            ' AS "t1";'
     assert bql2sql('''
         estimate predictive relevance
             of (label = 'Uganda')
@@ -1313,14 +1483,16 @@ def test_modeledby_usingmodels_trival():
         using models 1, 4, 12
     ''', setup=setup) == \
         'SELECT 1 AS population_id, v0.name AS name0, v1.name AS name1,' \
-        ' bql_column_dependence_probability(1, 1, \'[1, 4, 12]\',' \
-                ' v0.colno, v1.colno)' \
-            ' AS value' \
+        ' d.depprob AS value' \
         ' FROM bayesdb_population AS p,' \
         ' bayesdb_variable AS v0,' \
-        ' bayesdb_variable AS v1' \
+        ' bayesdb_variable AS v1,' \
+        ' bql_depprob AS d' \
         ' WHERE p.id = 1' \
         ' AND v0.population_id = p.id AND v1.population_id = p.id' \
+        ' AND d.population_id = 1 AND d.generator_id = 1' \
+        ' AND d.modelnos = \'[1, 4, 12]\'' \
+        ' AND d.colno0 = v0.colno AND d.colno1 = v1.colno' \
         ' AND (v0.generator_id IS NULL OR v0.generator_id = 1)' \
         ' AND (v1.generator_id IS NULL OR v1.generator_id = 1)' \
         ' AND v0.colno IN (1, 2) AND v1.colno IN (1, 2);'
@@ -1328,8 +1500,8 @@ def test_modeledby_usingmodels_trival():
         estimate mutual information of age with weight
         from p1 modeled by m1 using model 1;
     ''', setup=setup) == \
-        'SELECT bql_column_mutual_information('\
-            '1, 1, \'[1]\', \'[2]\', \'[3]\', NULL)'\
+        'SELECT (SELECT bql_column_mutual_information('\
+            '1, 1, \'[1]\', \'[2]\', \'[3]\', NULL))'\
         ' FROM "t1";'
 
 def test_simulate_columns_all():
@@ -1589,28 +1761,16 @@ def test_parametrized():
                 ' in the context of (estimate * from columns of p limit 1)' \
                 ' from p;',
         ]
+        # The catalog was loaded by the BQL-traced query above.
         assert sqltraced_execute('estimate similarity to (rowid = 1)'
                 ' in the context of (estimate * from columns of p limit 1)'
                 ' from p;') == [
-            'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?',
-            'SELECT id FROM bayesdb_population WHERE name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
-            'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?',
-            'SELECT id FROM bayesdb_population WHERE name = ?',
             'SELECT v.name AS name FROM bayesdb_variable AS v'
                 ' WHERE v.population_id = 1'
                     ' AND v.generator_id IS NULL'
                 ' LIMIT 1',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT tabname FROM bayesdb_population'
-                ' WHERE id = ?',
             'SELECT bql_row_similarity(1, NULL, NULL, _rowid_,'
                 ' (SELECT _rowid_ FROM "t" WHERE ("rowid" = 1)), 0) FROM "t"',
-            'SELECT id FROM bayesdb_generator WHERE population_id = ?',
-            'SELECT backend FROM bayesdb_generator WHERE id = ?',
             'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
                 ' WHERE generator_id = ? AND table_rowid = ?',
             'SELECT cgpm_rowid FROM bayesdb_cgpm_individual '
@@ -1623,31 +1783,15 @@ def test_parametrized():
                 ' in the context of (estimate * from columns of p limit ?)'
                 ' from p;',
                 (1,)) == [
-            'SELECT COUNT(*) FROM bayesdb_population'
-                ' WHERE name = ?',
-            'SELECT id FROM bayesdb_population'
-                ' WHERE name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
-            'SELECT COUNT(*) FROM bayesdb_population'
-                ' WHERE name = ?',
-            'SELECT id FROM bayesdb_population'
-                ' WHERE name = ?',
             # ESTIMATE * FROM COLUMNS OF:
             'SELECT v.name AS name'
                 ' FROM bayesdb_variable AS v'
                 ' WHERE v.population_id = 1'
                     ' AND v.generator_id IS NULL'
                 ' LIMIT ?1',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
             # ESTIMATE SIMILARITY TO (rowid=1):
             'SELECT bql_row_similarity(1, NULL, NULL, _rowid_,'
                 ' (SELECT _rowid_ FROM "t" WHERE ("rowid" = 1)), 0) FROM "t"',
-            'SELECT id FROM bayesdb_generator WHERE population_id = ?',
-            'SELECT backend FROM bayesdb_generator WHERE id = ?',
             'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
                 ' WHERE generator_id = ? AND table_rowid = ?',
             'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
@@ -1661,137 +1805,27 @@ def test_parametrized():
                 'from p given gender = \'F\' limit 4') == [
             'PRAGMA table_info("sim")',
             'PRAGMA table_info("bayesdb_temp_0")',
-            'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?',
-            'SELECT id FROM bayesdb_population WHERE name = ?',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
             'SELECT CAST(4 AS INTEGER), \'F\'',
             'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
             'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
             'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
             'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
             'SELECT MAX(_rowid_) FROM "t"',
             'SELECT token FROM bayesdb_rowid_tokens',
             'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT id FROM bayesdb_generator'
-                ' WHERE population_id = ?',
-            'SELECT backend FROM bayesdb_generator WHERE id = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
             'SELECT 1 FROM "t" WHERE oid = ?',
             'SELECT 1 FROM bayesdb_cgpm_individual'
                 ' WHERE generator_id = ? AND table_rowid = ? LIMIT 1',
             'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
                 ' WHERE generator_id = ? AND table_rowid = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ? AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
             'SELECT code FROM bayesdb_cgpm_category'
                 ' WHERE generator_id = ? AND colno = ? AND value = ?',
             'SELECT engine_stamp FROM bayesdb_cgpm_generator'
                 ' WHERE generator_id = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ? AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ? AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ? AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ? AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
-            'SELECT value FROM bayesdb_cgpm_category'
-                ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
+        ] + [
             'SELECT value FROM bayesdb_cgpm_category'
                 ' WHERE generator_id = ? AND colno = ? AND code = ?',
+        ] * 12 + [
             'CREATE TEMP TABLE "bayesdb_temp_0"'
                 ' ("age","RANK","division")',
             'INSERT INTO "bayesdb_temp_0" ("age","RANK","division")'
@@ -1806,77 +1840,36 @@ def test_parametrized():
                 ' SELECT * FROM "bayesdb_temp_0"',
             'DROP TABLE "bayesdb_temp_0"'
         ]
+        # The writes to the temporary tables invalidated the catalog.
         assert sqltraced_execute(
                 'select * from (simulate age from p '
                 'given gender = \'F\' limit 4)') == [
             'PRAGMA table_info("bayesdb_temp_1")',
-            'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?',
-            'SELECT id FROM bayesdb_population WHERE name = ?',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
+            'SELECT id, name, tabname FROM bayesdb_population',
+            'SELECT id, name, population_id, backend FROM bayesdb_generator',
+            'SELECT population_id, generator_id, colno, name, stattype'
+                ' FROM bayesdb_variable',
             'SELECT CAST(4 AS INTEGER), \'F\'',
             'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
             'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
             'SELECT MAX(_rowid_) FROM "t"',
             'SELECT token FROM bayesdb_rowid_tokens',
             'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT id FROM bayesdb_generator WHERE population_id = ?',
-            'SELECT backend FROM bayesdb_generator WHERE id = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
             'SELECT 1 FROM "t" WHERE oid = ?',
             'SELECT 1 FROM bayesdb_cgpm_individual'
                 ' WHERE generator_id = ? AND table_rowid = ? LIMIT 1',
             'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
                 ' WHERE generator_id = ? AND table_rowid = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
             'SELECT code FROM bayesdb_cgpm_category'
                 ' WHERE generator_id = ? AND colno = ? AND value = ?',
             'SELECT engine_stamp FROM bayesdb_cgpm_generator'
                 ' WHERE generator_id = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
             'SELECT value FROM bayesdb_cgpm_category'
                 ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
             'SELECT value FROM bayesdb_cgpm_category'
                 ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
             'SELECT value FROM bayesdb_cgpm_category'
                 ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
             'SELECT value FROM bayesdb_cgpm_category'
                 ' WHERE generator_id = ? AND colno = ? AND code = ?',
             'CREATE TEMP TABLE "bayesdb_temp_1" ("age")',
@@ -1900,17 +1893,54 @@ def test_parametrized():
         bdb.execute('create generator q_cc for q;')
         bdb.execute('initialize 1 model for q_cc;')
         assert sqltraced_execute('analyze q_cc for 1 iteration;') == [
-            'SELECT COUNT(*) FROM bayesdb_generator WHERE name = ?',
-            'SELECT id FROM bayesdb_generator WHERE name = ?',
-            'SELECT backend FROM bayesdb_generator WHERE id = ?',
-            'SELECT engine_json, engine_stamp FROM bayesdb_cgpm_generator'
+            'SELECT id, name, tabname FROM bayesdb_population',
+            'SELECT id, name, population_id, backend FROM bayesdb_generator',
+            'SELECT population_id, generator_id, colno, name, stattype'
+                ' FROM bayesdb_variable',
+            'SELECT engine_stamp FROM bayesdb_cgpm_generator'
                 ' WHERE generator_id = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
+            'SELECT cgpm_modelno, state_stamp FROM bayesdb_cgpm_state'
+                ' WHERE generator_id = ?',
+            'SELECT engine_json FROM bayesdb_cgpm_generator'
+                ' WHERE generator_id = ?',
+            'SELECT cgpm_modelno, state_json FROM bayesdb_cgpm_state'
+                ' WHERE generator_id = ? AND cgpm_modelno IN (0)',
             'SELECT engine_stamp FROM bayesdb_cgpm_generator'
                 ' WHERE generator_id = ?',
-            'UPDATE bayesdb_cgpm_generator'
-                ' SET engine_json = :engine_json, engine_stamp = :engine_stamp'
-                ' WHERE generator_id = :generator_id']
+            'UPDATE bayesdb_cgpm_generator SET engine_stamp = ?'
+                ' WHERE generator_id = ?',
+            'INSERT OR REPLACE INTO bayesdb_cgpm_state'
+                ' (generator_id, cgpm_modelno, state_json, state_stamp)'
+                ' VALUES (?, ?, ?, ?)']
+
+def test_prepare():
+    with test_csv.bayesdb_csv_file(test_csv.csv_data) as (bdb, fname):
+        with open(fname, 'rU') as f:
+            bayeslite.bayesdb_read_csv(bdb, 't', f, header=True, create=True)
+        stmt = bdb.prepare('select age from t where division = :division')
+        assert map(tuple, stmt.execute({':division': 'sales'})) == \
+            [(34,), (30,)]
+        out = stmt._out
+        assert out is not None
+        assert map(tuple, stmt.execute({':division': 'marketing'})) == \
+            [(41,)]
+        assert stmt._out is out
+        with pytest.raises(ValueError):
+            stmt.execute({':rank': 4})
+        # Any BQL command invalidates the compiled query.
+        bdb.execute('create population p for t'
+            ' (age numerical; ignore gender, salary, height, division, rank)')
+        stmt = bdb.prepare('estimate * from variables of p')
+        assert map(tuple, stmt.execute()) == [('age',)]
+        bdb.execute('drop population p')
+        bdb.execute('create population p for t'
+            ' (rank numerical; ignore age, gender, salary, height, division)')
+        assert map(tuple, stmt.execute()) == [('rank',)]
+        # Plain execution goes through a bounded cache of plans.
+        bdb.plan_cache_size = 2
+        for i in range(4):
+            assert bql_execute(bdb, 'select %d' % (i,)) == [(i,)]
+        assert bdb._plans.keys() == ['select 2', 'select 3']
 
 def test_create_table_ifnotexists_as_simulate():
     with test_csv.bayesdb_csv_file(test_csv.csv_data) as (bdb, fname):
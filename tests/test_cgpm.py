@@ -36,8 +36,10 @@ from bayeslite import bayesdb_nullify
 from bayeslite import bayesdb_open
 from bayeslite import bayesdb_read_csv
 from bayeslite import bayesdb_register_backend
+from bayeslite import bqlvtab
 from bayeslite.core import bayesdb_get_generator
 from bayeslite.core import bayesdb_get_population
+from bayeslite.core import bayesdb_variable_number
 from bayeslite.exception import BQLError
 from bayeslite.backends.cgpm_backend import CGPM_Backend
 from bayeslite.util import cursor_value
@@ -349,6 +351,163 @@ def test_cgpm_analysis_iteration_timed__ci_slow():
         ''')
         assert 0 < time.time() - start3 < 15
 
+def test_cgpm_analysis_checkpoint_seconds():
+    # Test that analysis checkpointed by seconds runs the requested
+    # iterations, writing the states at least once.
+    with cgpm_smoke_bdb() as bdb:
+        bdb.execute('CREATE GENERATOR g2 FOR p USING cgpm')
+        bdb.execute('INITIALIZE 2 MODELS FOR g2')
+        backend = bdb.backends['cgpm']
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'g2')
+        stamp = backend._engine_stamp(bdb, generator_id)
+        bdb.execute('''
+            ANALYZE g2 MODEL 1 FOR 3 ITERATION CHECKPOINT 1 SECOND
+        ''')
+        assert stamp < backend._engine_stamp(bdb, generator_id)
+        engine = backend._engine(bdb, generator_id)
+        assert len(engine.states[0].diagnostics['logscore']) == 0
+        assert len(engine.states[1].diagnostics['logscore']) == 3
+        start = time.time()
+        bdb.execute('''
+            ANALYZE g2 FOR 2 SECONDS CHECKPOINT 1 SECOND (QUIET)
+        ''')
+        assert time.time() - start < 15
+
+def test_cgpm_analysis_background():
+    # Test that background analysis leaves the models as last written until
+    # its checkpoints are written, and refuses to overwrite models changed
+    # meanwhile.
+    with cgpm_smoke_bdb() as bdb:
+        bdb.execute('CREATE GENERATOR g2 FOR p USING cgpm')
+        bdb.execute('INITIALIZE 2 MODELS FOR g2')
+        backend = bdb.backends['cgpm']
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'g2')
+        stamp = backend._engine_stamp(bdb, generator_id)
+        analysis = backend.analyze_models_async(bdb, generator_id,
+            modelnos=[1], iterations=3, ckpt_seconds=1)
+        bdb.execute('SIMULATE output FROM p MODELED BY g2 LIMIT 2').fetchall()
+        assert backend._engine_stamp(bdb, generator_id) == stamp
+        assert analysis.wait()
+        assert analysis.done
+        assert 1 <= analysis.commits
+        assert stamp < backend._engine_stamp(bdb, generator_id)
+        engine = backend._engine(bdb, generator_id)
+        assert len(engine.states[0].diagnostics['logscore']) == 0
+        assert len(engine.states[1].diagnostics['logscore']) == 3
+        analysis = backend.analyze_models_async(bdb, generator_id,
+            iterations=1)
+        bdb.execute('ANALYZE g2 MODEL 0 FOR 1 ITERATION')
+        with pytest.raises(BQLError):
+            analysis.wait()
+        assert analysis.done
+        engine = backend._engine(bdb, generator_id)
+        assert len(engine.states[0].diagnostics['logscore']) == 1
+        assert len(engine.states[1].diagnostics['logscore']) == 3
+
+
+def test_cgpm_incorporate_new_rows():
+    # Test that rows inserted into the table after the models were
+    # initialized are incorporated into every model on request.
+    with cgpm_smoke_bdb() as bdb:
+        bdb.execute('CREATE GENERATOR g2 FOR p USING cgpm')
+        bdb.execute('INITIALIZE 2 MODELS FOR g2')
+        bdb.execute('ANALYZE g2 FOR 1 ITERATION')
+        backend = bdb.backends['cgpm']
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'g2')
+        # Nothing new to incorporate.
+        stamp = backend._engine_stamp(bdb, generator_id)
+        bdb.execute('ALTER GENERATOR g2 INCORPORATE NEW ROWS')
+        assert backend._engine_stamp(bdb, generator_id) == stamp
+        bdb.sql_execute('''
+            INSERT INTO t (output, cat, input) VALUES (1.5, 1, 4)
+        ''')
+        bdb.sql_execute('''
+            INSERT INTO t (output, cat, input) VALUES (NULL, 7, NULL)
+        ''')
+        rowids = [rowid for (rowid,) in
+            bdb.sql_execute('SELECT _rowid_ FROM t ORDER BY _rowid_')]
+        assert backend._cgpm_rowid(bdb, generator_id, rowids[-1]) == -1
+        with pytest.raises(BQLError):
+            bdb.execute('ALTER GENERATOR g2 MODEL (0) INCORPORATE NEW ROWS')
+        # Unknown categories are refused, and nothing is incorporated.
+        with pytest.raises(BQLError):
+            bdb.execute('ALTER GENERATOR g2 INCORPORATE NEW ROWS')
+        assert backend._engine_stamp(bdb, generator_id) == stamp
+        assert backend._cgpm_rowids(bdb, generator_id, rowids[-2:]) == \
+            [-1, -1]
+        for state in backend._engine(bdb, generator_id).states:
+            assert state.n_rows() == 27
+        # Rows with no values of the modeled variables are left out.
+        bdb.sql_execute('''
+            UPDATE t SET cat = NULL WHERE _rowid_ = ?
+        ''', (rowids[-1],))
+        bdb.execute('ALTER GENERATOR g2 INCORPORATE NEW ROWS')
+        assert stamp < backend._engine_stamp(bdb, generator_id)
+        assert backend._cgpm_rowids(bdb, generator_id, rowids[-2:]) == \
+            [27, -1]
+        engine = backend._engine(bdb, generator_id)
+        for state in engine.states:
+            assert state.n_rows() == 28
+        # Similarity to the incorporated row is defined in every row.
+        similarities = bdb.execute('''
+            ESTIMATE SIMILARITY TO (_rowid_ = ?) IN THE CONTEXT OF output
+                FROM p MODELED BY g2
+        ''', (rowids[-2],)).fetchall()
+        assert len(similarities) == 29
+        assert not any(math.isnan(s) for (s,) in similarities[:-1])
+        bdb.execute('CREATE GENERATOR g3 FOR p USING cgpm (SUBSAMPLE 10)')
+        bdb.execute('INITIALIZE 1 MODEL FOR g3')
+        with pytest.raises(BQLError):
+            bdb.execute('ALTER GENERATOR g3 INCORPORATE NEW ROWS')
+
+def test_cgpm_incorporate_new_rows_out_of_order():
+    # A row left out while it has no values is incorporated after rows
+    # inserted after it, so cgpm rowids are not in order of table rowid.
+    # The values of variables added later, and the data given to models
+    # initialized later, still go to the right rows.
+    with cgpm_smoke_bdb() as bdb:
+        bdb.sql_execute('ALTER TABLE t ADD COLUMN extra')
+        bdb.execute('CREATE GENERATOR g2 FOR p USING cgpm')
+        bdb.execute('INITIALIZE 2 MODELS FOR g2')
+        backend = bdb.backends['cgpm']
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'g2')
+        bdb.sql_execute('''
+            INSERT INTO t (output, cat, input, extra)
+                VALUES (NULL, NULL, NULL, 100)
+        ''')
+        bdb.sql_execute('''
+            INSERT INTO t (output, cat, input, extra)
+                VALUES (2.5, NULL, NULL, 200)
+        ''')
+        rowids = [rowid for (rowid,) in
+            bdb.sql_execute('SELECT _rowid_ FROM t ORDER BY _rowid_')][-2:]
+        bdb.execute('ALTER GENERATOR g2 INCORPORATE NEW ROWS')
+        assert backend._cgpm_rowids(bdb, generator_id, rowids) == [-1, 27]
+        bdb.sql_execute('''
+            UPDATE t SET output = 3.5 WHERE _rowid_ = ?
+        ''', (rowids[0],))
+        bdb.execute('ALTER GENERATOR g2 INCORPORATE NEW ROWS')
+        assert backend._cgpm_rowids(bdb, generator_id, rowids) == [28, 27]
+        def colno(var):
+            return bayesdb_variable_number(
+                bdb, population_id, generator_id, var)
+        def check_row_values(var, values):
+            engine = backend._engine(bdb, generator_id)
+            for state in engine.states:
+                assert [state.X[colno(var)][cgpm_rowid]
+                    for cgpm_rowid in [27, 28]] == values
+        check_row_values('output', [2.5, 3.5])
+        bdb.execute('ALTER POPULATION p ADD VARIABLE extra NUMERICAL')
+        check_row_values('extra', [200, 100])
+        bdb.execute('DROP MODELS FROM g2')
+        bdb.execute('INITIALIZE 2 MODELS FOR g2')
+        check_row_values('output', [2.5, 3.5])
+        check_row_values('extra', [200, 100])
+
 
 # Use dummy, quick version of Kepler's laws.  Allow an extra
 # distribution argument to make sure it gets passed through.
@@ -1013,6 +1172,21 @@ def test_add_drop_models():
         population_id = bayesdb_get_population(bdb, 'p')
         generator_id = bayesdb_get_generator(bdb, population_id, 'm')
 
+        # The subsampled individuals are numbered in order of table rowid.
+        individuals = bdb.sql_execute('''
+            SELECT table_rowid, cgpm_rowid FROM bayesdb_cgpm_individual
+            WHERE generator_id = ? ORDER BY table_rowid ASC
+        ''', (generator_id,)).fetchall()
+        assert [cgpm_rowid for _rowid, cgpm_rowid in individuals] == \
+            range(10)
+        # Each nominal column has codes 0, 1, ..., one per distinct value.
+        for colno, count, low, high in bdb.sql_execute('''
+            SELECT colno, COUNT(*), MIN(code), MAX(code)
+            FROM bayesdb_cgpm_category WHERE generator_id = ?
+            GROUP BY colno
+        ''', (generator_id,)):
+            assert (low, high) == (0, count - 1)
+
         def check_modelno_mapping(lookup):
             pairs = bdb.sql_execute('''
                 SELECT modelno, cgpm_modelno FROM bayesdb_cgpm_modelno
@@ -1226,3 +1400,209 @@ def test_using_modelnos():
                 ESTIMATE PREDICTIVE PROBABILITY OF period FROM satellites
                 USING MODELS 0-8 LIMIT 2;
             ''')
+
+def test_pairwise_dependence_probability():
+    with cgpm_smoke_bdb() as bdb:
+        bdb.execute('CREATE GENERATOR g FOR p USING cgpm')
+        bdb.execute('INITIALIZE 4 MODELS FOR g')
+        bdb.execute('ANALYZE g FOR 2 ITERATION')
+        for modelnos in ['', 'USING MODELS 1-2']:
+            pairwise = bdb.execute('''
+                ESTIMATE DEPENDENCE PROBABILITY FROM PAIRWISE VARIABLES OF p
+                %s
+            ''' % (modelnos,)).fetchall()
+            assert len(pairwise) == 9
+            for _population_id, name0, name1, depprob in pairwise:
+                assert depprob == cursor_value(bdb.execute('''
+                    ESTIMATE DEPENDENCE PROBABILITY OF %s WITH %s
+                    BY p %s
+                ''' % (name0, name1, modelnos)))
+        # Restricted to some of the variables, and in the condition.
+        pairwise = bdb.execute('''
+            ESTIMATE DEPENDENCE PROBABILITY
+            FROM PAIRWISE VARIABLES OF p FOR output, cat
+            WHERE DEPENDENCE PROBABILITY >= 0
+        ''').fetchall()
+        assert len(pairwise) == 4
+
+def test_pairwise_similarity():
+    with cgpm_smoke_bdb() as bdb:
+        bdb.execute('CREATE GENERATOR g FOR p USING cgpm')
+        bdb.execute('INITIALIZE 4 MODELS FOR g')
+        bdb.execute('ANALYZE g FOR 2 ITERATION')
+        for modelnos in ['', 'USING MODELS 1-2']:
+            pairwise = bdb.execute('''
+                ESTIMATE SIMILARITY IN THE CONTEXT OF cat
+                FROM PAIRWISE p %s
+            ''' % (modelnos,)).fetchall()
+            assert len(pairwise) == 27 * 27
+            for rowid0, rowid1, similarity in pairwise[::13]:
+                assert similarity == cursor_value(bdb.execute('''
+                    ESTIMATE SIMILARITY TO (_rowid_ = ?)
+                    IN THE CONTEXT OF cat
+                    FROM p %s WHERE _rowid_ = ?
+                ''' % (modelnos,), (rowid1, rowid0)))
+        # Computed block by block.
+        pairwise = bdb.execute('''
+            ESTIMATE SIMILARITY IN THE CONTEXT OF cat FROM PAIRWISE p
+        ''').fetchall()
+        bqlvtab.SimilarityCursor.BLOCK_SIZE = 27 * 5
+        try:
+            blocked = bdb.execute('''
+                ESTIMATE SIMILARITY IN THE CONTEXT OF cat FROM PAIRWISE p
+            ''').fetchall()
+        finally:
+            bqlvtab.SimilarityCursor.BLOCK_SIZE = 1 << 20
+        assert blocked == pairwise
+
+def test_batched_queries():
+    with cgpm_smoke_bdb() as bdb:
+        bdb.execute('CREATE GENERATOR g FOR p USING cgpm')
+        bdb.execute('INITIALIZE 4 MODELS FOR g')
+        bdb.execute('ANALYZE g FOR 2 ITERATION')
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'g')
+        backend = bdb.backends['cgpm']
+        output = bayesdb_variable_number(bdb, population_id, None, 'output')
+        cat = bayesdb_variable_number(bdb, population_id, None, 'cat')
+        # Incorporated rows, and a hypothetical row.
+        rowids = range(1, 28) + [100]
+        for modelnos in [None, [1, 2]]:
+            queries = [(rowid, [(output, 1)], []) for rowid in rowids] + \
+                [(rowid, [(output, 1)], [(cat, 1)]) for rowid in rowids]
+            batched = backend.logpdf_joint_many(
+                bdb, generator_id, modelnos, queries)
+            assert len(batched) == len(queries)
+            for query, logpdf in zip(queries, batched):
+                assert np.allclose(logpdf, backend.logpdf_joint(
+                    bdb, generator_id, modelnos, *query))
+        # Targets with nan values are marginalized out, as constraints are.
+        nan = float('nan')
+        queries = [
+            (1, [(output, nan)], []),
+            (1, [(output, nan), (cat, 1)], [(output, nan)]),
+            (100, [(output, nan), (cat, 1)], [(output, 1)]),
+        ]
+        assert np.allclose(
+            backend.logpdf_joint_many(bdb, generator_id, None, queries), [
+                0,
+                backend.logpdf_joint(bdb, generator_id, None, 1,
+                    [(cat, 1)], []),
+                backend.logpdf_joint(bdb, generator_id, None, 100,
+                    [(cat, 1)], [(output, 1)]),
+            ])
+        assert backend.logpdf_joint(
+            bdb, generator_id, None, 1, [(output, nan)], []) == 0
+        samples = backend.simulate_joint_many(
+            bdb, generator_id, None,
+            [(rowid, [output, cat], []) for rowid in rowids], num_samples=3)
+        assert len(samples) == len(rowids)
+        assert all(len(s) == 3 and all(len(r) == 2 for r in s)
+            for s in samples)
+        predictions = backend.predict_confidence_many(
+            bdb, generator_id, None, [(rowid, cat) for rowid in rowids])
+        assert len(predictions) == len(rowids)
+        assert all(0 <= confidence <= 1
+            for _value, confidence in predictions)
+        # Cells of incorporated rows are predicted exactly rather than by
+        # sampling: the same every time, in batches or one by one.
+        queries = [(rowid, colno)
+            for rowid in rowids if rowid != 100 for colno in [output, cat]]
+        predictions = backend.predict_confidence_many(
+            bdb, generator_id, None, queries, numsamples=1)
+        assert predictions == backend.predict_confidence_many(
+            bdb, generator_id, None, queries, numsamples=1)
+        for (rowid, colno), (value, confidence) in zip(queries, predictions):
+            value_one, confidence_one = backend.predict_confidence(
+                bdb, generator_id, None, rowid, colno)
+            assert value_one == value
+            assert np.allclose(confidence_one, confidence)
+            if colno == cat:
+                assert 0 < confidence <= 1
+            else:
+                assert isinstance(value, float)
+
+def test_predict_exact():
+    with cgpm_smoke_bdb() as bdb:
+        bdb.execute('CREATE GENERATOR g FOR p USING cgpm')
+        bdb.execute('INITIALIZE 4 MODELS FOR g')
+        bdb.execute('ANALYZE g FOR 2 ITERATION')
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'g')
+        backend = bdb.backends['cgpm']
+        engine = backend._engine(bdb, generator_id)
+        codebook = backend._codebook(bdb, generator_id)
+        output = bayesdb_variable_number(bdb, population_id, None, 'output')
+        cat = bayesdb_variable_number(bdb, population_id, None, 'cat')
+        # Rows 13, 14, and 15 have neither output nor cat.
+        for rowid in [13, 14, 15]:
+            cgpm_rowid = backend._cgpm_rowid(bdb, generator_id, rowid)
+            # Mean of the predictive of the row's cluster in each state.
+            means = []
+            for state in engine.states:
+                view = state.views[state.Zv(output)]
+                cluster = view.dims[output].clusters[view.Zr(cgpm_rowid)]
+                hypers = cluster.get_hypers()
+                suffstats = cluster.get_suffstats()
+                means.append(
+                    (hypers['r']*hypers['m'] + suffstats['sum_x'])
+                        / (hypers['r'] + suffstats['N']))
+            value, confidence = backend.predict_confidence(
+                bdb, generator_id, None, rowid, output)
+            assert np.allclose(value, np.mean(means))
+            assert 0 <= confidence <= 1
+            # Probability of each category, averaged over the states.
+            values = codebook['values'][cat]
+            p = np.mean([
+                [np.exp(state.logpdf(cgpm_rowid, {cat: code}))
+                    for code in xrange(len(values))]
+                for state in engine.states
+            ], axis=0)
+            value, confidence = backend.predict_confidence(
+                bdb, generator_id, None, rowid, cat)
+            assert value == values[np.argmax(p)]
+            assert np.allclose(confidence, np.max(p) / np.sum(p))
+        # Observed cells are predicted as themselves, with certainty.
+        assert backend.predict_confidence(
+            bdb, generator_id, None, 1, output) == (0, 1)
+
+def test_batched_row_functions():
+    with cgpm_smoke_bdb() as bdb:
+        bdb.execute('CREATE GENERATOR g FOR p USING cgpm')
+        bdb.execute('INITIALIZE 4 MODELS FOR g')
+        bdb.execute('ANALYZE g FOR 2 ITERATION')
+        population_id = bayesdb_get_population(bdb, 'p')
+        output = bayesdb_variable_number(bdb, population_id, None, 'output')
+        cat = bayesdb_variable_number(bdb, population_id, None, 'cat')
+        # Compare with the row-by-row function, a few rows per block.
+        bqlvtab._RowBlockCursor.BLOCK_SIZE = 4
+        try:
+            batched = bdb.execute('''
+                ESTIMATE _rowid_, PREDICTIVE PROBABILITY OF output GIVEN (cat)
+                FROM p WHERE _rowid_ NOT IN (3, 4, 9, 20)
+            ''').fetchall()
+        finally:
+            bqlvtab._RowBlockCursor.BLOCK_SIZE = 1 << 12
+        assert [rowid for rowid, _p in batched] == \
+            [rowid for rowid in range(1, 28) if rowid not in (3, 4, 9, 20)]
+        for rowid, p in batched:
+            expected = cursor_value(bdb.sql_execute('''
+                SELECT bql_row_column_predictive_probability(?, NULL, NULL,
+                    ?, ?, ?)
+            ''', (population_id, rowid, '[%d]' % (output,),
+                '[%d]' % (cat,))))
+            if expected is None:
+                assert p is None
+            else:
+                assert np.allclose(p, expected)
+        # Every row gets a prediction and confidence, and the threshold
+        # applies to the confidence.
+        inferred = bdb.execute('''
+            INFER EXPLICIT rowid, PREDICT cat CONFIDENCE cat_conf
+            USING 4 SAMPLES FROM p
+        ''').fetchall()
+        assert len(inferred) == 27
+        assert all(0 <= conf <= 1 for _rowid, _cat, conf in inferred)
+        assert all(value is None for (value,) in bdb.execute('''
+            INFER EXPLICIT PREDICT cat WITH CONFIDENCE 1.1 FROM p
+        '''))
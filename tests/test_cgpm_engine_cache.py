@@ -17,6 +17,8 @@
 from StringIO import StringIO
 
 import bayeslite
+import math
+import pytest
 import tempfile
 
 import test_csv
@@ -107,3 +109,462 @@ def test_engine_stamp_two_clients():
 
             # Engine in cache of bdb0 should be stale, since bdb2 analyzed.
             assert cgpm_backend._engine_latest(bdb0, generator_id) is None
+
+
+def test_engine_formats():
+    """Confirm engines are stored in binary and legacy JSON is readable."""
+    from bayeslite.backends import cgpm_serialize
+    from bayeslite.backends.cgpm_backend import CGPM_Backend
+    from bayeslite.util import json_dumps
+    for engine_format in ['binary', 'zlib', 'json']:
+        with bayeslite.bayesdb_open(':memory:', builtin_backends=False) \
+                as bdb:
+            cgpm_backend = CGPM_Backend(dict(), multiprocess=0,
+                engine_format=engine_format)
+            bayeslite.bayesdb_register_backend(bdb, cgpm_backend)
+            bayeslite.bayesdb_read_csv(bdb, 't',
+                StringIO(test_csv.csv_data), header=True, create=True)
+            bdb.execute('''
+                CREATE POPULATION p FOR t (
+                    age NUMERICAL;
+                    gender NOMINAL;
+                    salary NUMERICAL;
+                    height IGNORE;
+                    division NOMINAL;
+                    rank NOMINAL;
+                )
+            ''')
+            bdb.execute('CREATE GENERATOR m FOR p;')
+            bdb.execute('INITIALIZE 2 MODELS FOR m;')
+            bdb.execute('ANALYZE m FOR 1 ITERATION')
+            engine_json = bdb.sql_execute('''
+                SELECT engine_json FROM bayesdb_cgpm_generator
+            ''').fetchvalue()
+            assert cgpm_serialize.is_binary(engine_json) == \
+                (engine_format != 'json')
+            population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+            generator_id = bayeslite.core.bayesdb_get_generator(
+                bdb, population_id, 'm')
+            expected = json_dumps(
+                cgpm_backend._engine(bdb, generator_id).to_metadata())
+            cgpm_backend._del_cache_entry(bdb, generator_id, 'engine')
+            engine = cgpm_backend._engine(bdb, generator_id)
+            assert json_dumps(engine.to_metadata()) == expected
+            bdb.execute('SIMULATE age FROM p LIMIT 1;').fetchall()
+
+
+def test_engine_per_model_states():
+    """Confirm models are stored, loaded, and dropped one by one."""
+    with bayeslite.bayesdb_open(':memory:') as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('''
+            CREATE POPULATION p FOR t (
+                age NUMERICAL;
+                gender NOMINAL;
+                salary NUMERICAL;
+                height IGNORE;
+                division NOMINAL;
+                rank NOMINAL;
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        cgpm_backend = bdb.backends['cgpm']
+        population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+        generator_id = bayeslite.core.bayesdb_get_generator(
+            bdb, population_id, 'm')
+        def state_stamps():
+            return dict(bdb.sql_execute('''
+                SELECT cgpm_modelno, state_stamp FROM bayesdb_cgpm_state
+                    WHERE generator_id = ?
+            ''', (generator_id,)))
+        bdb.execute('INITIALIZE 4 MODELS FOR m;')
+        assert state_stamps() == {0: 1, 1: 1, 2: 1, 3: 1}
+        # Analyzing one model writes only its state.
+        bdb.execute('ANALYZE m MODEL 2 FOR 1 ITERATION')
+        assert state_stamps() == {0: 1, 1: 1, 2: 2, 3: 1}
+        # Querying some models loads only their states.
+        cgpm_backend._del_cache_entry(bdb, generator_id, None)
+        bdb.execute('''
+            ESTIMATE PROBABILITY DENSITY OF age = 30 BY p
+                MODELED BY m USING MODELS 1-2
+        ''').fetchall()
+        engine = cgpm_backend._engine_latest(bdb, generator_id)
+        assert [state is not None for state in engine.states] == \
+            [False, True, True, False]
+        # Queries and analyses of some models work on them alone while the
+        # others are not loaded.
+        cgpm_backend._del_cache_entry(bdb, generator_id, None)
+        assert len(bdb.execute('''
+            SIMULATE age, gender FROM p MODELED BY m USING MODEL 1 LIMIT 3
+        ''').fetchall()) == 3
+        bdb.execute('''
+            ESTIMATE PROBABILITY DENSITY OF age = 30 GIVEN (gender = 'F')
+                BY p MODELED BY m USING MODELS 1-2
+        ''').fetchall()
+        bdb.execute('''
+            ESTIMATE MUTUAL INFORMATION OF age WITH salary USING 2 SAMPLES
+                BY p MODELED BY m USING MODEL 2
+        ''').fetchall()
+        bdb.execute('ANALYZE m MODEL 1 FOR 1 ITERATION')
+        bdb.execute('''
+            ALTER GENERATOR m MODEL (1) ENSURE VARIABLES * DEPENDENT
+        ''')
+        assert state_stamps() == {0: 1, 1: 4, 2: 2, 3: 1}
+        engine = cgpm_backend._engine_latest(bdb, generator_id)
+        assert [state is not None for state in engine.states] == \
+            [False, True, True, False]
+        # Appending models writes only the new states.
+        bdb.execute('INITIALIZE 5 MODELS IF NOT EXISTS FOR m;')
+        assert state_stamps() == {0: 1, 1: 4, 2: 2, 3: 1, 4: 5}
+        # Dropping models renumbers the states after them.
+        bdb.execute('DROP MODEL 1 FROM m')
+        assert state_stamps() == {0: 1, 1: 6, 2: 6, 3: 6}
+        assert cgpm_backend._engine_stamp(bdb, generator_id) == 6
+        engine = cgpm_backend._engine(bdb, generator_id)
+        assert engine.num_states() == 4
+        assert all(state is not None for state in engine.states)
+        bdb.execute('SIMULATE age FROM p MODELED BY m USING MODEL 3 LIMIT 1')\
+            .fetchall()
+
+
+def test_engine_cache_budget():
+    """Confirm engines are evicted least recently used first."""
+    with bayeslite.bayesdb_open(':memory:') as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('''
+            CREATE POPULATION p FOR t (
+                age NUMERICAL;
+                gender NOMINAL;
+                salary NUMERICAL;
+                height IGNORE;
+                division NOMINAL;
+                rank NOMINAL;
+            )
+        ''')
+        cgpm_backend = bdb.backends['cgpm']
+        population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+        generator_ids = []
+        for name in ['m0', 'm1']:
+            bdb.execute('CREATE GENERATOR %s FOR p;' % (name,))
+            bdb.execute('INITIALIZE 1 MODEL FOR %s;' % (name,))
+            generator_ids.append(bayeslite.core.bayesdb_get_generator(
+                bdb, population_id, name))
+        old = cgpm_backend.set_cache_bytes(1)
+        try:
+            stats = cgpm_backend.cache_stats()
+            bdb.execute('SIMULATE age FROM p MODELED BY m0 LIMIT 1')\
+                .fetchall()
+            bdb.execute('SIMULATE age FROM p MODELED BY m0 LIMIT 1')\
+                .fetchall()
+            after = cgpm_backend.cache_stats()
+            assert after['misses'] == stats['misses'] + 1
+            assert after['hits'] >= stats['hits'] + 1
+            assert 0 < after['bytes']
+            assert cgpm_backend._engine_latest(bdb, generator_ids[0]) \
+                is not None
+            # Loading the other engine evicts the first, over budget.
+            bdb.execute('SIMULATE age FROM p MODELED BY m1 LIMIT 1')\
+                .fetchall()
+            assert cgpm_backend._engine_latest(bdb, generator_ids[0]) is None
+            assert cgpm_backend._engine_latest(bdb, generator_ids[1]) \
+                is not None
+            assert cgpm_backend.cache_stats()['evictions'] > \
+                after['evictions']
+        finally:
+            cgpm_backend.set_cache_bytes(old)
+
+
+def test_codebook():
+    """Confirm categories are coded in bulk from the cached codebook."""
+    with bayeslite.bayesdb_open(':memory:') as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('''
+            CREATE POPULATION p FOR t (
+                age NUMERICAL;
+                gender NOMINAL;
+                salary NUMERICAL;
+                height IGNORE;
+                division NOMINAL;
+                rank NOMINAL;
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        bdb.execute('INITIALIZE 1 MODEL FOR m;')
+        cgpm_backend = bdb.backends['cgpm']
+        population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+        generator_id = bayeslite.core.bayesdb_get_generator(
+            bdb, population_id, 'm')
+        colno = bayeslite.core.bayesdb_variable_number(
+            bdb, population_id, generator_id, 'rank')
+        def code(value):
+            return bdb.sql_execute('''
+                SELECT code FROM bayesdb_cgpm_category
+                    WHERE generator_id = ? AND colno = ? AND value = ?
+            ''', (generator_id, colno, value)).fetchvalue()
+        codes = cgpm_backend._to_numeric_column(
+            bdb, generator_id, colno, [3, '4', None, 'nope', 2.0])
+        assert codes[:2] == [code(3), code('4')]
+        assert all(math.isnan(c) for c in codes[2:])
+        assert cgpm_backend._from_numeric_column(
+            bdb, generator_id, colno, codes[:3]) == ['3', '4', None]
+        with pytest.raises(bayeslite.BQLError):
+            cgpm_backend._from_numeric_column(
+                bdb, generator_id, colno, [100.])
+        # The codebook is cached until categories are added, which
+        # analysis does not do.
+        codebook = cgpm_backend._codebook(bdb, generator_id)
+        assert cgpm_backend._codebook(bdb, generator_id) is codebook
+        bdb.execute('ANALYZE m FOR 1 ITERATION')
+        assert cgpm_backend._codebook(bdb, generator_id) is codebook
+        # Categories added by another client are noticed.
+        bdb.sql_execute('''
+            INSERT INTO bayesdb_cgpm_category
+                (generator_id, colno, value, code)
+                SELECT generator_id, colno, 'new', MAX(code) + 1
+                    FROM bayesdb_cgpm_category
+                    WHERE generator_id = ? AND colno = ?
+        ''', (generator_id, colno))
+        assert cgpm_backend._codebook(bdb, generator_id) is not codebook
+        assert cgpm_backend._to_numeric_column(
+            bdb, generator_id, colno, ['new']) == [code('new')]
+
+
+def test_rowid_map():
+    """Confirm table rowids are mapped to cgpm rowids from the cache."""
+    with bayeslite.bayesdb_open(':memory:') as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('''
+            CREATE POPULATION p FOR t (
+                age NUMERICAL;
+                gender NOMINAL;
+                salary NUMERICAL;
+                height IGNORE;
+                division NOMINAL;
+                rank NOMINAL;
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p (SUBSAMPLE 4);')
+        bdb.execute('INITIALIZE 1 MODEL FOR m;')
+        cgpm_backend = bdb.backends['cgpm']
+        population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+        generator_id = bayeslite.core.bayesdb_get_generator(
+            bdb, population_id, 'm')
+        expected = dict(bdb.sql_execute('''
+            SELECT table_rowid, cgpm_rowid FROM bayesdb_cgpm_individual
+                WHERE generator_id = ?
+        ''', (generator_id,)))
+        assert len(expected) == 4
+        rowids = range(0, 10)
+        cgpm_rowids = [expected.get(rowid, -1) for rowid in rowids]
+        assert cgpm_backend._cgpm_rowids(bdb, generator_id, rowids) == \
+            cgpm_rowids
+        assert [cgpm_backend._cgpm_rowid(bdb, generator_id, rowid)
+            for rowid in rowids] == cgpm_rowids
+        with pytest.raises(ValueError):
+            cgpm_backend._cgpm_rowid(bdb, generator_id, 100, nullok=False)
+        # Rows left out of the subsample, or inserted later, are constrained
+        # by their values in the table.
+        bdb.sql_execute('''
+            INSERT INTO t (age, gender, salary, height, division, rank)
+                VALUES (40, 'F', 90000, 68, 'sales', 3)
+        ''')
+        rowids = [rowid for (rowid,) in bdb.sql_execute('SELECT oid FROM t')]
+        unincorporated = [rowid for rowid in rowids if rowid not in expected]
+        assert len(unincorporated) == 4
+        table_constraints = cgpm_backend._retrieve_table_constraints_many(
+            bdb, generator_id, rowids + [100])
+        assert sorted(table_constraints) == unincorporated
+        for rowid in rowids + [100]:
+            assert cgpm_backend._retrieve_table_constraints(
+                bdb, generator_id, rowid) == table_constraints.get(rowid, [])
+        # Rows incorporated by another client are noticed by the engine
+        # stamp written with them.
+        new_rowid = max(unincorporated)
+        bdb.sql_execute('''
+            INSERT INTO bayesdb_cgpm_individual
+                (generator_id, table_rowid, cgpm_rowid)
+                VALUES (?, ?, 4)
+        ''', (generator_id, new_rowid))
+        bdb.sql_execute('''
+            UPDATE bayesdb_cgpm_generator SET engine_stamp = engine_stamp + 1
+                WHERE generator_id = ?
+        ''', (generator_id,))
+        assert cgpm_backend._cgpm_rowids(bdb, generator_id, [new_rowid]) == [4]
+        table_constraints = cgpm_backend._retrieve_table_constraints_many(
+            bdb, generator_id, rowids)
+        assert sorted(table_constraints) == unincorporated[:-1]
+
+
+def test_data_array():
+    """Confirm table data are loaded as an array of codes and NaNs."""
+    with bayeslite.bayesdb_open(':memory:') as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.sql_execute('''
+            INSERT INTO t (age, gender, salary, height, division, rank)
+                VALUES (NULL, 'F', 90000, 68, NULL, 3)
+        ''')
+        bdb.execute('''
+            CREATE POPULATION p FOR t (
+                age NUMERICAL;
+                gender NOMINAL;
+                salary NUMERICAL;
+                height IGNORE;
+                division NOMINAL;
+                rank NOMINAL;
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        cgpm_backend = bdb.backends['cgpm']
+        population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+        generator_id = bayeslite.core.bayesdb_get_generator(
+            bdb, population_id, 'm')
+        data = cgpm_backend._data(bdb, generator_id, ['age', 'division'])
+        assert data.shape == (8, 2)
+        assert data.dtype == float
+        rows = bdb.sql_execute('SELECT age, division FROM t ORDER BY oid')\
+            .fetchall()
+        colno = bayeslite.core.bayesdb_variable_number(
+            bdb, population_id, generator_id, 'division')
+        for (age, division), row in zip(rows, data.tolist()):
+            if age is None:
+                assert math.isnan(row[0])
+            else:
+                assert row[0] == age
+            if division is None:
+                assert math.isnan(row[1])
+            else:
+                assert cgpm_backend._from_numeric(
+                    bdb, generator_id, colno, row[1]) == division
+        bdb.execute('INITIALIZE 1 MODEL FOR m;')
+        bdb.execute('SIMULATE age, division FROM p LIMIT 2').fetchall()
+
+
+def test_state_pool_queries():
+    """Confirm multiprocess queries run on states resident in workers."""
+    from bayeslite.backends.cgpm_backend import CGPM_Backend
+    with bayeslite.bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        cgpm_backend = CGPM_Backend(dict(), multiprocess=True)
+        bayeslite.bayesdb_register_backend(bdb, cgpm_backend)
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('''
+            CREATE POPULATION p FOR t (
+                age NUMERICAL;
+                gender NOMINAL;
+                salary NUMERICAL;
+                height IGNORE;
+                division NOMINAL;
+                rank NOMINAL;
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        bdb.execute('INITIALIZE 2 MODELS FOR m;')
+        # Evaluate every call on more than one state in parallel.
+        cgpm_backend._costs.choose = \
+            lambda kind, num_states, units: num_states > 1
+        try:
+            bdb.execute('ANALYZE m FOR 1 ITERATION')
+            assert cgpm_backend._pool is None
+            samples = bdb.execute('''
+                SIMULATE age, gender FROM p LIMIT 4
+            ''').fetchall()
+            assert len(samples) == 4
+            assert cgpm_backend._pool is not None
+            resident = dict(cgpm_backend._pool._resident)
+            assert len(resident) == 2
+            # The states share one copy of the data, here and in the
+            # workers.
+            generator_id = bayeslite.core.bayesdb_get_generator(
+                bdb, None, 'm')
+            engine = cgpm_backend._get_cache_entry(bdb, generator_id, 'engine')
+            assert all(engine.states[1].X[colno] is values
+                for colno, values in engine.states[0].X.iteritems())
+            assert len(cgpm_backend._pool._data) == 1
+            densities = bdb.execute('''
+                ESTIMATE PROBABILITY DENSITY OF age = 30 GIVEN (gender = 'F')
+                    BY p
+            ''').fetchall()
+            assert len(densities) == 1
+            # ANALYZE pushes the analyzed states to the workers.
+            bdb.execute('ANALYZE m MODEL 1 FOR 1 ITERATION')
+            assert cgpm_backend._pool._resident[min(resident)] == \
+                resident[min(resident)]
+            assert cgpm_backend._pool._resident[max(resident)] != \
+                resident[max(resident)]
+            bdb.execute('''
+                ESTIMATE DEPENDENCE PROBABILITY OF age WITH salary BY p
+            ''').fetchall()
+            # The analysis of one model was transitioned in process.
+            stats = cgpm_backend.execution_stats()
+            assert stats['transition']['parallel'] == 1
+            assert stats['transition']['serial'] == 1
+            assert stats['dependence_probability']['parallel'] == 1
+            assert all(stats[kind]['serial'] == 0
+                for kind in stats if kind != 'transition')
+            # States analyzed in the workers come back to the one copy of
+            # the data, which the workers are not sent again.
+            data = dict(engine.states[0].X)
+            bdb.execute('ANALYZE m FOR 1 ITERATION')
+            assert cgpm_backend.execution_stats()['transition']['parallel'] \
+                == 2
+            engine = cgpm_backend._get_cache_entry(bdb, generator_id, 'engine')
+            assert all(state.X[colno] is values
+                for state in engine.states
+                for colno, values in data.iteritems())
+            [pool_data] = cgpm_backend._pool._data.values()
+            assert all(values is data[colno]
+                for colno, values in pool_data.iteritems())
+        finally:
+            cgpm_backend.set_multiprocess(False)
+        assert cgpm_backend._pool is None
+
+def test_state_pool_deterministic():
+    """Confirm evaluating in parallel or in process gives the same results."""
+    from bayeslite.backends.cgpm_backend import CGPM_Backend
+    def queries(parallel):
+        with bayeslite.bayesdb_open(':memory:', builtin_backends=False) as bdb:
+            cgpm_backend = CGPM_Backend(dict(), multiprocess=True)
+            bayeslite.bayesdb_register_backend(bdb, cgpm_backend)
+            bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+                header=True, create=True)
+            bdb.execute('''
+                CREATE POPULATION p FOR t (
+                    age NUMERICAL;
+                    gender NOMINAL;
+                    salary NUMERICAL;
+                    height IGNORE;
+                    division NOMINAL;
+                    rank NOMINAL;
+                )
+            ''')
+            bdb.execute('CREATE GENERATOR m FOR p;')
+            bdb.execute('INITIALIZE 3 MODELS FOR m;')
+            # Transition alike, and evaluate queries one way or the other.
+            cgpm_backend._costs.choose = \
+                lambda kind, num_states, units: \
+                    parallel and kind != 'transition'
+            try:
+                bdb.execute('ANALYZE m FOR 1 ITERATION')
+                results = bdb.execute('''
+                    SIMULATE age, gender FROM p LIMIT 4
+                ''').fetchall()
+                results += bdb.execute('''
+                    ESTIMATE PROBABILITY DENSITY OF age = 30
+                        GIVEN (gender = 'F') BY p
+                ''').fetchall()
+                results += bdb.execute('''
+                    SIMULATE salary FROM p GIVEN division = 'sales' LIMIT 3
+                ''').fetchall()
+                stats = cgpm_backend.execution_stats()
+                assert all(
+                    stats[kind]['parallel' if parallel else 'serial'] > 0
+                    for kind in stats if kind != 'transition')
+            finally:
+                cgpm_backend.set_multiprocess(False)
+            return results
+    assert queries(True) == queries(False)
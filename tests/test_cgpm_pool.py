@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import gc
+import os
+import random
+
+import pytest
+
+from bayeslite.backends import cgpm_pool
+from bayeslite.backends.cgpm_pool import CostModel
+from bayeslite.backends.cgpm_pool import StatePool
+from bayeslite.backends.cgpm_pool import share_data
+from bayeslite.backends.cgpm_pool import unshare_data
+
+class Rng(object):
+    def __init__(self):
+        self.seeded = None
+    def seed(self, seed):
+        self.seeded = seed
+
+class State(object):
+    def __init__(self, value, X):
+        self.value = value
+        self.rng = Rng()
+        self.X = {colno: list(values) for colno, values in X.iteritems()}
+        self.hooked_cgpms = {}
+    def evaluate(self, x, y=0):
+        if x is None:
+            raise ValueError('no x')
+        return (self.value, x + y, self.rng.seeded, os.getpid())
+    def datum(self, colno, rowid):
+        values = self.X[colno]
+        return (values[rowid], isinstance(values, list))
+
+class Engine(object):
+    def __init__(self, values, X=None):
+        self.states = [State(value, X or {}) for value in values]
+
+def test_state_pool():
+    pool = StatePool(processes=2)
+    try:
+        engine = Engine(['a', 'b', 'c'])
+        stamps = {0: 1, 1: 1, 2: 1}
+        results = pool.map(
+            engine, [2, 0], stamps, 'evaluate', (1,), {'y': 2}, [7, 8])
+        assert [r[:3] for r in results] == [('c', 3, 7), ('a', 3, 8)]
+        assert all(r[3] != os.getpid() for r in results)
+        # States are resident: changing them here does not change them in
+        # the workers until their stamps change.
+        engine.states[0].value = 'A'
+        results = pool.map(engine, [0], stamps, 'evaluate', (1,), {}, [0])
+        assert results[0][0] == 'a'
+        stamps[0] = 2
+        results = pool.map(engine, [0], stamps, 'evaluate', (1,), {}, [0])
+        assert results[0][0] == 'A'
+        engine.states[1].value = 'B'
+        stamps[1] = 2
+        pool.push(engine, [1], stamps)
+        results = pool.map(engine, [1], stamps, 'evaluate', (1,), {}, [0])
+        assert results[0][0] == 'B'
+        # Errors in the workers are raised here.
+        with pytest.raises(ValueError):
+            pool.map(engine, [0, 1], stamps, 'evaluate', (None,), {}, [0, 0])
+        assert pool.map(engine, [1], stamps, 'evaluate', (1,), {}, [0])[0][0] \
+            == 'B'
+        # States of collected engines are dropped.
+        other = Engine(['x'])
+        pool.map(other, [0], {0: 1}, 'evaluate', (1,), {}, [0])
+        assert len(pool._resident) == 4
+        del other
+        gc.collect()
+        assert len(pool._resident) == 3
+    finally:
+        pool.close()
+
+def test_cost_model():
+    costs = CostModel(processes=4)
+    # Serial until timed serially, and always for a single state.
+    assert not costs.choose('simulate', 4, 100)
+    costs.record('simulate', False, 4, 100, 1.)
+    assert costs.choose('simulate', 4, 100)
+    assert not costs.choose('simulate', 1, 100)
+    # Small calls are not worth the overhead.
+    assert not costs.choose('simulate', 4, 1)
+    assert not costs.choose('logpdf', 4, 100)
+    # Parallel calls measure the overhead.
+    costs.record('simulate', True, 4, 100, 2.)
+    assert 0 < costs.stats()['simulate']['overhead'] < 2
+    for _i in xrange(10):
+        costs.record('simulate', True, 4, 100, 2.)
+    assert not costs.choose('simulate', 4, 100)
+    assert costs.choose('simulate', 4, 10000)
+    stats = costs.stats()
+    assert stats['simulate']['serial'] == 1
+    assert stats['simulate']['parallel'] == 11
+    assert stats['simulate']['serial_seconds'] == 1.
+    assert stats['simulate']['per_unit'] == 0.01
+
+def test_state_pool_shared_data():
+    X = {3: [1., 2., float('nan')], 7: [4., 5., 6.]}
+    engine = Engine(['a', 'b', 'c'], X)
+    engine.states[2].hooked_cgpms = {0: None}
+    shared = share_data(engine.states)
+    assert shared == {3: engine.states[0].X[3], 7: engine.states[0].X[7]}
+    assert engine.states[1].X[3] is engine.states[0].X[3]
+    assert engine.states[2].X[3] is not engine.states[0].X[3]
+    pool = StatePool(processes=2)
+    try:
+        stamps = {0: 1, 1: 1, 2: 1}
+        results = pool.map(
+            engine, [0, 1, 2], stamps, 'datum', (7, 1), {}, [0, 0, 0])
+        # The workers map the shared data from a file, and hold their own
+        # copies only of data not shared.
+        assert results == [(5., False), (5., False), (5., True)]
+        assert len(pool._data) == 1
+        # The states sent keep sharing their data here.
+        assert engine.states[1].X[7] is engine.states[0].X[7]
+        assert engine.states[0].X[7] == [4., 5., 6.]
+        # New data is sent with the states which hold it.
+        unshare_data(engine.states)
+        assert engine.states[1].X[7] is not engine.states[0].X[7]
+        for state in engine.states:
+            state.X[7].append(8.)
+        share_data(engine.states)
+        stamps = {0: 2, 1: 2, 2: 2}
+        results = pool.map(
+            engine, [1, 0], stamps, 'datum', (7, 3), {}, [0, 0])
+        assert results == [(8., False), (8., False)]
+    finally:
+        pool.close()
+
+def test_state_pool_shared_data_copies(monkeypatch):
+    saved = []
+    save = cgpm_pool.numpy.save
+    monkeypatch.setattr(cgpm_pool.numpy, 'save',
+        lambda f, array: saved.append(array) or save(f, array))
+    X = {3: [1., float('nan')], 7: [4., 5.]}
+    engine = Engine(['a', 'b'], X)
+    shared = share_data(engine.states)
+    pool = StatePool(processes=2)
+    try:
+        pool.map(engine, [0, 1], {0: 1, 1: 1}, 'datum', (7, 1), {}, [0, 0])
+        assert len(saved) == 1
+        # States transitioned in other processes come back with copies of
+        # the data: they share the copy held already.
+        for state in engine.states:
+            state.X = {colno: list(values)
+                for colno, values in state.X.iteritems()}
+        assert share_data(engine.states, shared) == shared
+        assert all(state.X[3] is shared[3] for state in engine.states)
+        results = pool.map(
+            engine, [0, 1], {0: 2, 1: 2}, 'datum', (7, 1), {}, [0, 0])
+        assert results == [(5., False), (5., False)]
+        assert len(saved) == 1
+        # Copies of the same values are not sent to the workers again.
+        engine.states[0].X = {colno: list(values)
+            for colno, values in engine.states[0].X.iteritems()}
+        results = pool.map(
+            engine, [0, 1], {0: 3, 1: 3}, 'datum', (7, 1), {}, [0, 0])
+        assert results == [(5., False), (5., False)]
+        assert len(saved) == 1
+        # Other values are.
+        for state in engine.states:
+            state.X[7] = [4., 6.]
+        shared = share_data(engine.states, shared)
+        assert shared[7] == [4., 6.]
+        assert engine.states[1].X[7] is engine.states[0].X[7]
+        results = pool.map(
+            engine, [0, 1], {0: 4, 1: 4}, 'datum', (7, 1), {}, [0, 0])
+        assert results == [(6., False), (6., False)]
+        assert len(saved) == 2
+    finally:
+        pool.close()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import math
+import pytest
+
+import bayeslite.backends.cgpm_serialize as cgpm_serialize
+
+from bayeslite.util import json_dumps
+
+
+def _metadata():
+    return {
+        'X': [[float(i), float('nan') if i % 7 == 0 else 1.5 * i]
+            for i in xrange(100)],
+        'Zv': [{'0': 0, '1': 0}, {'0': 1, '1': 1}],
+        'Zrv': [[[i % 3 for i in xrange(100)]]],
+        'outputs': range(1000, 1100),
+        'bools': [True, False] * 50,
+        'mixed': [1, 2.5] * 50,
+        'big': [2**70] * 100,
+        'ragged': [[1.0] * 50, [2.0] * 51],
+        'short': [1.0, 2.0],
+        'cctypes': ['normal', 'categorical'],
+        'hypers': {'mu': 0.5, 'alpha': None},
+    }
+
+
+def _expected():
+    # Same as the legacy JSON format, including unicode strings.
+    return json.loads(json_dumps(_metadata()))
+
+
+def _same(a, b):
+    if isinstance(a, dict):
+        return isinstance(b, dict) and sorted(a) == sorted(b) and \
+            all(_same(a[k], b[k]) for k in a)
+    elif isinstance(a, list):
+        return isinstance(b, list) and len(a) == len(b) and \
+            all(_same(x, y) for x, y in zip(a, b))
+    elif isinstance(a, float) and math.isnan(a):
+        return isinstance(b, float) and math.isnan(b)
+    else:
+        return type(a) == type(b) and a == b
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_round_trip(compress):
+    blob = cgpm_serialize.dumps(_metadata(), compress=compress)
+    assert cgpm_serialize.is_binary(blob)
+    assert cgpm_serialize.is_binary(buffer(blob))
+    assert _same(_expected(), cgpm_serialize.loads(blob))
+    assert _same(_expected(), cgpm_serialize.loads(buffer(blob), threads=1))
+
+
+def test_chunks(monkeypatch):
+    monkeypatch.setattr(cgpm_serialize, 'CHUNK_SIZE', 64)
+    for compress in [False, True]:
+        blob = cgpm_serialize.dumps(_metadata(), compress=compress, threads=4)
+        assert _same(_expected(), cgpm_serialize.loads(blob, threads=4))
+
+
+def test_not_binary():
+    metadata = _metadata()
+    assert not cgpm_serialize.is_binary(None)
+    assert not cgpm_serialize.is_binary(json_dumps(metadata))
+    with pytest.raises(ValueError):
+        cgpm_serialize.loads(json_dumps(metadata))
+    blob = cgpm_serialize.dumps(metadata)
+    with pytest.raises(ValueError):
+        cgpm_serialize.loads(blob[:-1])
+    version = cgpm_serialize.VERSION + 1
+    with pytest.raises(ValueError):
+        cgpm_serialize.loads(cgpm_serialize._HEADER.pack(
+            cgpm_serialize.MAGIC, version, 0, 0, 0))
@@ -14,6 +14,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import StringIO
 import apsw
 import contextlib
 import itertools
@@ -576,6 +577,33 @@ def test_bayesdb_population_add_variable():
         assert core.bayesdb_has_variable(bdb, population_id, None, 'q')
         assert core.bayesdb_variable_number(bdb, population_id, None, 'q') == 3
 
+def test_bayesdb_catalog():
+    with bayesdb() as bdb:
+        bdb.sql_execute('create table t (a real, b real)')
+        bdb.execute('create population p for t (a numerical; b numerical)')
+        population_id = core.bayesdb_get_population(bdb, 'p')
+        catalog = bdb._catalog
+        assert catalog is not None
+        assert core.bayesdb_variable_name(bdb, population_id, None, 1) == 'b'
+        assert core.bayesdb_variable_numbers(bdb, population_id, None) == \
+            [0, 1]
+        assert bdb._catalog is catalog
+        # Writes through SQL invalidate the catalog.
+        bdb.sql_execute('''
+            UPDATE bayesdb_variable SET stattype = 'nominal' WHERE name = 'b'
+        ''')
+        assert core.bayesdb_variable_stattype(bdb, population_id, None, 1) \
+            == 'nominal'
+        assert bdb._catalog is not catalog
+        # So does rolling back.
+        with bdb.savepoint_rollback():
+            bdb.execute('drop population p')
+            assert not core.bayesdb_has_population(bdb, 'p')
+        assert core.bayesdb_has_population(bdb, 'p')
+        assert core.bayesdb_get_population(bdb, 'P') == population_id
+        with pytest.raises(ValueError):
+            core.bayesdb_variable_number(bdb, population_id, None, 'c')
+
 def test_bayesdb_implicit_population_generator():
     with bayesdb() as bdb:
         # Create table t.
@@ -694,6 +722,24 @@ def test_json_ready_models():
         j = bdb.backends['cgpm'].json_ready_models(bdb, pop_id, gen_id)
         for m in j["models"]:
             assert len(m["clusters"]) > 0
+        # Written incrementally, the models read back the same.
+        backend = bdb.backends['cgpm']
+        f = StringIO.StringIO()
+        backend.write_json_models(bdb, pop_id, gen_id, f)
+        assert json.loads(f.getvalue()) == json.loads(json.dumps(j))
+        # Restricted to chosen models and variables.
+        r = backend.json_ready_models(bdb, pop_id, gen_id, modelnos=[0],
+            variables=['label', 'age'])
+        assert len(r["models"]) == 1
+        assert sorted(r["column-statistical-types"]) == ['age', 'label']
+        assert sorted(r["categories"]) == ['label']
+        for m in r["models"]:
+            assert sorted(sum(m["column-partition"], [])) == ['age', 'label']
+            assert sorted(m["column-hypers"]) == ['age', 'label']
+            assert len(m["clusters"]) == len(m["column-partition"])
+        with pytest.raises(bayeslite.BQLError):
+            backend.json_ready_models(bdb, pop_id, gen_id,
+                variables=['nonexistent'])
         # This is handy debugging code (lets you look at the model)
         # that can be enabled manually when needed.
         with tempfile.NamedTemporaryFile(
@@ -535,3 +535,37 @@ def test_nig_normal_latent_2var2lat_conditional_smoke():
         bdb.execute('drop generator g1')
         bdb.execute('drop population p')
         bdb.execute('drop table t')
+
+def test_nig_normal_batched():
+    with bayesdb_open(':memory:') as bdb:
+        bayesdb_register_backend(bdb, NIGNormalBackend())
+        bdb.sql_execute('create table t(x, y)')
+        for x in xrange(100):
+            bdb.sql_execute('insert into t(x, y) values(?, ?)', (x, x*x - 100))
+        bdb.execute('create population p for t(x numerical; y numerical)')
+        bdb.execute('create generator g for p using nig_normal(xe deviation(x))')
+        bdb.execute('initialize 2 models for g')
+        bdb.execute('analyze g for 1 iteration')
+        population_id = core.bayesdb_get_population(bdb, 'p')
+        generator_id = core.bayesdb_get_generator(bdb, population_id, 'g')
+        backend = bdb.backends['nig_normal']
+        queries = [
+            (1, [(0, 50)], []),
+            (2, [(0, 50), (1, 3)], [(1, 1)]),
+            (3, [(-1, 1)], []),
+        ]
+        batched = backend.logpdf_joint_many(bdb, generator_id, None, queries)
+        assert batched == [
+            backend.logpdf_joint(bdb, generator_id, None, *query)
+            for query in queries
+        ]
+        samples = backend.simulate_joint_many(
+            bdb, generator_id, None, queries=[
+                (rowid, [colno for colno, _x in targets], constraints)
+                for rowid, targets, constraints in queries
+            ], num_samples=2)
+        assert [[len(row) for row in sample] for sample in samples] == \
+            [[1, 1], [2, 2], [1, 1]]
+        predictions = backend.predict_many(
+            bdb, generator_id, None, [(1, 0), (2, 1), (3, -1)], 0.5)
+        assert predictions[2] == 0
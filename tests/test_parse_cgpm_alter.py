@@ -124,3 +124,32 @@ def test_basic():
     ''') == [
         cgpm_alter_parser.SetRowClusterConc('eland', 12)
     ]
+
+def test_incorporate_rows():
+    assert parse_alter_cmds('incorporate new rows') == [
+        cgpm_alter_parser.IncorporateRows()
+    ]
+    assert parse_alter_cmds('''
+        ensure variable a in singleton view, incorporate new rows
+    ''') == [
+        cgpm_alter_parser.SetVarCluster(
+            ['a'], cgpm_alter_parser.SingletonCluster),
+        cgpm_alter_parser.IncorporateRows(),
+    ]
+    # Variables may still be named incorporate or new.
+    assert parse_alter_cmds('''
+        ensure variables (new, incorporate) in view of new
+    ''') == [
+        cgpm_alter_parser.SetVarCluster(['new', 'incorporate'], 'new')
+    ]
+    assert parse_alter_cmds('''
+        set row cluster concentration parameter within view of incorporate
+            to 2,
+        ensure variable new in singleton view
+    ''') == [
+        cgpm_alter_parser.SetRowClusterConc('incorporate', 2),
+        cgpm_alter_parser.SetVarCluster(
+            ['new'], cgpm_alter_parser.SingletonCluster),
+    ]
+    with pytest.raises(bayeslite.BQLParseError):
+        parse_alter_cmds('incorporate rows')